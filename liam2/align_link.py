@@ -1,78 +1,59 @@
 # encoding: utf-8
 from __future__ import print_function
 
-import random
-
 import numpy as np
 
 
-# noinspection PyNoneFunctionAssignment
-def align_link_nd(scores, need, num_candidates, hh, fcols_labels,
-                  secondary_axis=None):
-    # need and num_candidates are LabeledArray, but we don't need the extra
-    # functionality from this point on
-    need = np.asarray(need)
-    num_candidates = np.asarray(num_candidates)
-    print("total needed", need.sum())
-
-    still_needed = need.copy()
-    still_available = num_candidates.copy()
-
-    rel_need = still_needed.astype(np.float64) / still_available
-
-    unfillable_bins = still_needed > still_available
-    filled_bins = still_needed <= 0
-
-    if secondary_axis is not None:
-        assert secondary_axis < need.ndim
-        other_axes = list(range(need.ndim))
-        other_axes.pop(secondary_axis)
-        other_axes = tuple(other_axes)
-        # requires np 1.7+
-        still_needed_by_sec_axis = need.sum(axis=other_axes)
-        print("needed by secondary axis", still_needed_by_sec_axis)
-    else:
-        still_needed_by_sec_axis = None
-
-    still_needed_total = need.sum()
-
-    col_range = list(range(len(fcols_labels)))
-    aligned = np.zeros(len(hh), dtype=bool)
-    sorted_indices = scores.argsort()[::-1]
-    for sorted_idx in sorted_indices:
+def py_align_households(sorted_indices, draws, hh_offsets, hh_members,
+                        labels, sec_labels, still_needed, still_available,
+                        still_needed_by_sec_axis, still_needed_total):
+    """
+    households are considered in the order given by sorted_indices and
+    household hh is aligned if draws[hh] is lower than its relative need.
+
+    labels contains the (flat) bin of each person and sec_labels its bin
+    on the secondary axis (it is empty if there is no secondary axis).
+    still_needed, still_available and still_needed_by_sec_axis are
+    updated inplace.
+    """
+    use_sec_axis = len(sec_labels) > 0
+    num_sec_values = len(still_needed_by_sec_axis)
+    aligned = np.zeros(len(draws), dtype=bool)
+    for hh in sorted_indices:
         if still_needed_total <= 0:
             print("total reached")
             break
-        persons_in_hh_indices = hh[sorted_idx]
-        num_persons_in_hh = len(persons_in_hh_indices)
+        persons_in_hh = hh_members[hh_offsets[hh]:hh_offsets[hh + 1]]
+        num_persons_in_hh = len(persons_in_hh)
 
         # this will usually happen when the household is not a candidate
         # and thus no person in the household is a candidate either
         if num_persons_in_hh == 0:
             continue
 
-        persons_in_hh = tuple(np.empty(num_persons_in_hh, dtype=int)
-                              for _ in col_range)
-        prange = list(range(num_persons_in_hh))
-        for hh_col, fcol_labels in zip(persons_in_hh, fcols_labels):
-            for i in prange:
-                hh_col[i] = fcol_labels[persons_in_hh_indices[i]]
+        hh_labels = labels[persons_in_hh]
+        sn = still_needed[hh_labels]
+        sa = still_available[hh_labels]
 
         # Keep the highest relative need index for the family
-        hh_rel_need = np.nanmax(rel_need[persons_in_hh])
-
-        # count number of objects in the family belonging to already filled bins
-        surplus = filled_bins[persons_in_hh].sum()
-        if secondary_axis is not None and surplus == 0:
-            hh_axis_values = persons_in_hh[secondary_axis]
-            axis_num_pvalues = len(still_needed_by_sec_axis)
-            hh_counts_by_sec_axis = np.bincount(hh_axis_values,
-                                                minlength=axis_num_pvalues)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_need = sn.astype(np.float64) / sa
+        rel_need = rel_need[~np.isnan(rel_need)]
+        hh_rel_need = rel_need.max() if len(rel_need) else np.nan
+
+        # count number of objects in the family belonging to already
+        # filled bins
+        surplus = np.sum(sn <= 0)
+        if use_sec_axis and surplus == 0:
+            hh_counts_by_sec_axis = \
+                np.bincount(sec_labels[persons_in_hh],
+                            minlength=num_sec_values)
             if np.any(hh_counts_by_sec_axis >= still_needed_by_sec_axis):
                 surplus = 1
 
-        # count number of objects in the family belonging to unfillable bins
-        num_unfillable = unfillable_bins[persons_in_hh].sum()
+        # count number of objects in the family belonging to unfillable
+        # bins
+        num_unfillable = np.sum(sn > sa)
 
         # if either surplus or unfillable are not zero, adjust rel_need:
         if (surplus != 0) or (num_unfillable != 0):
@@ -85,42 +66,77 @@ def align_link_nd(scores, need, num_candidates, hh, fcols_labels,
 
         # Run through the random selection process, using rel_need as the
         # probability
-        if random.random() < hh_rel_need:
-            aligned[sorted_idx] = True
+        if draws[hh] < hh_rel_need:
+            aligned[hh] = True
 
             # update all counters
             still_needed_total -= num_persons_in_hh
 
-            # update grids (only the bins present in the family)
+            # update grids (only the bins present in the family). Note
+            # that we cannot use still_needed[hh_labels] -= 1 because that
+            # does not work as expected when there are more than one
+            # family member in a bin (it does not decrement the bin
+            # several times)
+            np.subtract.at(still_needed, hh_labels, 1)
+            np.subtract.at(still_available, hh_labels, 1)
+            if use_sec_axis:
+                np.subtract.at(still_needed_by_sec_axis,
+                               sec_labels[persons_in_hh], 1)
+        else:
+            np.subtract.at(still_available, hh_labels, 1)
+    return aligned
 
-            # Note that we have to loop explicitly on individuals, instead
-            # of using xxx[persons_in_hh] += 1 because that syntax does not
-            # work as expected when there are more than one family member
-            # in a bin (it does not increment the bin several times)
-            for values in zip(*persons_in_hh):
-                sn = still_needed[values] - 1
-                still_needed[values] = sn
 
-                sa = still_available[values] - 1
-                still_available[values] = sa
+# the compiled version is used when available. py_align_households is kept
+# around as the reference implementation.
+try:
+    from calign_link import align_households
+except ImportError:
+    align_households = py_align_households
 
-                if secondary_axis is not None:
-                    still_needed_by_sec_axis[values[secondary_axis]] -= 1
 
-                # unfillable stays unchanged in this case
-                filled_bins[values] = sn <= 0
+def align_link_nd(scores, need, num_candidates, hh_offsets, hh_members,
+                  fcols_labels, secondary_axis=None):
+    """
+    the members (rows in fcols_labels) of household i are
+    hh_members[hh_offsets[i]:hh_offsets[i + 1]]
+    """
+    # need and num_candidates are LabeledArray, but we don't need the extra
+    # functionality from this point on
+    need = np.asarray(need)
+    num_candidates = np.asarray(num_candidates)
+    print("total needed", need.sum())
 
-                # using np.float64 to workaround an issue with numpy 1.8
-                # https://github.com/numpy/numpy/issues/4636
-                rel_need[values] = np.float64(sn) / sa
-        else:
-            for values in zip(*persons_in_hh):
-                sa = still_available[values] - 1
-                still_available[values] = sa
-                sn = still_needed[values]
+    # the bins are handled as a flat array: compute the flat bin of each
+    # person
+    assert need.size < 2 ** 31
+    labels = np.ravel_multi_index(fcols_labels, need.shape).astype(np.int32)
+    still_needed = need.astype(np.int64).ravel()
+    still_available = num_candidates.astype(np.int64).ravel()
 
-                unfillable_bins[values] = sn > sa
+    if secondary_axis is not None:
+        assert secondary_axis < need.ndim
+        other_axes = list(range(need.ndim))
+        other_axes.pop(secondary_axis)
+        other_axes = tuple(other_axes)
+        # requires np 1.7+
+        still_needed_by_sec_axis = need.sum(axis=other_axes).astype(np.int64)
+        print("needed by secondary axis", still_needed_by_sec_axis)
+        sec_labels = np.asarray(fcols_labels[secondary_axis], dtype=np.int32)
+    else:
+        still_needed_by_sec_axis = np.empty(0, dtype=np.int64)
+        sec_labels = np.empty(0, dtype=np.int32)
 
-                rel_need[values] = np.float64(sn) / sa
+    sorted_indices = scores.argsort()[::-1]
+    # one random number per household, drawn from the numpy random stream so
+    # that the result is reproducible with random_seed
+    draws = np.random.uniform(size=len(scores))
+    aligned = align_households(sorted_indices, draws,
+                               np.asarray(hh_offsets, dtype=np.intp),
+                               np.asarray(hh_members, dtype=np.intp),
+                               labels, sec_labels, still_needed,
+                               still_available, still_needed_by_sec_axis,
+                               need.sum())
+    still_needed = still_needed.reshape(need.shape).astype(need.dtype)
     print("missing %d individuals" % np.sum(still_needed))
     return aligned, still_needed
@@ -1,7 +1,6 @@
 # encoding: utf-8
 from __future__ import print_function
 
-from itertools import izip
 import os
 
 import numpy as np
@@ -12,7 +11,7 @@ from context import context_length
 from expr import Expr, Variable, expr_eval, missing_values, always
 from exprbases import FilteredExpression
 from groupby import GroupBy
-from links import LinkGet, Many2One
+from links import one2many_index
 from partition import partition_nd, filter_to_indices
 from importer import load_ndarray
 from utils import PrettyTable, LabeledArray
@@ -46,6 +45,24 @@ def kill_axis(axis_name, value, expressions, possible_values, need):
     return expressions, possible_values, need
 
 
+def values_to_labels(values, pvalues):
+    """
+    returns the index in pvalues of each value (as an int32 array), or -1 for
+    values which are not in pvalues.
+    """
+    values = np.asarray(values)
+    pvalues = np.asarray(pvalues)
+    if not len(pvalues):
+        return np.full(len(values), -1, dtype=np.int32)
+    sorter = np.argsort(pvalues, kind='mergesort')
+    sorted_pvalues = pvalues[sorter]
+    # if a value is present several times in pvalues, use its last index
+    pos = np.searchsorted(sorted_pvalues, values, side='right') - 1
+    pos = np.maximum(pos, 0)
+    found = sorted_pvalues[pos] == values
+    return np.where(found, sorter[pos], -1).astype(np.int32)
+
+
 def align_get_indices_nd(ctx_length, groups, need, filter_value, score,
                          take_filter=None, leave_filter=None,
                          method="bysorting"):
@@ -58,118 +75,151 @@ def align_get_indices_nd(ctx_length, groups, need, filter_value, score,
     else:
         bool_filter_value = True
 
-    maybe_filter = bool_filter_value
+    # all groups are handled at once: members contains the indices of the
+    # members of all groups, one group after the other, and member_groups
+    # the group of each of them
+    num_groups = len(groups)
+    group_sizes = np.array([len(g) for g in groups], dtype=int)
+    if num_groups:
+        members = np.concatenate(groups).astype(int)
+    else:
+        members = np.empty(0, dtype=int)
+    member_groups = np.repeat(np.arange(num_groups), group_sizes)
+
     if take_filter is not None:
-        take_intersect = take_filter & bool_filter_value
-        take = np.sum(take_intersect)
-
-        # XXX: it would probably be faster to leave the filters as boolean
-        # vector and do
-        #     take_members = take_filter[member_indices]
-        #     group_always = member_indices[take_members]
-        # instead of
-        #     group_always = np.intersect1d(members_indices, take_indices,
-        #                                   assume_unique=True)
-        take_indices = filter_to_indices(take_intersect)
-        maybe_filter &= ~take_filter
+        take = np.sum(take_filter & bool_filter_value)
+        is_take = take_filter[members]
     else:
         take = 0
-        take_indices = None
+        is_take = np.zeros(len(members), dtype=bool)
 
     if leave_filter is not None:
         leave = np.sum(leave_filter & bool_filter_value)
-        maybe_filter &= ~leave_filter
+        is_maybe = ~(is_take | leave_filter[members])
     else:
         leave = 0
-
-    if take_filter is not None or leave_filter is not None:
-        maybe_indices = filter_to_indices(maybe_filter)
-    else:
-        maybe_indices = None
-
-    total_underflow = 0
-    total_overflow = 0
-    total_affected = 0
+        is_maybe = ~is_take
 
     aligned = np.zeros(ctx_length, dtype=bool)
 
     if method == 'sidewalk':
-        score_max = max(score)
-        score_min = min(score)
+        score_max = np.max(score)
+        score_min = np.min(score)
         if score_max > 1 or score_min < 0:
             raise Exception("""Score values are in the interval {} - {}.
 Sidewalk alignment can only be used with a score between 0 and 1.
 You may want to use a logistic function.
 """.format(score_min, score_max))
 
-    for members_indices, group_need in izip(groups, need.flat):
-        if len(members_indices):
-            affected = group_need
-            total_affected += affected
-
-            if take_indices is not None:
-                group_always = np.intersect1d(members_indices, take_indices,
-                                              assume_unique=True)
-                num_always = len(group_always)
-                aligned[group_always] = True
-            else:
-                num_always = 0
-
-            if affected > num_always:
-                if maybe_indices is not None:
-                    group_maybe_indices = np.intersect1d(members_indices,
-                                                         maybe_indices,
-                                                         assume_unique=True)
-                else:
-                    group_maybe_indices = members_indices
-                if isinstance(score, np.ndarray):
-                    if method == 'bysorting':
-                        maybe_members_rank_value = score[group_maybe_indices]
-                        # TODO: use np.partition (np1.8+)
-                        sorted_local_indices = np.argsort(maybe_members_rank_value)
-                        sorted_global_indices = \
-                            group_maybe_indices[sorted_local_indices]
-                    elif method == 'sidewalk':
-                        sorted_global_indices = \
-                            np.random.permutation(group_maybe_indices)
-                else:
-                    # if the score expression is a constant, we don't need to
-                    # sort indices. In that case, the alignment will first take
-                    # the individuals created last (highest id).
-                    sorted_global_indices = group_maybe_indices
-
-                # maybe_to_take is always > 0
-                maybe_to_take = affected - num_always
-                if method == 'bysorting':
-                    # take the last X individuals (ie those with the highest
-                    # score)
-                    indices_to_take = sorted_global_indices[-maybe_to_take:]
-                elif method == 'sidewalk':
-                    proba_sum = sum(score[sorted_global_indices])
-                    if maybe_to_take > round(proba_sum):
-                        raise ValueError(
-                            "Cannot use 'sidewalk' with need = {} > sum of probabilities = {}".format(
-                                maybe_to_take, proba_sum
-                                )
-                            )
-                    u = np.random.uniform() + np.arange(maybe_to_take)
-                    # on the random sample, score are cumulated and then, we
-                    # extract indices of each value before each value of u
-                    cum_score = np.cumsum(score[sorted_global_indices])
-                    indices_to_take = \
-                        sorted_global_indices[np.searchsorted(cum_score, u)]
-
-                underflow = maybe_to_take - len(indices_to_take)
-                if underflow > 0:
-                    total_underflow += underflow
-                aligned[indices_to_take] = True
-            elif affected < num_always:
-                total_overflow += num_always - affected
+    # individuals in the "take" filter are always aligned
+    aligned[members[is_take]] = True
+    num_always = np.bincount(member_groups[is_take], minlength=num_groups)
+
+    affected = need.ravel()[:num_groups]
+    non_empty = group_sizes > 0
+    total_affected = int(np.sum(affected[non_empty]))
+    overflow_groups = non_empty & (affected < num_always)
+    total_overflow = int(np.sum(num_always[overflow_groups] -
+                                affected[overflow_groups]))
+
+    # maybe_to_take is always > 0 for the groups which need more individuals
+    maybe_to_take = np.where(non_empty & (affected > num_always),
+                             affected - num_always, 0)
+
+    maybe_members = members[is_maybe]
+    maybe_groups = member_groups[is_maybe]
+    num_maybe = np.bincount(maybe_groups, minlength=num_groups)
+    maybe_ends = np.cumsum(num_maybe)
+    if method == 'bysorting':
+        if isinstance(score, np.ndarray):
+            # sort the "maybe" individuals by group, then by score within each
+            # group. lexsort is stable, so individuals with the same score
+            # keep their order.
+            order = np.lexsort((score[maybe_members], maybe_groups))
+            sorted_members = maybe_members[order]
+        else:
+            # if the score expression is a constant, we don't need to
+            # sort indices. In that case, the alignment will first take
+            # the individuals created last (highest id).
+            sorted_members = maybe_members
+
+        # take the last X individuals of each group (ie those with the highest
+        # score)
+        first_taken = (maybe_ends - maybe_to_take)[maybe_groups]
+        aligned[sorted_members[np.arange(len(sorted_members)) >=
+                               first_taken]] = True
+        underflow = np.maximum(maybe_to_take - num_maybe, 0)
+    elif method == 'sidewalk':
+        if not isinstance(score, np.ndarray):
+            score = np.full(ctx_length, score, dtype=float)
+
+        # only consider the groups which need more individuals
+        is_candidate = maybe_to_take[maybe_groups] > 0
+        candidates = maybe_members[is_candidate]
+        candidate_groups = maybe_groups[is_candidate]
+
+        # shuffle the candidates within each group: sort them by group, then
+        # by a random key
+        random_keys = np.random.uniform(size=len(candidates))
+        order = np.lexsort((random_keys, candidate_groups))
+        candidates = candidates[order]
+        candidate_groups = candidate_groups[order]
+        candidate_scores = score[candidates]
+
+        proba_sum = np.bincount(candidate_groups, weights=candidate_scores,
+                                minlength=num_groups)
+        # round half up, like round() in Python 2
+        impossible = maybe_to_take > np.floor(proba_sum + 0.5)
+        if np.any(impossible):
+            group = impossible.nonzero()[0][0]
+            raise ValueError(
+                "Cannot use 'sidewalk' with need = {} > sum of probabilities = {}".format(
+                    maybe_to_take[group], proba_sum[group]
+                    )
+                )
+
+        # on the shuffled candidates, scores are cumulated (for all groups at
+        # once) and then, we extract the indices of the candidates at
+        # u, u + 1, u + 2, ... from the start of each group
+        cum_score = np.cumsum(candidate_scores)
+        num_candidates = np.bincount(candidate_groups, minlength=num_groups)
+        group_ends = np.cumsum(num_candidates)
+        group_starts = group_ends - num_candidates
+        cum_score_at_start = np.concatenate(([0.0], cum_score))[group_starts]
+
+        to_take_groups = maybe_to_take.nonzero()[0]
+        u = np.random.uniform(size=len(to_take_groups))
+        target_groups = np.repeat(to_take_groups,
+                                  maybe_to_take[to_take_groups])
+        target_offsets = np.cumsum(maybe_to_take[to_take_groups])
+        # position of each target within its group
+        target_rank = np.arange(len(target_groups)) - \
+            np.repeat(target_offsets - maybe_to_take[to_take_groups],
+                      maybe_to_take[to_take_groups])
+        targets = (cum_score_at_start[target_groups] +
+                   np.repeat(u, maybe_to_take[to_take_groups]) + target_rank)
+        # the candidate selected by a target is the first one whose
+        # cumulated score is strictly greater than the target
+        positions = np.searchsorted(cum_score, targets, side='right')
+        # due to rounding, a target can be beyond the last candidate of its
+        # group (in that case the last candidate is taken several times and
+        # this counts as underflow)
+        positions = np.minimum(positions, group_ends[target_groups] - 1)
+        # since scores are cumulated for all groups, a target slightly before
+        # the start of its group (due to rounding) would select the last
+        # candidate of the previous group
+        positions = np.maximum(positions, group_starts[target_groups])
+        is_new = np.ones(len(positions), dtype=bool)
+        is_new[1:] = positions[1:] != positions[:-1]
+        aligned[candidates[positions]] = True
+        num_taken = np.bincount(target_groups[is_new], minlength=num_groups)
+        underflow = maybe_to_take - num_taken
+    total_underflow = int(np.sum(underflow))
 
     num_aligned = int(np.sum(aligned))
     # this assertion is only valid in the non weighted case
     assert num_aligned == total_affected + total_overflow - total_underflow
-    num_partitioned = sum(len(g) for g in groups)
+    num_partitioned = len(members)
     if config.log_level == "processes":
         print(" %d/%d" % (num_aligned, num_partitioned), end=" ")
         if (take_filter is not None) or (leave_filter is not None):
@@ -343,7 +393,7 @@ class AlignmentAbsoluteValues(FilteredExpression):
             # need is calculated over score and we could think of
             # calculate without leave_filter and without take_filter
             if need is None:
-                need = sum(score)
+                need = np.sum(score)
 
         # XXX: move this to _eval_need?
         # need is a single scalar
@@ -460,15 +510,22 @@ class AlignmentAbsoluteValues(FilteredExpression):
 
         # evaluate columns
         target_columns = [expr_eval(e, target_context) for e in expressions]
-        # this is a one2many, so the link column is on the target side
-        link_column = target_context[link._link_field]
+
+        # rows of the linked individuals for each local individual.
+        # e.g. the rows of the persons of each household
+        link_index = one2many_index(context, link)
 
         filter_expr = self._getfilter(context, filter)
         if filter_expr is not None:
-            reverse_link = Many2One("reverse", link._link_field,
-                                    context.entity.name)
-            target_filter = LinkGet(reverse_link, filter_expr, False)
-            target_filter_value = expr_eval(target_filter, target_context)
+            # propagate the filter to linked individuals
+            filter_value = expr_eval(filter_expr, context)
+            if np.isscalar(filter_value):
+                filter_value = np.full(context_length(context), filter_value,
+                                       dtype=bool)
+            source_rows = link_index.source_rows
+            linked = source_rows != missing_values[int]
+            target_filter_value = np.zeros(len(source_rows), dtype=bool)
+            target_filter_value[linked] = filter_value[source_rows[linked]]
 
             # It is often not a good idea to pre-filter columns like this
             # because we loose information about "indices", but in this case,
@@ -477,8 +534,6 @@ class AlignmentAbsoluteValues(FilteredExpression):
                                 if isinstance(col, np.ndarray) and col.shape
                                 else [col]
                                 for col in target_columns]
-
-            link_column = link_column[target_filter_value]
         else:
             filtered_columns = target_columns
             target_filter_value = None
@@ -488,25 +543,18 @@ class AlignmentAbsoluteValues(FilteredExpression):
         # We can't use _group_labels_light because group_labels assigns labels
         # on a first come, first served basis, not using the order they are
         # in pvalues
-        fcols_labels = []
-        filtered_length = len(filtered_columns[0])
-        unaligned = np.zeros(filtered_length, dtype=bool)
-        for fcol, pvalues in zip(filtered_columns, need.pvalues):
-            pvalues_index = dict((v, i) for i, v in enumerate(pvalues))
-            fcol_labels = np.empty(filtered_length, dtype=np.int32)
-            for i in range(filtered_length):
-                value_idx = pvalues_index.get(fcol[i], -1)
-                if value_idx == -1:
-                    unaligned[i] = True
-                fcol_labels[i] = value_idx
-            fcols_labels.append(fcol_labels)
+        fcols_labels = [values_to_labels(fcol, pvalues)
+                        for fcol, pvalues in zip(filtered_columns,
+                                                 need.pvalues)]
+        unaligned = np.zeros(len(fcols_labels[0]), dtype=bool)
+        for fcol_labels in fcols_labels:
+            unaligned |= fcol_labels == -1
 
         num_unaligned = np.sum(unaligned)
         if num_unaligned:
-            # further filter label columns and link_column
+            # further filter label columns
             validlabels = ~unaligned
             fcols_labels = [labels[validlabels] for labels in fcols_labels]
-            link_column = link_column[validlabels]
 
             # display who are the evil ones
             ids = target_context['id']
@@ -519,19 +567,6 @@ class AlignmentAbsoluteValues(FilteredExpression):
         else:
             del unaligned
 
-        id_to_rownum = context.id_to_rownum
-        missing_int = missing_values[int]
-        source_ids = link_column
-
-        if len(id_to_rownum):
-            source_rows = id_to_rownum[source_ids]
-            # filter out missing values: those where the value of the link
-            # points to nowhere (-1)
-            source_rows[source_ids == missing_int] = missing_int
-        else:
-            assert np.all(source_ids == missing_int)
-            source_rows = []
-
         # filtered_columns are not filtered further on invalid labels
         # (num_unaligned) but this is not a problem since those will be
         # ignored by GroupBy anyway.
@@ -545,25 +580,18 @@ class AlignmentAbsoluteValues(FilteredExpression):
         # because the length of the context is not correct.
         num_candidates = expr_eval(groupby_expr, target_context)
 
-        # fetch the list of linked individuals for each local individual.
-        # e.g. the list of person ids for each household
-        hh = np.empty(context_length(context), dtype=object)
-        # we can't use .fill([]) because it reuses the same list for all
-        # objects
-        for i in range(len(hh)):
-            hh[i] = []
-
-        # Even though this is highly sub-optimal, the time taken to create
-        # those lists of ids is very small compared to the total time taken
-        # for align_other (0.2s vs 4.26), so I shouldn't care too much about
-        # it for now.
-
-        # target_row (row of person) is an index valid for *filtered/label*
-        # columns !
-        for target_row, source_row in enumerate(source_rows):
-            if source_row == -1:
-                continue
-            hh[source_row].append(target_row)
+        # restrict the linked individuals to those with valid labels, so that
+        # their rows are valid indices for fcols_labels
+        if target_filter_value is not None:
+            members_mask = target_filter_value.copy()
+            if num_unaligned:
+                members_mask[target_filter_value] = validlabels
+        elif num_unaligned:
+            members_mask = validlabels
+        else:
+            members_mask = None
+        if members_mask is not None:
+            link_index = link_index.subset(members_mask)
 
         class FakeContainer(object):
             def __init__(self, length):
@@ -578,8 +606,8 @@ class AlignmentAbsoluteValues(FilteredExpression):
         # need = np.asarray(need)
         need = np.asarray(need)
         aligned, error = \
-            align_link_nd(score, need, num_candidates, hh, fcols_labels,
-                          secondary_axis)
+            align_link_nd(score, need, num_candidates, link_index.offsets,
+                          link_index.indices, fcols_labels, secondary_axis)
         self.past_error = error
         return aligned
 
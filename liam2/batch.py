@@ -0,0 +1,112 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import os
+import sys
+import time
+import multiprocessing
+import traceback
+
+import config
+from data import H5Source
+from simulation import Simulation
+from utils import time2str
+
+# {input_path: indexes} of the input files used by the simulations of the
+# batch. They are computed by the parent process before forking the worker
+# processes, which inherit them.
+_batch_indexes = {}
+
+
+def _run_batch_worker(args):
+    fpath, log_path, kwargs = args
+    start_time = time.time()
+    stdout = sys.stdout
+    try:
+        with open(log_path, 'w') as log_file:
+            sys.stdout = log_file
+            try:
+                simulation = Simulation.from_yaml(fpath, jobs=1, **kwargs)
+                data_source = simulation.data_source
+                if isinstance(data_source, H5Source):
+                    data_source.indexes = \
+                        _batch_indexes.get(data_source.input_path, {})
+                simulation.run()
+                error = None
+            except Exception as e:
+                traceback.print_exc(file=log_file)
+                error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout = stdout
+    return fpath, time.time() - start_time, error
+
+
+def run_batch(fpaths, jobs=None, **kwargs):
+    """
+    runs several simulation files (typically variants of the same model) in
+    a pool of jobs worker processes (defaults to the number of CPUs). The
+    input files are indexed only once for all the simulations which use them.
+    The console output of each simulation is written to a .log file next to
+    its output file (or named after the simulation file, in the output
+    directory, for simulations without output file). kwargs are passed to
+    Simulation.from_yaml.
+
+    Returns the number of simulations which failed.
+    """
+    if not hasattr(os, 'fork'):
+        raise Exception("batch runs are not supported on this platform")
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    # check all simulation files before starting any of them and index their
+    # input files
+    tasks = []
+    output_paths = set()
+    for fpath in fpaths:
+        print("checking simulation file: '%s'" % fpath)
+        simulation = Simulation.from_yaml(fpath, **kwargs)
+        output_path = simulation.data_sink.output_path
+        if simulation.minimal_output:
+            # the output file of a simulation without output file is in a
+            # temporary directory, which is created again when it is run
+            os.rmdir(os.path.dirname(output_path))
+            fname = os.path.splitext(os.path.basename(fpath))[0]
+            log_path = os.path.join(config.output_directory, fname + '.log')
+        else:
+            log_path = os.path.splitext(output_path)[0] + '.log'
+        if output_path in output_paths:
+            raise Exception("several simulations of the batch use the same "
+                            "output file: '%s'" % output_path)
+        output_paths.add(output_path)
+        data_source = simulation.data_source
+        if isinstance(data_source, H5Source):
+            input_path = data_source.input_path
+            if input_path not in _batch_indexes:
+                simulation.load()
+                data_source.close()
+                _batch_indexes[input_path] = data_source.indexes
+        tasks.append((fpath, log_path, kwargs))
+
+    print()
+    print("running %d simulations using %d processes" % (len(tasks), jobs))
+    start_time = time.time()
+    # each simulation is run in a freshly forked process, so that it does not
+    # inherit the state (e.g. config) of the previous simulations
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        num_failed = 0
+        results = pool.imap_unordered(_run_batch_worker, tasks, chunksize=1)
+        for fpath, elapsed, error in results:
+            if error is None:
+                status = "done"
+            else:
+                status = "FAILED (%s)" % error
+                num_failed += 1
+            print(" - %s: %s (%s elapsed)" % (fpath, status,
+                                              time2str(elapsed)))
+    finally:
+        pool.terminate()
+        _batch_indexes.clear()
+    print("%d simulations done in %s, %d failed"
+          % (len(tasks), time2str(time.time() - start_time), num_failed))
+    return num_failed
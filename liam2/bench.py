@@ -0,0 +1,233 @@
+# encoding: utf-8
+from __future__ import division, print_function
+
+import json
+import os
+import sys
+import time
+import platform
+import multiprocessing
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+import yaml
+
+from data import H5Source
+from links import Many2One
+from popgen import generate_population
+from simulation import Simulation
+from utils import validate_dict, timed, time2str, size2str, peak_mem_usage
+from version import __version__
+
+
+suite_layout = {
+    '#models': [str],
+    'sizes': [int],
+    'periods': int
+}
+
+
+def link_fields(entities):
+    """
+    returns the fields of entities which contain ids of individuals (links),
+    as a {entity_name: {field_name: target_entity_name}} dictionary
+    """
+    fields = {}
+    for entity in entities:
+        for link in entity.links.itervalues():
+            # noinspection PyProtectedMember
+            if isinstance(link, Many2One):
+                owner, target = entity.name, link._target_entity_name
+            else:
+                # the link field of a one2many link is in the target entity
+                # and contains ids of the entity of the link
+                owner, target = link._target_entity_name, entity.name
+            # noinspection PyProtectedMember
+            fields.setdefault(owner, {})[link._link_field] = target
+    return fields
+
+
+def _run_benchmark_worker(args):
+    fpath, log_path, kwargs = args
+    stdout = sys.stdout
+    result = {}
+    try:
+        with open(log_path, 'w') as log_file:
+            sys.stdout = log_file
+            try:
+                simulation = Simulation.from_yaml(fpath, **kwargs)
+                simulation.run()
+                stats = simulation.run_stats
+                result = {'elapsed': stats['elapsed'],
+                          'individuals': stats['individuals'],
+                          'individuals_per_sec': stats['individuals_per_sec'],
+                          'peak_memory': peak_mem_usage(),
+                          'processes': stats['process_time'],
+                          'error': None}
+            except Exception as e:
+                traceback.print_exc(file=log_file)
+                result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    finally:
+        sys.stdout = stdout
+    return result
+
+
+def load_baseline(fpath):
+    """
+    returns the results of a benchmark history file (those of its last entry)
+    """
+    with open(fpath) as f:
+        history = json.load(f)
+    entry = history[-1] if isinstance(history, list) else history
+    return entry['results']
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """
+    compares results with those of baseline (for the same models and sizes)
+    and returns the number of regressions, ie the number of times a model is
+    more than threshold (as a fraction) slower or uses more memory
+    """
+    base_results = {(r['model'], r['size']): r for r in baseline
+                    if r.get('error') is None}
+    regressions = 0
+    print()
+    print("comparison with the baseline:")
+    for result in results:
+        base = base_results.get((result['model'], result['size']))
+        if base is None or result['error'] is not None:
+            continue
+        for key, to_str in (('elapsed', time2str), ('peak_memory', size2str)):
+            new, old = result.get(key), base.get(key)
+            if new is None or not old:
+                continue
+            change = new / old - 1
+            if change > threshold:
+                status = "REGRESSION"
+                regressions += 1
+            else:
+                status = "ok"
+            print(" - %s (%s individuals) %s: %s vs %s (%+d%%) %s"
+                  % (result['model'], result['size'] or 'input', key,
+                     to_str(new), to_str(old), change * 100, status))
+    print("%d regression(s) found" % regressions)
+    return regressions
+
+
+def run_benchmarks(suite_path, sizes=None, periods=None, output_dir=None,
+                   history_path=None, baseline_path=None, threshold=0.1):
+    """
+    runs the models of a benchmark suite (a yaml file) on populations of
+    each of the given sizes (generated from their input file) and appends
+    the timings, throughput and peak memory of each run to a JSON history
+    file. If baseline_path is given, the results are compared with the last
+    results of that (history) file.
+
+    Returns (the number of failed benchmarks, the number of regressions).
+    """
+    suite_dir = os.path.dirname(os.path.abspath(suite_path))
+    with open(suite_path) as f:
+        suite = yaml.load(f)
+    validate_dict(suite, suite_layout)
+    if sizes is None:
+        # None means: use the input file as is
+        sizes = suite.get('sizes', [None])
+    if periods is None:
+        periods = suite.get('periods')
+    if output_dir is None:
+        output_dir = os.path.join(suite_dir, 'output')
+    if history_path is None:
+        history_path = os.path.join(suite_dir, 'history.json')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # load the baseline before the history is modified (it can be the same
+    # file)
+    baseline = load_baseline(baseline_path) if baseline_path is not None \
+        else None
+
+    # check all models and generate their populations before running any
+    tasks = []
+    scaled_inputs = {}
+    for model in suite['models']:
+        fpath = os.path.join(suite_dir, model)
+        print("checking model: '%s'" % model)
+        simulation = Simulation.from_yaml(fpath, output_dir=output_dir,
+                                          periods=periods)
+        data_source = simulation.data_source
+        # models without input file generate a population of a fixed size
+        # (which the model can rely on), so they are run only once and with
+        # their own number of periods
+        if isinstance(data_source, H5Source):
+            model_sizes, model_periods = sizes, periods
+        else:
+            model_sizes, model_periods = [None], None
+        for size in model_sizes:
+            name = os.path.splitext(os.path.basename(model))[0]
+            if size is not None:
+                name += '_%d' % size
+            # assertions can fail on populations or periods the model was
+            # not written for
+            kwargs = dict(output_dir=output_dir, output_file=name + '.h5',
+                          periods=model_periods, runs=1, jobs=1,
+                          assertions='warn')
+            if size is not None:
+                input_path = data_source.input_path
+                key = (input_path, size)
+                if key not in scaled_inputs:
+                    root = os.path.splitext(os.path.basename(input_path))[0]
+                    scaled_path = os.path.join(output_dir, 'population_%s_%d.h5'
+                                               % (root, size))
+                    print("generating a population of %d individuals from "
+                          "'%s'" % (size, input_path))
+                    timed(generate_population, input_path, scaled_path,
+                          link_fields(simulation.entities), size=size)
+                    scaled_inputs[key] = scaled_path
+                kwargs['input_file'] = scaled_inputs[key]
+            log_path = os.path.join(output_dir, name + '.log')
+            tasks.append((model, size, (fpath, log_path, kwargs)))
+
+    print()
+    print("running %d benchmarks" % len(tasks))
+    results = []
+    # benchmarks are run one after the other (so that they do not compete for
+    # the CPU), each in a fresh process (so that its peak memory is its own)
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        worker_results = pool.imap(_run_benchmark_worker,
+                                   [args for _, _, args in tasks], chunksize=1)
+        for (model, size, _), result in zip(tasks, worker_results):
+            result = dict(result, model=model, size=size)
+            if result['error'] is None:
+                status = "%s elapsed, %d individuals/s/period, peak memory %s" \
+                         % (time2str(result['elapsed']),
+                            result['individuals_per_sec'] or 0,
+                            size2str(result['peak_memory'] or 0))
+            else:
+                status = "FAILED (%s)" % result['error']
+            print(" - %s (%s individuals): %s"
+                  % (model, size or 'input', status))
+            results.append(result)
+    finally:
+        pool.terminate()
+
+    entry = OrderedDict([('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+                         ('liam2', __version__),
+                         ('python', platform.python_version()),
+                         ('numpy', np.__version__),
+                         ('platform', platform.platform()),
+                         ('results', results)])
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = json.load(f)
+    history.append(entry)
+    with open(history_path, 'w') as f:
+        json.dump(history, f, indent=1)
+    print("results appended to '%s'" % history_path)
+
+    num_failed = sum(result['error'] is not None for result in results)
+    regressions = 0
+    if baseline is not None:
+        regressions = compare_results(results, baseline, threshold)
+    return num_failed, regressions
@@ -1,8 +1,19 @@
 # encoding: utf-8
 from __future__ import print_function
 
+from contextlib import contextmanager
+from threading import RLock
+
 
 class Cache(dict):
+    """
+    Processes can run concurrently in several threads, so all methods
+    modifying several keys at once hold the lock of the cache.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.lock = RLock()
+
     def invalidate(self, period, entity_name, variable=None):
         """
         Invalidates all keys matching period, entity_name and possibly variable
@@ -10,13 +21,36 @@ class Cache(dict):
         if variable is None, it matches all keys for that period and entity
         """
         # print("invalidate", variable.name, period, entity_name)
-        for i, key in enumerate(self.keys()):
-            # print(key)
-            c_expr, c_period, c_entity_name, c_filter_expr = key
-            # XXX: do we also need to invalidate when name not in expr but
-            # name in filter_expr?
-            expr_match = variable is None or variable in c_expr
-            if (c_period == period and c_entity_name == entity_name and
-                    expr_match):
-                # print("matches", key, " => invalidating")
-                del self[key]
+        with self.lock:
+            for key in self.keys():
+                # print(key)
+                c_expr, c_period, c_entity_name, c_filter_expr = key
+                # XXX: do we also need to invalidate when name not in expr but
+                # name in filter_expr?
+                expr_match = variable is None or variable in c_expr
+                if (c_period == period and c_entity_name == entity_name and
+                        expr_match):
+                    # print("matches", key, " => invalidating")
+                    del self[key]
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+
+    @contextmanager
+    def scope(self):
+        """
+        Context manager giving a local (initially empty) cache for the
+        duration of the with block. The content of the cache before the block
+        is restored afterwards, so clearing the cache inside the block only
+        discards what was cached inside the block.
+        """
+        with self.lock:
+            saved = dict(self)
+            dict.clear(self)
+        try:
+            yield self
+        finally:
+            with self.lock:
+                dict.clear(self)
+                self.update(saved)
@@ -0,0 +1,98 @@
+cimport cython
+
+cimport numpy as np
+import numpy as np
+from numpy cimport int32_t, int64_t, intp_t, ndarray
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def align_households(ndarray[intp_t] sorted_indices, ndarray[double] draws,
+                     ndarray[intp_t] hh_offsets, ndarray[intp_t] hh_members,
+                     ndarray[int32_t] labels, ndarray[int32_t] sec_labels,
+                     ndarray[int64_t] still_needed,
+                     ndarray[int64_t] still_available,
+                     ndarray[int64_t] still_needed_by_sec_axis,
+                     int64_t still_needed_total):
+    """
+    compiled version of align_link.py_align_households. See there for details.
+    """
+    cdef Py_ssize_t n = len(sorted_indices)
+    cdef Py_ssize_t num_sec_values = len(still_needed_by_sec_axis)
+    cdef bint use_sec_axis = len(sec_labels) > 0
+    cdef ndarray[np.uint8_t, cast=True] aligned = np.zeros(len(draws),
+                                                           dtype=bool)
+    cdef ndarray[int64_t] hh_counts_by_sec_axis = np.zeros(num_sec_values,
+                                                           dtype=np.int64)
+    cdef Py_ssize_t i, j, v, hh, start, stop
+    cdef int32_t label
+    cdef int64_t sn, sa, surplus, num_unfillable
+    cdef double hh_rel_need, rel_need
+
+    for i in range(n):
+        if still_needed_total <= 0:
+            print("total reached")
+            break
+        hh = sorted_indices[i]
+        start = hh_offsets[hh]
+        stop = hh_offsets[hh + 1]
+
+        # this will usually happen when the household is not a candidate
+        # and thus no person in the household is a candidate either
+        if start == stop:
+            continue
+
+        # Keep the highest relative need index for the family (ignoring nans)
+        # count number of objects in the family belonging to already filled
+        # bins and to unfillable bins
+        hh_rel_need = np.nan
+        surplus = 0
+        num_unfillable = 0
+        for j in range(start, stop):
+            label = labels[hh_members[j]]
+            sn = still_needed[label]
+            sa = still_available[label]
+            rel_need = <double>sn / <double>sa
+            if rel_need == rel_need and (hh_rel_need != hh_rel_need or
+                                         rel_need > hh_rel_need):
+                hh_rel_need = rel_need
+            if sn <= 0:
+                surplus += 1
+            if sn > sa:
+                num_unfillable += 1
+
+        if use_sec_axis and surplus == 0:
+            for v in range(num_sec_values):
+                hh_counts_by_sec_axis[v] = 0
+            for j in range(start, stop):
+                hh_counts_by_sec_axis[sec_labels[hh_members[j]]] += 1
+            for v in range(num_sec_values):
+                if hh_counts_by_sec_axis[v] >= still_needed_by_sec_axis[v]:
+                    surplus = 1
+                    break
+
+        # if either surplus or unfillable are not zero, adjust rel_need:
+        if surplus != 0 or num_unfillable != 0:
+            if num_unfillable > surplus:
+                hh_rel_need = 1.0
+            elif num_unfillable == surplus:
+                hh_rel_need = 0.5
+            else:
+                hh_rel_need = 0.0
+
+        # Run through the random selection process, using rel_need as the
+        # probability
+        if draws[hh] < hh_rel_need:
+            aligned[hh] = 1
+            still_needed_total -= stop - start
+            for j in range(start, stop):
+                label = labels[hh_members[j]]
+                still_needed[label] -= 1
+                still_available[label] -= 1
+                if use_sec_axis:
+                    still_needed_by_sec_axis[sec_labels[hh_members[j]]] -= 1
+        else:
+            for j in range(start, stop):
+                still_available[labels[hh_members[j]]] -= 1
+    return aligned
@@ -0,0 +1,147 @@
+cimport cython
+
+cimport numpy as np
+import numpy as np
+from numpy cimport intp_t, ndarray
+
+
+cdef inline void heap_push(double[:] keys, intp_t[:] values, Py_ssize_t size,
+                           double key, intp_t value):
+    cdef Py_ssize_t pos = size, parent
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if keys[parent] <= key:
+            break
+        keys[pos] = keys[parent]
+        values[pos] = values[parent]
+        pos = parent
+    keys[pos] = key
+    values[pos] = value
+
+
+cdef inline void heap_pop(double[:] keys, intp_t[:] values, Py_ssize_t size):
+    # size is the size *after* the pop, ie the index of the last element
+    cdef double key = keys[size]
+    cdef intp_t value = values[size]
+    cdef Py_ssize_t pos = 0, child
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and keys[child + 1] < keys[child]:
+            child += 1
+        if key <= keys[child]:
+            break
+        keys[pos] = keys[child]
+        values[pos] = values[child]
+        pos = child
+    keys[pos] = key
+    values[pos] = value
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def sparse_assignment(ndarray[intp_t] row_order, ndarray[intp_t] offsets,
+                      ndarray[intp_t] cols, ndarray[double] costs,
+                      Py_ssize_t num_cols):
+    """
+    compiled version of matching.py_sparse_assignment. See there for details.
+    """
+    cdef Py_ssize_t num_rows = len(offsets) - 1
+    cdef Py_ssize_t num_edges = len(cols)
+    # dummy columns (one per row) are stored after the real columns
+    cdef Py_ssize_t num_ext_cols = num_cols + num_rows
+    cdef double inf = np.inf
+    # an augmenting path adds at most min(num_rows, num_cols) pairs
+    cdef double max_cost = costs.max() if num_edges else 0.0
+    cdef double dummy_cost = max_cost * min(num_rows, num_cols) + 1.0
+    cdef ndarray[intp_t] col4row = np.full(num_rows, -1, dtype=np.intp)
+    cdef ndarray[intp_t] row4col = np.full(num_ext_cols, -1, dtype=np.intp)
+    cdef ndarray[double] u = np.zeros(num_rows)
+    cdef ndarray[double] v = np.zeros(num_ext_cols)
+    cdef ndarray[double] dist = np.full(num_ext_cols, inf)
+    cdef ndarray[intp_t] path = np.full(num_ext_cols, -1, dtype=np.intp)
+    cdef ndarray[np.uint8_t, cast=True] done = np.zeros(num_ext_cols,
+                                                        dtype=bool)
+    cdef ndarray[intp_t] touched = np.empty(num_ext_cols, dtype=np.intp)
+    cdef ndarray[intp_t] visited_rows = np.empty(num_rows, dtype=np.intp)
+    cdef double[:] heap_keys = np.empty(num_edges + num_rows + 1)
+    cdef intp_t[:] heap_values = np.empty(num_edges + num_rows + 1,
+                                          dtype=np.intp)
+    cdef Py_ssize_t k, e, num_touched, num_visited, heap_size, t
+    cdef intp_t cur_row, i, j, tmp
+    cdef double min_val, r
+
+    for k in range(len(row_order)):
+        cur_row = row_order[k]
+        i = cur_row
+        min_val = 0
+        num_touched = 0
+        num_visited = 0
+        heap_size = 0
+        while True:
+            visited_rows[num_visited] = i
+            num_visited += 1
+            for e in range(offsets[i], offsets[i + 1]):
+                j = cols[e]
+                if done[j]:
+                    continue
+                r = min_val + costs[e] - u[i] - v[j]
+                if r < dist[j]:
+                    if dist[j] == inf:
+                        touched[num_touched] = j
+                        num_touched += 1
+                    dist[j] = r
+                    path[j] = i
+                    heap_push(heap_keys, heap_values, heap_size, r, j)
+                    heap_size += 1
+            # only row i can reach its dummy column, so the dummy column of a
+            # visited row is always free
+            j = num_cols + i
+            touched[num_touched] = j
+            num_touched += 1
+            dist[j] = min_val + dummy_cost - u[i] - v[j]
+            path[j] = i
+            heap_push(heap_keys, heap_values, heap_size, dist[j], j)
+            heap_size += 1
+
+            # find the closest column not reached yet (skipping stale entries)
+            while True:
+                r = heap_keys[0]
+                j = heap_values[0]
+                heap_size -= 1
+                heap_pop(heap_keys, heap_values, heap_size)
+                if not done[j] and r <= dist[j]:
+                    break
+            min_val = dist[j]
+            done[j] = 1
+            if row4col[j] == -1:
+                break
+            i = row4col[j]
+
+        # update dual variables
+        u[cur_row] += min_val
+        for t in range(1, num_visited):
+            i = visited_rows[t]
+            u[i] += min_val - dist[col4row[i]]
+        for t in range(num_touched):
+            tmp = touched[t]
+            if done[tmp]:
+                v[tmp] -= min_val - dist[tmp]
+
+        # augment the matching along the path
+        while True:
+            i = path[j]
+            row4col[j] = i
+            tmp = col4row[i]
+            col4row[i] = j
+            j = tmp
+            if i == cur_row:
+                break
+
+        for t in range(num_touched):
+            j = touched[t]
+            dist[j] = inf
+            done[j] = 0
+    col4row[col4row >= num_cols] = -1
+    return col4row
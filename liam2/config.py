@@ -17,3 +17,7 @@ log_level = "functions"
 autodump = None
 autodump_file = None
 autodiff = None
+# record a profile of the time spent in each process/function/expression
+profile = False
+# record the memory used by each process
+track_memory = False
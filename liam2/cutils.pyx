@@ -1,6 +1,8 @@
+cimport cython
+
 cimport numpy as np
 import numpy as np
-from numpy cimport ndarray
+from numpy cimport intp_t, ndarray
 
 
 def fromiter(iterable, dtype, Py_ssize_t count=-1):
@@ -21,3 +23,30 @@ def fromiter(iterable, dtype, Py_ssize_t count=-1):
         if i < count:
             raise ValueError("iterator too short")
         return buf
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def choice_indices(ndarray[double, ndim=2] cdf, ndarray[double] u):
+    """
+    compiled version of exprrandom.choice_indices. See there for details.
+    """
+    cdef Py_ssize_t num_outcomes = cdf.shape[0]
+    cdef Py_ssize_t n = cdf.shape[1]
+    cdef ndarray[intp_t] indices = np.empty(n, dtype=np.intp)
+    cdef Py_ssize_t j, lo, hi, mid
+    cdef double value
+
+    for j in range(n):
+        value = u[j]
+        # binary search in the thresholds (except the last one)
+        lo = 0
+        hi = num_outcomes - 1
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if value < cdf[mid, j]:
+                hi = mid
+            else:
+                lo = mid + 1
+        indices[j] = lo
+    return indices
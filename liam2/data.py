@@ -10,7 +10,8 @@ import config
 from expr import (normalize_type, get_default_value, get_default_array,
                   get_default_vector, gettype)
 from utils import loop_wh_progress, time2str, safe_put, LabeledArray, timed
-from importer import load_def, stream_to_array, array_to_disk_array
+from importer import (load_def, consume_table, chunks_to_array,
+                      array_to_disk_array)
 
 MB = 2 ** 20
 
@@ -714,8 +715,8 @@ def load_path_globals(globals_def):
             continue
         kind, info = load_def(localdir, name, global_def, [])
         if kind == 'table':
-            fields, numlines, datastream, csvfile = info
-            array = stream_to_array(fields, datastream, numlines)
+            array = consume_table(info, lambda fields, numlines, chunks:
+                                  chunks_to_array(fields, chunks))
         else:
             assert kind == 'ndarray'
             array = info
@@ -723,8 +724,15 @@ def load_path_globals(globals_def):
     return globals_data
 
 
-def index_tables(globals_def, entities, fpath):
+def index_tables(globals_def, entities, fpath, indexes=None):
+    """
+    indexes is an optional dictionary {entity_name: (rows_per_period,
+    id_to_rownum_per_period)} of the tables already indexed. It is updated
+    inplace with the tables indexed by this function.
+    """
     print("reading data from %s ..." % fpath)
+    if indexes is None:
+        indexes = {}
 
     input_file = tables.open_file(fpath)
     try:
@@ -780,8 +788,11 @@ def index_tables(globals_def, entities, fpath):
             table = getattr(input_entities, ent_name)
             assert_valid_type(table, list(entity.fields.in_input.name_types))
 
-            rows_per_period, id_to_rownum_per_period = \
-                timed(index_table, table)
+            if ent_name in indexes:
+                print("done (already indexed).")
+            else:
+                indexes[ent_name] = timed(index_table, table)
+            rows_per_period, id_to_rownum_per_period = indexes[ent_name]
             indexed_table = IndexedTable(table, rows_per_period,
                                          id_to_rownum_per_period)
             entities_tables[ent_name] = indexed_table
@@ -811,9 +822,13 @@ class H5Source(DataSource):
     def __init__(self, input_path):
         self.h5in = None
         self.input_path = input_path
+        # the indexes are kept between loads (e.g. for several runs of the
+        # same simulation). They are never modified once computed.
+        self.indexes = {}
 
     def load(self, globals_def, entities):
-        h5file, dataset = index_tables(globals_def, entities, self.input_path)
+        h5file, dataset = index_tables(globals_def, entities, self.input_path,
+                                       self.indexes)
         entities_tables = dataset['entities']
         for ent_name, entity in entities.iteritems():
             table = entities_tables[ent_name]
@@ -913,6 +928,51 @@ class H5Sink(DataSink):
             raise
         self.h5out = output_file
 
+    def reopen(self, entities, input_dataset, period, output_rows):
+        """
+        reopens the output of an interrupted simulation in order to continue
+        it after period. Any data stored for later periods is discarded.
+        output_rows is a dictionary {entity_name: output_rows} with the
+        output_rows of each entity at the end of period.
+        """
+        from entities import DiskBackedArray
+
+        output_file = tables.open_file(self.output_path, mode="a")
+        try:
+            entities_tables = input_dataset['entities']
+            for ent_name, entity in entities.iteritems():
+                index_node = output_file.get_node("/indexes", ent_name)
+                entity.output_index_node = index_node
+                if not entity.fields.in_output:
+                    continue
+
+                ent_output_rows = output_rows[ent_name]
+                output_table = output_file.get_node("/entities", ent_name)
+                nrows = max([stop for _, stop in ent_output_rows.itervalues()]
+                            + [0])
+                output_table.truncate(nrows)
+
+                table = entities_tables.get(ent_name)
+                if table is not None:
+                    output_index = table.id2rownum_per_period.copy()
+                else:
+                    output_index = {}
+                for index_array in list(index_node):
+                    index_period = int(index_array.name[1:])
+                    if index_period > period:
+                        index_array.remove()
+                    else:
+                        output_index[index_period] = \
+                            DiskBackedArray(index_array)
+
+                entity.output_index = output_index
+                entity.output_rows = ent_output_rows
+                entity.table = output_table
+        except:
+            output_file.close()
+            raise
+        self.h5out = output_file
+
     def close(self):
         if self.h5out is not None:
             self.h5out.close()
@@ -3,10 +3,10 @@ from __future__ import division, print_function
 
 import inspect
 import types
-from collections import Counter
 
 import numpy as np
 
+import profiler
 from cache import Cache
 from context import EntityContext, EvaluationContext
 from utils import (LabeledArray, ExplainTypeError, safe_take, IrregularNDArray,
@@ -42,7 +42,6 @@ except ImportError:
         return eval(expr, complete_globals, {})
 
 expr_cache = Cache()
-timings = Counter()
 
 type_to_idx = {
     bool: 0, np.bool_: 0,
@@ -214,19 +213,11 @@ def expr_eval(expr, context):
                 if var.name not in globals_names and var not in context:
                     raise Exception("variable '%s' is unknown (it is either "
                                     "not defined or not computed yet)" % var)
+            if profiler.current is not None and \
+                    isinstance(expr, EvaluableExpression):
+                return profiler.current.call(profile_label(expr),
+                                             expr.evaluate, context)
             return expr.evaluate(context)
-
-            # there are several flaws with this approach:
-            # 1) I don't get action times (csv et al)
-            # 2) these are cumulative times (they include child expr/processes)
-            #    we might want to store the timings in a tree (based on call
-            #    stack depth???) so that I could rebuild both cumulative and
-            #    "real" timings.
-            # 3) the sum of timings is wrong since children/nested expr times
-            #    count both for themselves and for all their parents
-    #        time, res = gettime(expr.evaluate, context)
-    #        timings[expr.__class__.__name__] += time
-    #        return res
         elif isinstance(expr, list):
             return [expr_eval(e, context) for e in expr]
         elif isinstance(expr, tuple):
@@ -359,7 +350,11 @@ class Expr(object):
 
         s = simple_expr.as_string()
         constants = {'nan': float('nan'), 'inf': float('inf')}
-        res = evaluate(s, local_ctx, constants, truediv='auto')
+        if profiler.current is not None:
+            res = profiler.current.call('numexpr', evaluate, s, local_ctx,
+                                        constants, truediv='auto')
+        else:
+            res = evaluate(s, local_ctx, constants, truediv='auto')
         if isinstance(res, np.ndarray) and not res.shape:
             res = np.asscalar(res)
         if labels is not None:
@@ -524,7 +519,30 @@ class EvaluableExpression(Expr):
         raise NotImplementedError()
 
     def as_simple_expr(self, context):
-        return self.add_tmp_var(context, self.evaluate(context))
+        if profiler.current is not None:
+            result = profiler.current.call(profile_label(self), self.evaluate,
+                                           context)
+        else:
+            result = self.evaluate(context)
+        return self.add_tmp_var(context, result)
+
+
+def profile_label(expr):
+    """
+    returns the label of an (evaluable) expression in simulation profiles
+    """
+    if isinstance(expr, MethodCall):
+        return '%s.%s()' % (expr.entity.name, expr.name)
+    # we cannot use getattr on the expression itself because some expressions
+    # (e.g. ExprAttribute) return a new expression for any attribute
+    cls = expr.__class__
+    funcname = getattr(cls, 'funcname', None)
+    if funcname is None:
+        return cls.__name__
+    if hasattr(cls, 'link'):
+        # noinspection PyProtectedMember
+        return '%s.%s()' % (expr.link._name, funcname)
+    return funcname + '()'
 
 
 def non_scalar_array(a):
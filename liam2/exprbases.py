@@ -7,8 +7,8 @@ import numpy as np
 
 import config
 from context import context_length
-from expr import (FunctionExpr, not_hashable,
-                  getdtype, as_simple_expr, as_string,
+from expr import (Expr, Variable, UnaryOp, BinaryOp, FunctionExpr,
+                  not_hashable, getdtype, as_simple_expr, as_string,
                   get_default_value, ispresent, LogicalOp, AbstractFunction,
                   always, FillArgSpecMeta)
 from utils import classproperty, argspec, split_signature
@@ -263,6 +263,17 @@ class NumexprFunction(AbstractFunction):
         return '%s(%s)' % (self.funcname, self.format_args_str(args, kwargs))
 
 
+def rowwise(expr):
+    """
+    returns whether expr only contains element-wise operations, so that
+    evaluating it on a subset of the rows gives the same result as evaluating
+    it on all rows then taking the subset.
+    """
+    return all(isinstance(node, (Variable, UnaryOp, BinaryOp,
+                                 NumexprFunction))
+               for node in expr.traverse() if isinstance(node, Expr))
+
+
 class TableExpression(FunctionExpr):
     pass
 
@@ -4,11 +4,22 @@ from __future__ import division, print_function
 import numpy as np
 
 import config
-from expr import firstarg_dtype, ComparisonOp, Variable, expr_eval
+from expr import firstarg_dtype, expr_eval
 from exprbases import NumpyRandom, make_np_class, make_np_classes
-from exprmisc import Where
 from utils import argspec
 
+try:
+    from cutils import choice_indices
+except ImportError:
+    def choice_indices(cdf, u):
+        """
+        returns, for each individual j, the first index i for which
+        u[j] < cdf[i, j] (or the last index if there is none). cdf must be
+        non-decreasing along its first axis.
+        """
+        # the number of thresholds (except the last one) which are <= u
+        return (cdf[:-1] <= u).sum(axis=0)
+
 
 def make_random(docstring, dtypefunc):
     return make_np_class(NumpyRandom, docstring, dtypefunc)
@@ -39,15 +50,9 @@ class Choice(NumpyRandom):
             assert all(len(px) == size for px in p)
             assert len(a) >= 2
 
-            # I have not found a way to do this without an explicit loop as
-            # np.digitize only supports a 1d array for bins. What we do is
-            # worse than a linear "search" since we always evaluate all
-            # possibilities (there is no shortcut when the value is found).
-            # It might be faster to rewrite this using numba + np.digitize
-            # for each individual (assuming it has a low setup overhead).
-            # if isinstance(p, list) and any(isinstance(px, la.LArray) for px in p):
-            #     p = [np.asarray(px) for px in p]
             ap = np.asarray(p)
+            if np.any(ap < 0):
+                raise ValueError("probabilities are not non-negative")
             cdf = ap.cumsum(axis=0)
 
             # copied & adapted from numpy/random/mtrand/mtrand.pyx
@@ -60,22 +65,18 @@ class Choice(NumpyRandom):
 
             cdf /= cdf[-1]
 
-            # the goal is to build something like:
-            # if(u < proba1, outcome1,
-            #    if(u < proba2, outcome2,
-            #       outcome3))
-
-            data = {'u': np.random.uniform(size=size)}
-            expr = a[-1]
-            # iterate in reverse and skip last
-            pairs = zip(cdf[-2::-1], a[-2::-1])
-            for i, (proba_x, outcome_x) in enumerate(pairs):
-                data['p%d' % i] = proba_x
-                expr = Where(ComparisonOp('<', Variable(None, 'u'),
-                                          Variable(None, 'p%d' % i)),
-                             outcome_x, expr)
-            local_ctx = context.clone(fresh_data=True, entity_data=data)
-            return expr.evaluate(local_ctx)
+            # the chosen outcome is the first one whose cumulative
+            # probability is > u (a binary search for each individual when
+            # the compiled version is available)
+            u = np.random.uniform(size=size)
+            indices = choice_indices(cdf.astype(np.float64, copy=False), u)
+            if all(np.isscalar(outcome) for outcome in a):
+                return np.asarray(a)[indices]
+            # some outcomes are different for each individual
+            outcomes = np.empty((len(a), size), dtype=np.result_type(*a))
+            for i, outcome in enumerate(a):
+                outcomes[i] = outcome
+            return outcomes[indices, np.arange(size)]
         else:
             return NumpyRandom.compute(self, context, a, size, replace, p)
 
@@ -4,18 +4,111 @@ from __future__ import print_function
 import numpy as np
 
 from context import context_length
-from expr import expr_eval, collect_variables, not_hashable
-from exprbases import TableExpression
+from expr import Expr, expr_eval, collect_variables, not_hashable, ispresent
+from exprbases import TableExpression, rowwise
 from utils import expand, prod, LabeledArray
-from aggregates import Count
-from partition import partition_nd
+from aggregates import Count, Sum, Average, Min, Max, Std
+from partition import group_labels, split_by_label, observed_group_labels
+
+
+def aggregate_by_label(expr, context, labels, len_pvalues):
+    """
+    computes expr for each group and for the totals of each row and column of
+    groups, in a single pass over the data instead of evaluating expr on a
+    subset of the context for each group (and total).
+
+    labels contains the (flat) group of each individual of context (-1 for
+    individuals which are not in any group). This only works for count(),
+    and sum(), avg(), min(), max() and std() of an element-wise expression
+    (without any other argument). It returns None for other expressions,
+    or when the result could differ from evaluating expr on each group
+    (e.g. min() of an empty group).
+    """
+    func = type(expr)
+    if func not in (Count, Sum, Average, Min, Max, Std):
+        return None
+    args, kwargs = expr._original_args
+    if kwargs or len(args) != (0 if func is Count else 1):
+        return None
+
+    width = len_pvalues[-1]
+    num_groups = prod(len_pvalues)
+    height = num_groups // width
+    in_group = labels != -1
+    if func is Count:
+        values = None
+    else:
+        arg = args[0]
+        if not isinstance(arg, Expr) or not rowwise(arg):
+            return None
+        values = np.asarray(expr_eval(arg, context))
+        values = expand(values, context_length(context))
+        if values.ndim != 1 or values.dtype.kind not in 'bif':
+            return None
+        if values.dtype.kind == 'b' and func not in (Min, Max):
+            values = values.astype(int)
+        present = ispresent(values)
+        if func in (Sum, Average, Min, Max) and values.dtype.kind == 'f':
+            # nan functions (like nansum) are used for floats, so infinite
+            # values are taken into account by those
+            in_group &= ~np.isnan(values)
+        else:
+            in_group &= present
+        # avg() also counts values which are present (finite)
+        if func is Average:
+            present = present[in_group]
+        values = values[in_group]
+    labels = labels[in_group]
+
+    # the group, row and column of each value
+    label_sets = [(labels, num_groups),
+                  (labels // width, height),
+                  (labels % width, width),
+                  (np.zeros(len(labels), dtype=int), 1)]
+    counts = [np.bincount(ids, minlength=n) for ids, n in label_sets]
+
+    if func is Count:
+        results = counts
+    elif func in (Min, Max):
+        # min() and max() of an empty group fail (or are nan)
+        if not counts[0].all():
+            return None
+        ufunc = np.minimum if func is Min else np.maximum
+        order = labels.argsort(kind='mergesort')
+        starts = counts[0].cumsum() - counts[0]
+        data = ufunc.reduceat(values[order], starts)
+        cells = data.reshape(height, width)
+        results = [data, ufunc.reduce(cells, axis=1),
+                   ufunc.reduce(cells, axis=0), ufunc.reduce(data, keepdims=True)]
+    else:
+        isint = values.dtype.kind == 'i'
+        # bincount sums in float64, so integer sums are only exact up to 2 ** 53
+        if isint and np.abs(values).sum(dtype=float) >= 2 ** 53:
+            return None
+        sums = [np.bincount(ids, values, minlength=n) for ids, n in label_sets]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if func is Sum:
+                results = [s.astype(int) if isint else s for s in sums]
+            elif func is Average:
+                results = []
+                for s, (ids, n) in zip(sums, label_sets):
+                    c = np.bincount(ids[present], minlength=n)
+                    results.append(np.where(c > 0, s / c, np.nan))
+            else:
+                results = []
+                for s, c, (ids, n) in zip(sums, counts, label_sets):
+                    dev = values - (s / c)[ids]
+                    results.append(np.sqrt(np.bincount(ids, dev * dev,
+                                                       minlength=n) / c))
+    data, row_totals, col_totals, total = results
+    return data, list(row_totals), list(col_totals) + list(total)
 
 
 class GroupBy(TableExpression):
     funcname = 'groupby'
     no_eval = ('expressions', 'expr')
     kwonlyargs = {'expr': None, 'filter': None, 'percent': False,
-                  'pvalues': None}
+                  'pvalues': None, 'sparse': False}
 
     # noinspection PyNoneFunctionAssignment
     def compute(self, context, *expressions, **kwargs):
@@ -41,6 +134,10 @@ class GroupBy(TableExpression):
         filter_value = kwargs.pop('filter', None)
         percent = kwargs.pop('percent', False)
         possible_values = kwargs.pop('pvalues', None)
+        sparse = kwargs.pop('sparse', False)
+        if sparse and possible_values is not None:
+            raise ValueError("groupby() cannot use both pvalues and "
+                             "sparse=True")
 
         expr_vars = [v.name for v in collect_variables(expr)]
         labels = [str(e) for e in expressions]
@@ -56,61 +153,39 @@ class GroupBy(TableExpression):
             filtered_columns = columns
             filtered_context = context
 
-        if possible_values is None:
-            possible_values = [np.unique(col) for col in filtered_columns]
-
-        # We pre-filtered columns instead of passing the filter to partition_nd
-        # because it is a bit faster this way. The indices are still correct,
-        # because we use them on a filtered_context.
-        groups = partition_nd(filtered_columns, True, possible_values)
-        if not groups:
-            return LabeledArray([], labels, possible_values)
-
-        # evaluate the expression on each group
-        # we use not_hashable to avoid storing the subset in the cache
-        contexts = [filtered_context.subset(indices, expr_vars, not_hashable)
-                    for indices in groups]
-        data = [expr_eval(expr, c) for c in contexts]
-
-        # TODO: use group_indices_nd directly to avoid using np.unique
-        # this is twice as fast (unique is very slow) but breaks because
-        # the rest of the code assumes all combinations are present
-#        if self.filter is not None:
-#            filter_value = expr_eval(self.filter, context)
-#        else:
-#            filter_value = True
-#
-#        d = group_indices_nd(columns, filter_value)
-#        pvalues = sorted(d.keys())
-#        ndim = len(columns)
-#        possible_values = [[pv[i] for pv in pvalues]
-#                           for i in range(ndim)]
-#        groups = [d[k] for k in pvalues]
-
-        # groups is a (flat) list of list.
-        # the first variable is the outer-most "loop",
-        # the last one the inner most.
-
-        # add total for each row
+        # We pre-filtered columns instead of passing the filter to
+        # group_labels because it is a bit faster this way. The labels are
+        # still correct, because we use them on a filtered_context.
+        if sparse:
+            # only the combinations of values (of all expressions but the
+            # last) which are present are used, as rows of a 2d table whose
+            # first axis is labelled by those combinations
+            row_keys, last_values, group_label = \
+                observed_group_labels(filtered_columns)
+            if len(labels) > 1:
+                labels = [tuple(labels[:-1]), labels[-1]]
+                possible_values = [row_keys, last_values]
+            else:
+                possible_values = [last_values]
+        else:
+            if possible_values is None:
+                possible_values = [np.unique(col) for col in filtered_columns]
+            group_label = group_labels(filtered_columns, True,
+                                       possible_values)
         len_pvalues = [len(vals) for vals in possible_values]
-        width = len_pvalues[-1]
-        height = prod(len_pvalues[:-1])
-
-        rows_indices = [np.concatenate([groups[y * width + x]
-                                        for x in range(width)])
-                        for y in range(height)]
-        cols_indices = [np.concatenate([groups[y * width + x]
-                                        for y in range(height)])
-                        for x in range(width)]
-        cols_indices.append(np.concatenate(cols_indices))
+        if not prod(len_pvalues):
+            return LabeledArray([], labels, possible_values)
 
-        # evaluate the expression on each "combined" group (ie compute totals)
-        row_ctxs = [filtered_context.subset(indices, expr_vars, not_hashable)
-                    for indices in rows_indices]
-        row_totals = [expr_eval(expr, ctx) for ctx in row_ctxs]
-        col_ctxs = [filtered_context.subset(indices, expr_vars, not_hashable)
-                    for indices in cols_indices]
-        col_totals = [expr_eval(expr, ctx) for ctx in col_ctxs]
+        # the usual aggregates are computed for all groups (and totals) at
+        # once
+        result = aggregate_by_label(expr, filtered_context, group_label,
+                                    len_pvalues)
+        if result is not None:
+            data, row_totals, col_totals = result
+        else:
+            data, row_totals, col_totals = \
+                self.eval_by_group(expr, filtered_context, expr_vars,
+                                   group_label, len_pvalues)
 
         if percent:
             # convert to np.float64 to get +-inf if total_value is int(0)
@@ -154,6 +229,45 @@ class GroupBy(TableExpression):
         return LabeledArray(data, labels, possible_values,
                             row_totals, col_totals)
 
+    @staticmethod
+    def eval_by_group(expr, context, expr_vars, group_label, len_pvalues):
+        """
+        evaluates expr on the subset of context corresponding to each group
+        and to the totals of each row and column of groups.
+        """
+        groups = split_by_label(group_label, prod(len_pvalues))
+
+        # evaluate the expression on each group
+        # we use not_hashable to avoid storing the subset in the cache
+        contexts = [context.subset(indices, expr_vars, not_hashable)
+                    for indices in groups]
+        data = [expr_eval(expr, c) for c in contexts]
+
+        # groups is a (flat) list of list.
+        # the first variable is the outer-most "loop",
+        # the last one the inner most.
+
+        # add total for each row
+        width = len_pvalues[-1]
+        height = prod(len_pvalues[:-1])
+
+        rows_indices = [np.concatenate([groups[y * width + x]
+                                        for x in range(width)])
+                        for y in range(height)]
+        cols_indices = [np.concatenate([groups[y * width + x]
+                                        for y in range(height)])
+                        for x in range(width)]
+        cols_indices.append(np.concatenate(cols_indices))
+
+        # evaluate the expression on each "combined" group (ie compute totals)
+        row_ctxs = [context.subset(indices, expr_vars, not_hashable)
+                    for indices in rows_indices]
+        row_totals = [expr_eval(expr, ctx) for ctx in row_ctxs]
+        col_ctxs = [context.subset(indices, expr_vars, not_hashable)
+                    for indices in cols_indices]
+        col_totals = [expr_eval(expr, ctx) for ctx in col_ctxs]
+        return data, row_totals, col_totals
+
 
 functions = {
     'groupby': GroupBy
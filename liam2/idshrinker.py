@@ -57,6 +57,33 @@ def map_file(input_file, output_file, entities_map):
             copy_table(table, output_entities)
 
 
+def parse_toshrink(spec):
+    """
+    parses a "entityname1:[entityname2.]linkfield1,linkfield2;entityname2:..."
+    string into a {entity_name: [fields]} dictionary
+    """
+    entities = [entity.split(':') for entity in spec.split(';')]
+    return {ent_name: fields.split(',') for ent_name, fields in entities}
+
+
+def link_targets(toshrink):
+    """
+    returns the link fields of a {entity_name: [fields]} dictionary (where
+    fields contain ids of entity_name and are either in entity_name itself or
+    given as "source_entity.field") as a
+    {source_entity_name: {field_name: target_entity_name}} dictionary
+    """
+    links = {}
+    for ent_name, fields in toshrink.iteritems():
+        for fname in fields:
+            if '.' in fname:
+                source_ent, fname = fname.split('.')
+            else:
+                source_ent = ent_name
+            links.setdefault(source_ent, {})[fname] = ent_name
+    return links
+
+
 def shrinkids(input_path, output_path, toshrink):
     input_file = tables.open_file(input_path)
     output_file = tables.open_file(output_path, mode="w")
@@ -71,14 +98,9 @@ def shrinkids(input_path, output_path, toshrink):
 
     fields_to_change = {ent_name: {'id': idmaps[ent_name]}
                         for ent_name in toshrink}
-    for ent_name, fields in toshrink.iteritems():
-        # fields_to_change[ent_name] = d = []
-        for fname in fields:
-            if '.' in fname:
-                source_ent, fname = fname.split('.')
-            else:
-                source_ent = ent_name
-            fields_to_change[source_ent][fname] = idmaps[ent_name]
+    for source_ent, fields in link_targets(toshrink).iteritems():
+        for fname, target_ent in fields.iteritems():
+            fields_to_change[source_ent][fname] = idmaps[target_ent]
     print(" * shrinking ids")
     map_file(input_file, output_file, fields_to_change)
     input_file.close()
@@ -110,7 +132,6 @@ if __name__ == '__main__':
               "linkfield2;entityname2:...")
         sys.exit()
 
-    entities = [entity.split(':') for entity in args[3].split(';')]
-    toshrink = {ent_name: fields.split(',') for ent_name, fields in entities}
+    toshrink = parse_toshrink(args[3])
     timed(shrinkids, args[1], 'shrinkedids.h5', toshrink)
     timed(fixlinks, 'shrinkedids.h5', args[2], toshrink)
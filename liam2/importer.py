@@ -2,9 +2,13 @@
 from __future__ import print_function
 
 import csv
+import multiprocessing
 import os.path
 import re
-from itertools import islice, chain
+import traceback
+from itertools import islice, chain, imap
+from operator import itemgetter
+from Queue import Empty
 
 import numpy as np
 try:
@@ -24,6 +28,13 @@ from utils import (validate_dict, merge_dicts, merge_items, invert_dict,
 
 MB = 2.0 ** 20
 
+# number of lines used to detect the type of the columns of csv files
+TYPE_DETECTION_LINES = 10000
+
+# number of seconds to wait for a message from the worker processes of a
+# parallel import before checking that they are still alive
+IMPORT_POLL_INTERVAL = 1
+
 
 def to_int(v):
     if not v or v == '--':
@@ -73,6 +84,66 @@ def convert(iterable, fields, positions=None):
                         for func, pos in zip(funcs, positions))
 
 
+def convert_column(values, celltype):
+    """
+    converts a sequence of strings to an array of celltype at once, using the
+    same rules than the converters above
+
+    >>> convert_column(('1', '', '--', '3'), int)
+    array([ 1, -1, -1,  3])
+    >>> convert_column(('1.5', '', '2'), float)
+    array([1.5, nan, 2. ])
+    >>> convert_column(('1', 'True', '0', 'false', ''), bool)
+    array([ True,  True, False, False, False])
+    """
+    count = len(values)
+    if celltype is str:
+        return np.array(values, dtype=str)
+    elif celltype is bool:
+        # columns usually contain very few distinct values
+        func = {v: to_bool(v) for v in set(values)}.__getitem__
+    elif celltype is int:
+        res = fast_int_column(values)
+        if res is not None:
+            return res
+        func = to_int
+    else:
+        # the builtin float is much faster than to_float but does not
+        # support missing values
+        try:
+            return np.fromiter(imap(float, values), dtype=float, count=count)
+        except ValueError:
+            func = to_float
+    return np.fromiter(imap(func, values), dtype=celltype, count=count)
+
+
+def fast_int_column(values):
+    """
+    converts a sequence of strings to an array of ints using float, which is
+    about twice faster than int. Returns None if any value is not an integer
+    (including missing values).
+
+    >>> fast_int_column(('1', '-2', '+3'))
+    array([ 1, -2,  3])
+    >>> fast_int_column(('1', '2.0')) is None
+    True
+    """
+    # int() refuses decimal points and exponents while float() does not
+    joined = ''.join(values)
+    if '.' in joined or 'e' in joined or 'E' in joined:
+        return None
+    try:
+        floats = np.fromiter(imap(float, values), dtype=float,
+                             count=len(values))
+    except ValueError:
+        return None
+    # nan, inf and integers which are not exactly representable as floats
+    # need to go through int()
+    if len(floats) and not (np.abs(floats) < 2 ** 53).all():
+        return None
+    return floats.astype(int)
+
+
 def convert_2darray(iterable, celltype):
     """homogeneous 2d array"""
 
@@ -118,13 +189,11 @@ def detect_column_type(iterable):
     return [None, bool, int, float, str][coltype]
 
 
-# it is possible to express detect_column_types in terms of
-# split_columns_as_iterators and detect_column_type, but it is both more
-# complicated and slower, so let's keep this seemingly duplicate code here.
-def detect_column_types(iterable):
-    iterator = iter(iterable)
-    header = iterator.next()
-    numcolumns = len(header)
+def detect_column_codes(iterator, numcolumns):
+    """
+    returns the type code (0: empty, 1: bool, 2: int, 3: float, 4: str) of
+    each column of the rows of iterator
+    """
     coltypes = [0] * numcolumns
     type2code = {None: 0, bool: 1, int: 2, float: 3, str: 4}
     for row in iterator:
@@ -133,6 +202,16 @@ def detect_column_types(iterable):
         for column, value in enumerate(row):
             coltypes[column] = max(coltypes[column],
                                    type2code[guess_type(value)])
+    return coltypes
+
+
+# it is possible to express detect_column_types in terms of
+# split_columns_as_iterators and detect_column_type, but it is both more
+# complicated and slower, so let's keep this seemingly duplicate code here.
+def detect_column_types(iterable):
+    iterator = iter(iterable)
+    header = iterator.next()
+    coltypes = detect_column_codes(iterator, len(header))
     for i, colname in enumerate(header):
         coltype = coltypes[i]
         if coltype == 0:
@@ -161,10 +240,19 @@ def eval_with_template(s, template_context):
     return eval(s.format(**template_context), {'__builtins__': None})
 
 
+class TypeDetectionError(Exception):
+    """
+    raised when a value does not match the type detected (using the first
+    lines of a file) for its column
+    """
+    pass
+
+
 class CSV(object):
     eval_re = re.compile('eval\((.*)\)')
 
-    def __init__(self, fpath, newnames=None, delimiter=None, transpose=False):
+    def __init__(self, fpath, newnames=None, delimiter=None, transpose=False,
+                 buffersize=10 * 2 ** 20):
         f = open(fpath, "rb")
         if delimiter is None:
             dialect = csv.Sniffer().sniff(f.read(1024))
@@ -192,7 +280,13 @@ class CSV(object):
         self.transposed = transposed
         self.f = f
         self.data_stream = data_stream
+        self.buffersize = buffersize
         self._fields = None
+        # whether the types of _fields were detected using only the first
+        # lines of the file and the positions of the columns which were empty
+        # in those lines
+        self._sampled = False
+        self._empty_columns = set()
         self._field_names = None
         self._numlines = None
 
@@ -227,14 +321,43 @@ class CSV(object):
     @property
     def fields(self):
         if self._fields is None:
-            self.rewind()
-            fields = detect_column_types(self.data_stream)
-            if self.newnames is not None:
-                fields = [(self.newnames.get(name, name), type_)
-                          for name, type_ in fields]
-            self._fields = fields
+            self.detect_fields(TYPE_DETECTION_LINES)
         return self._fields
 
+    def detect_fields(self, maxlines=None):
+        """
+        detects the type of each column using its first maxlines values (all
+        of them if maxlines is None). If the type detected for a column
+        turns out to be wrong for the rest of the file, read_chunks raises a
+        TypeDetectionError.
+        """
+        self.rewind()
+        header = self.next()
+        if maxlines is None:
+            sample = self.data_stream
+        else:
+            sample = list(islice(self.data_stream, maxlines))
+        codes = detect_column_codes(sample, len(header))
+        # if we read less lines than asked, we read the whole file
+        self._sampled = maxlines is not None and len(sample) == maxlines
+        self._empty_columns = set()
+        for i, colname in enumerate(header):
+            if codes[i] == 0:
+                if self._sampled:
+                    print("Warning: column %s is empty in the first %d "
+                          "lines, assuming it is float" % (colname, maxlines))
+                    self._empty_columns.add(i)
+                else:
+                    print("Warning: column %s is all empty, assuming it is "
+                          "float" % colname)
+                codes[i] = 3
+        num2type = [None, bool, int, float, str]
+        fields = [(name, num2type[code]) for name, code in zip(header, codes)]
+        if self.newnames is not None:
+            fields = [(self.newnames.get(name, name), type_)
+                      for name, type_ in fields]
+        self._fields = fields
+
     @property
     def numlines(self):
         if self._numlines is None:
@@ -264,14 +387,98 @@ class CSV(object):
         self.next()
         return convert(self.data_stream, fields, positions)
 
-    def as_array(self, fields=None):
+    def read_chunks(self, fields=None):
+        """
+        same as read but returns an iterator of arrays of (at most)
+        self.buffersize bytes. Each column of a chunk of lines is converted at
+        once.
+        """
+        print(" - reading", self.fpath)
         if fields is None:
             fields = self.fields
+            positions = range(len(fields))
+            check_types = self._sampled
+        else:
+            available = self.field_names
+            missing = set(name for name, _ in fields) - set(available)
+            if missing:
+                raise Exception("%s does not contain any field(s) named: %s"
+                                % (self.fpath, ", ".join(missing)))
+            positions = [available.index(name) for name, _ in fields]
+            check_types = False
+        self.rewind()
+        self.next()
+        dtype = np.dtype(fields)
+        chunk_lines = max(self.buffersize // dtype.itemsize, 1)
+        return self._chunks(fields, positions, dtype, chunk_lines, check_types)
 
+    def _chunks(self, fields, positions, dtype, chunk_lines, check_types):
+        rowlen = None
+        while True:
+            rows = list(islice(self.data_stream, chunk_lines))
+            if not rows:
+                break
+            if rowlen is None:
+                rowlen = len(rows[0])
+            if set(map(len, rows)) != {rowlen}:
+                row = next(row for row in rows if len(row) != rowlen)
+                raise Exception("invalid row length (%d != %d): %s"
+                                % (len(row), rowlen, row))
+            chunk = np.empty(len(rows), dtype=dtype)
+            for (name, type_), pos in zip(fields, positions):
+                values = map(itemgetter(pos), rows)
+                if check_types:
+                    self._check_type(values, pos, name, type_)
+                try:
+                    chunk[name] = convert_column(values, type_)
+                except ValueError:
+                    func = converters[type_]
+                    for value in values:
+                        try:
+                            func(value)
+                        except ValueError:
+                            msg = "invalid value for field '%s' (%s) in " \
+                                  "%s: '%s'" % (name, type_.__name__,
+                                                self.fpath, value)
+                            if check_types:
+                                raise TypeDetectionError(msg)
+                            raise Exception(msg)
+                    raise
+            yield chunk
+
+    def _check_type(self, values, pos, name, type_):
+        """
+        checks that values (the values of column pos) can have the type
+        detected (using the first lines of the file) for their column
+        """
+        if pos in self._empty_columns:
+            if any(value and value != '--' for value in values):
+                raise TypeDetectionError(
+                    "field '%s' in %s is not empty after its first %d lines"
+                    % (name, self.fpath, TYPE_DETECTION_LINES))
+        elif type_ is bool:
+            # to_bool does not fail for non-boolean values
+            invalid = set(values) - {'', '--', '0', '1'}
+            if any(v.lower() not in ('false', 'true') for v in invalid):
+                raise TypeDetectionError(
+                    "field '%s' in %s contains non-boolean values after its "
+                    "first %d lines" % (name, self.fpath,
+                                        TYPE_DETECTION_LINES))
+
+    def as_array(self, fields=None):
         # csv file is assumed to be in the correct order (ie by period then id)
-        datastream = self.read(fields)
-        return fromiter(datastream, dtype=np.dtype(fields),
-                        count=self.numlines)
+        try:
+            chunks = list(self.read_chunks(fields))
+        except TypeDetectionError as e:
+            print("Warning: %s, detecting column types using the whole file"
+                  % e)
+            self.detect_fields()
+            chunks = list(self.read_chunks(fields))
+        if fields is None:
+            fields = self.fields
+        if not chunks:
+            return np.empty(0, dtype=np.dtype(fields))
+        return np.concatenate(chunks)
 
 
 def complete_path(prefix, path):
@@ -311,19 +518,73 @@ def stream_to_array(fields, datastream, numlines=None, invert=()):
     return array
 
 
-def stream_to_table(h5file, node, name, fields, datastream, numlines=None,
-                    title=None, invert=(), buffersize=10 * 2 ** 20,
-                    compression=None):
+def chunks_to_array(fields, chunks, invert=()):
+    """
+    concatenates chunks (an iterable of arrays)
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return np.empty(0, dtype=np.dtype(fields))
+    array = np.concatenate(chunks)
+    for field in invert:
+        array[field] = ~array[field]
+    return array
+
+
+def chunks_to_table(h5file, node, name, fields, chunks, numlines=None,
+                    title=None, invert=(), compression=None):
+    """
+    stores chunks (an iterable of arrays) in a new table. If an error occurs
+    while reading the chunks, the table is removed.
+    """
+    msg, filters = compression_str2filter(compression)
+    print(" - storing %s..." % msg)
+    dtype = np.dtype(fields)
+    kwargs = {'expectedrows': numlines} if numlines else {}
+    table = h5file.create_table(node, name, dtype, title=title, filters=filters,
+                                **kwargs)
+    try:
+        for array in chunks:
+            for field in invert:
+                array[field] = ~array[field]
+            table.append(array)
+            table.flush()
+    except:
+        table.remove()
+        raise
+    return table
+
+
+def consume_table(info, func):
+    """
+    returns func(fields, numlines, chunks) for a table loaded by load_def. If
+    the types of its columns were detected using the first lines of its file
+    and turn out to be wrong, they are detected using the whole file and func
+    is called again.
+    """
+    fields, numlines, chunks, csvfile = info
+    try:
+        try:
+            return func(fields, numlines, chunks)
+        except TypeDetectionError as e:
+            print("Warning: %s, detecting column types using the whole file"
+                  % e)
+            csvfile.detect_fields()
+            return func(csvfile.fields, numlines, csvfile.read_chunks())
+    finally:
+        if csvfile is not None:
+            csvfile.close()
+
+
+def stream_to_chunks(fields, datastream, numlines=None,
+                     buffersize=10 * 2 ** 20):
     # make sure datastream is an iterator, not a list, otherwise it could
     # loop indefinitely as it will never be consumed.
     # Note that, contrary to what I thought, we shouldn't make a special case
     # for that as np.fromiter(islice(iter(l), max_rows)) is faster than
     # np.array(l[:max_rows])
     datastream = iter(datastream)
-    msg, filters = compression_str2filter(compression)
-    print(" - storing %s..." % msg)
     dtype = np.dtype(fields)
-    table = h5file.create_table(node, name, dtype, title=title, filters=filters)
     # buffered load
     max_buffer_rows = buffersize // dtype.itemsize
     while True:
@@ -340,13 +601,15 @@ def stream_to_table(h5file, node, name, fields, datastream, numlines=None,
             array = fromiter(dataslice, dtype=dtype)
             if not len(array):
                 break
+        yield array
 
-        for field in invert:
-            array[field] = ~array[field]
-        table.append(array)
-        table.flush()
 
-    return table
+def stream_to_table(h5file, node, name, fields, datastream, numlines=None,
+                    title=None, invert=(), buffersize=10 * 2 ** 20,
+                    compression=None):
+    chunks = stream_to_chunks(fields, datastream, numlines, buffersize)
+    return chunks_to_table(h5file, node, name, fields, chunks, numlines,
+                           title=title, invert=invert, compression=compression)
 
 
 def array_to_disk_array(node, name, array, title='', compression=None):
@@ -549,23 +812,14 @@ def load_ndarray(fpath, celltype=None):
     return LabeledArray(array.reshape(shape), header, possible_values)
 
 
-def load_def(localdir, ent_name, section_def, required_fields):
-    if 'type' in section_def and 'fields' in section_def:
-        raise Exception("invalid structure for '%s': "
-                        "type and fields sections are mutually exclusive"
-                        % ent_name)
-
-    if 'type' in section_def:
-        csv_filename = section_def.get('path', ent_name + ".csv")
-        csv_filepath = complete_path(localdir, csv_filename)
-        str_type = section_def['type']
-        if isinstance(str_type, basestring):
-            celltype = field_str_to_type(str_type, "array '%s'" % ent_name)
-        else:
-            assert isinstance(str_type, type)
-            celltype = str_type
-        return 'ndarray', load_ndarray(csv_filepath, celltype)
-
+def table_def(localdir, ent_name, section_def, required_fields):
+    """
+    returns (fields, files, to_interpolate) for the table defined by
+    section_def. fields is None if they must be detected. files is a list of
+    (path, csv_kwargs) tuples. to_interpolate is the list of fields to
+    interpolate between the files, or None if the table is made of a single
+    file (which can then be imported as a stream).
+    """
     fields_def = section_def.get('fields')
     if fields_def is not None:
         for fdef in fields_def:
@@ -597,22 +851,15 @@ def load_def(localdir, ent_name, section_def, required_fields):
         # we can simply return the stream as-is
         # FIXME: stream is not sorted
         # csv file is assumed to be in the correct order (ie by period then id)
-        csv_filename = section_def.get('path', ent_name + ".csv")
-        csv_filepath = complete_path(localdir, csv_filename)
-        csv_file = CSV(csv_filepath, newnames,
-                       delimiter=',', transpose=transpose)
-        stream = csv_file.read(fields)
-        if fields is None:
-            fields = csv_file.fields
         if interpolate_def is not None:
             raise Exception('interpolate is currently only supported with '
                             'multiple files')
-        return 'table', (fields, csv_file.numlines, stream, csv_file)
+        csv_filename = section_def.get('path', ent_name + ".csv")
+        csv_filepath = complete_path(localdir, csv_filename)
+        csv_kwargs = dict(newnames=newnames, delimiter=',',
+                          transpose=transpose)
+        return fields, [(csv_filepath, csv_kwargs)], None
     else:
-        # we have to load all files, merge them and return a stream out of that
-        print(" * computing number of rows...")
-
-        # 1) only load required fields
         default_args = dict(newnames=newnames, transpose=transpose)
         if isinstance(files_def, dict):
             files_items = files_def.items()
@@ -631,43 +878,12 @@ def load_def(localdir, ent_name, section_def, required_fields):
         # section_def.get('path')
         files = []
         for path, kwargs in files_items:
+            kwargs = kwargs.copy()
             kwargs['newnames'] = \
                 merge_dicts(invert_dict(kwargs.pop('oldnames', {})),
                             kwargs.get('newnames', {}))
-            f = CSV(complete_path(localdir, path),
-                    **merge_dicts(default_args, kwargs))
-            files.append(f)
-        id_periods = union1d(f.as_array(required_fields) for f in files)
-
-        print(" * reading files...")
-        # 2) load all fields
-        if fields is None:
-            target_fields = merge_items(*[f.fields for f in files])
-            fields_per_file = [None for _ in files]
-        else:
-            target_fields = fields
-            fields_per_file = [[(name, type_) for name, type_ in target_fields
-                                if name in f.field_names]
-                               for f in files]
-            total_fields = set.union(*[set(f.field_names) for f in files])
-            missing = set(name for name, _ in target_fields) - total_fields
-            if missing:
-                raise Exception("the following fields were not found in any "
-                                "file: %s" % ", ".join(missing))
-
-        total_lines = len(id_periods)
-
-        # allocate main array
-        target = get_default_array(total_lines, np.dtype(target_fields))
-        target['period'] = id_periods['period']
-        target['id'] = id_periods['id']
-
-        arrays = [f.as_array(fields_to_load)
-                  for f, fields_to_load in zip(files, fields_per_file)]
-
-        # close all files
-        for f in files:
-            f.close()
+            files.append((complete_path(localdir, path),
+                          merge_dicts(default_args, kwargs)))
 
         # FIXME: interpolation currently only interpolates missing data points,
         # not data points with their value equal the missing value
@@ -682,12 +898,352 @@ def load_def(localdir, ent_name, section_def, required_fields):
                               if v == 'previous_value']
         else:
             to_interpolate = []
+        return fields, files, to_interpolate
+
+
+def fields_per_file(fields, files):
+    """
+    returns the fields (among fields) to load from each of files (a list of
+    (path, csv_kwargs) tuples). If fields is None, all the fields of all files
+    are loaded (None is returned for each file).
+    """
+    if fields is None:
+        return [None for _ in files]
+    field_names = []
+    for path, kwargs in files:
+        f = CSV(path, **kwargs)
+        field_names.append(f.field_names)
+        f.close()
+    total_fields = set.union(*[set(names) for names in field_names])
+    missing = set(name for name, _ in fields) - total_fields
+    if missing:
+        raise Exception("the following fields were not found in any "
+                        "file: %s" % ", ".join(missing))
+    return [[(name, type_) for name, type_ in fields if name in names]
+            for names in field_names]
+
+
+def merge_arrays(fields, arrays, arrays_fields, paths, required_fields,
+                 to_interpolate):
+    """
+    merges the arrays loaded from the files (paths) of a table, filling the
+    missing values of the to_interpolate fields with their previous value.
+    arrays_fields are the fields of each array (they are only used if fields
+    is None). Returns (fields, array).
+    """
+    def required_columns(array, path):
+        missing = set(name for name, _ in required_fields) - \
+            set(array.dtype.names)
+        if missing:
+            raise Exception("%s does not contain any field(s) named: %s"
+                            % (path, ", ".join(missing)))
+        res = np.empty(len(array), dtype=np.dtype(required_fields))
+        for name, _ in required_fields:
+            res[name] = array[name]
+        return res
+
+    id_periods = union1d(required_columns(array, path)
+                         for array, path in zip(arrays, paths))
+    if fields is None:
+        target_fields = merge_items(*arrays_fields)
+    else:
+        target_fields = fields
 
-        interpolate(target, arrays, id_periods, to_interpolate)
-        return 'table', (target_fields, total_lines, iter(target), None)
+    # allocate main array
+    target = get_default_array(len(id_periods), np.dtype(target_fields))
+    target['period'] = id_periods['period']
+    target['id'] = id_periods['id']
+    interpolate(target, arrays, id_periods, to_interpolate)
+    return target_fields, target
 
 
-def csv2h5(fpath, buffersize=10 * 2 ** 20):
+def load_def(localdir, ent_name, section_def, required_fields,
+             buffersize=10 * 2 ** 20):
+    if 'type' in section_def and 'fields' in section_def:
+        raise Exception("invalid structure for '%s': "
+                        "type and fields sections are mutually exclusive"
+                        % ent_name)
+
+    if 'type' in section_def:
+        csv_filename = section_def.get('path', ent_name + ".csv")
+        csv_filepath = complete_path(localdir, csv_filename)
+        str_type = section_def['type']
+        if isinstance(str_type, basestring):
+            celltype = field_str_to_type(str_type, "array '%s'" % ent_name)
+        else:
+            assert isinstance(str_type, type)
+            celltype = str_type
+        return 'ndarray', load_ndarray(csv_filepath, celltype)
+
+    fields, files, to_interpolate = table_def(localdir, ent_name, section_def,
+                                              required_fields)
+    if to_interpolate is None:
+        path, kwargs = files[0]
+        csv_file = CSV(path, buffersize=buffersize, **kwargs)
+        chunks = csv_file.read_chunks(fields)
+        if fields is None:
+            fields = csv_file.fields
+        return 'table', (fields, csv_file.numlines, chunks, csv_file)
+    else:
+        # we have to load all files, merge them and return a stream out of that
+        print(" * reading files...")
+        csv_files = [CSV(path, buffersize=buffersize, **kwargs)
+                     for path, kwargs in files]
+        arrays = [f.as_array(fields_to_load)
+                  for f, fields_to_load
+                  in zip(csv_files, fields_per_file(fields, files))]
+        # the types of fields can only be known once the files are loaded
+        # (their detection can fail on the first lines of a file)
+        arrays_fields = [f.fields for f in csv_files] if fields is None \
+            else None
+        # close all files
+        for f in csv_files:
+            f.close()
+        fields, target = merge_arrays(fields, arrays, arrays_fields,
+                                      [path for path, _ in files],
+                                      required_fields, to_interpolate)
+        return 'table', (fields, len(target), [target], None)
+
+
+def read_csv_file(task, send):
+    """
+    reads the csv file of an import task and sends its content as messages:
+    ('start', task_id, (fields, numlines)), one ('chunk', task_id, array) per
+    chunk of lines and ('done', task_id, None). task is a (task_id, path,
+    csv_kwargs, fields, count_lines) tuple. If the types of columns (detected
+    on the first lines of the file) turn out to be wrong, the file is read
+    again (starting with a new 'start' message).
+    """
+    task_id, path, csv_kwargs, fields, count_lines = task
+    csv_file = CSV(path, **csv_kwargs)
+    try:
+        chunks = csv_file.read_chunks(fields)
+        numlines = csv_file.numlines if count_lines else None
+        send(('start', task_id, (fields or csv_file.fields, numlines)))
+        try:
+            for chunk in chunks:
+                send(('chunk', task_id, chunk))
+        except TypeDetectionError as e:
+            print("Warning: %s, detecting column types using the whole file"
+                  % e)
+            csv_file.detect_fields()
+            send(('start', task_id, (csv_file.fields, numlines)))
+            for chunk in csv_file.read_chunks():
+                send(('chunk', task_id, chunk))
+    finally:
+        csv_file.close()
+    send(('done', task_id, None))
+
+
+# queue of the messages sent by the worker processes of a parallel import
+_import_queue = None
+
+
+def _init_import_worker(queue):
+    global _import_queue
+    _import_queue = queue
+
+
+def _import_worker(task):
+    try:
+        read_csv_file(task, _import_queue.put)
+    except Exception as e:
+        # exceptions are not necessarily picklable
+        _import_queue.put(('error', task[0],
+                           ('%s: %s' % (type(e).__name__, e),
+                            traceback.format_exc())))
+
+
+class TableWriter(object):
+    """
+    appends the chunks of a csv file to a new table
+    """
+    def __init__(self, node, name, title, invert=(), compression=None):
+        self.node = node
+        self.name = name
+        self.title = title
+        self.invert = invert
+        self.compression = compression
+        self.table = None
+
+    def start(self, info):
+        fields, numlines = info
+        if self.table is not None:
+            # the file is read again with other column types
+            self.table.remove()
+        msg, filters = compression_str2filter(self.compression)
+        print(" - storing %s %s..." % (self.name, msg))
+        kwargs = {'expectedrows': numlines} if numlines else {}
+        # noinspection PyProtectedMember
+        h5file = self.node._v_file
+        self.table = h5file.create_table(self.node, self.name,
+                                         np.dtype(fields), title=self.title,
+                                         filters=filters, **kwargs)
+
+    def chunk(self, array):
+        for field in self.invert:
+            array[field] = ~array[field]
+        self.table.append(array)
+        self.table.flush()
+
+    def done(self, _):
+        pass
+
+
+class FileCollector(object):
+    """
+    collects the chunks of one of the files of a MultiFileTableWriter
+    """
+    def __init__(self, writer, path, fields):
+        self.writer = writer
+        self.path = path
+        self.fields = fields
+        self.chunks = []
+        self.array = None
+
+    def start(self, info):
+        self.fields, _ = info
+        self.chunks = []
+
+    def chunk(self, array):
+        self.chunks.append(array)
+
+    def done(self, _):
+        self.array = chunks_to_array(self.fields, self.chunks)
+        self.chunks = None
+        self.writer.file_done()
+
+
+class MultiFileTableWriter(object):
+    """
+    merges the files of a table (once they are all read) and stores the
+    result in a new table
+    """
+    def __init__(self, node, name, fields, files, required_fields,
+                 to_interpolate, title, invert=(), compression=None):
+        self.node = node
+        self.name = name
+        self.fields = fields
+        self.required_fields = required_fields
+        self.to_interpolate = to_interpolate
+        self.title = title
+        self.invert = invert
+        self.compression = compression
+        self.collectors = [FileCollector(self, path, file_fields)
+                           for (path, _), file_fields
+                           in zip(files, fields_per_file(fields, files))]
+        self.remaining = len(self.collectors)
+
+    def file_done(self):
+        self.remaining -= 1
+        if self.remaining:
+            return
+        collectors = self.collectors
+        print(" * merging %d files of %s..." % (len(collectors), self.name))
+        fields, target = merge_arrays(self.fields,
+                                      [c.array for c in collectors],
+                                      [c.fields for c in collectors],
+                                      [c.path for c in collectors],
+                                      self.required_fields,
+                                      self.to_interpolate)
+        self.collectors = None
+        # noinspection PyProtectedMember
+        chunks_to_table(self.node._v_file, self.node, self.name, fields,
+                        [target], len(target), title=self.title,
+                        invert=self.invert, compression=self.compression)
+
+
+def table_import_tasks(localdir, node, name, section_def, required_fields,
+                       title, invert=(), compression=None,
+                       buffersize=10 * 2 ** 20):
+    """
+    returns the (task, handler) pairs needed to import the table defined by
+    section_def in node
+    """
+    fields, files, to_interpolate = table_def(localdir, name, section_def,
+                                              required_fields)
+    if to_interpolate is None:
+        path, kwargs = files[0]
+        kwargs = dict(kwargs, buffersize=buffersize)
+        handler = TableWriter(node, name, title, invert, compression)
+        return [((path, kwargs, fields, True), handler)]
+    else:
+        writer = MultiFileTableWriter(node, name, fields, files,
+                                      required_fields, to_interpolate, title,
+                                      invert, compression)
+        return [((path, dict(kwargs, buffersize=buffersize),
+                  collector.fields, False), collector)
+                for (path, kwargs), collector
+                in zip(files, writer.collectors)]
+
+
+def run_import_tasks(tasks, jobs=1):
+    """
+    reads the csv files of tasks (a list of (task, handler) pairs) using jobs
+    worker processes and passes their content to their handler (in the
+    current process, which is the only one writing to the output file)
+    """
+    handlers = [handler for _, handler in tasks]
+    tasks = [(task_id,) + task for task_id, (task, _) in enumerate(tasks)]
+
+    def dispatch(message):
+        kind, task_id, payload = message
+        if kind == 'error':
+            message, worker_traceback = payload
+            raise Exception("error while reading '%s': %s\n\nin the worker "
+                            "process:\n%s" % (tasks[task_id][1], message,
+                                               worker_traceback))
+        getattr(handlers[task_id], kind)(payload)
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            read_csv_file(task, dispatch)
+        return
+
+    print("reading %d files using %d processes" % (len(tasks), jobs))
+    # the queue is bounded so that the workers cannot read files (much)
+    # faster than they are written
+    queue = multiprocessing.Queue(maxsize=2 * jobs)
+    pool = multiprocessing.Pool(min(jobs, len(tasks)), _init_import_worker,
+                                (queue,))
+    # the workers only exit before the end of the tasks if they crash (in
+    # which case the pool replaces them but their task is lost)
+    # noinspection PyProtectedMember
+    workers = list(pool._pool)
+    try:
+        result = pool.map_async(_import_worker, tasks, chunksize=1)
+        remaining = len(tasks)
+        while remaining:
+            try:
+                message = queue.get(timeout=IMPORT_POLL_INTERVAL)
+            except Empty:
+                if result.ready() and not result.successful():
+                    # raise the error of the worker
+                    result.get()
+                dead = [worker for worker in workers
+                        if worker.exitcode is not None]
+                if dead:
+                    raise Exception("a worker process of the import died "
+                                    "unexpectedly (exit code: %d)"
+                                    % dead[0].exitcode)
+                continue
+            dispatch(message)
+            if message[0] == 'done':
+                remaining -= 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def csv2h5(fpath, buffersize=10 * 2 ** 20, jobs=None):
+    """
+    imports the csv files described in fpath (an import file). The csv files
+    are read and converted by jobs worker processes (defaults to the number of
+    CPUs) while the current process writes the output file.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count() if hasattr(os, 'fork') else 1
     with open(fpath) as f:
         content = yaml.load(f)
 
@@ -761,6 +1317,8 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
     try:
         h5file = tables.open_file(h5_filepath, mode="w", title="CSV import")
 
+        # csv tables are imported by tasks which can run in parallel
+        tasks = []
         globals_def = content.get('globals', {})
         if globals_def:
             print()
@@ -768,48 +1326,38 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
             print("-------")
             const_node = h5file.create_group("/", "globals", "Globals")
             for global_name, global_def in globals_def.iteritems():
-                print()
-                print(" %s" % global_name)
                 req_fields = [('PERIOD', int)] \
                     if global_name == 'periodic' else []
 
-                kind, info = load_def(localdir, global_name,
-                                      global_def, req_fields)
-                if kind == 'ndarray':
+                if 'type' in global_def:
+                    print()
+                    print(" %s" % global_name)
+                    kind, info = load_def(localdir, global_name,
+                                          global_def, req_fields, buffersize)
+                    assert kind == 'ndarray'
                     array_to_disk_array(const_node, global_name, info,
                                         title=global_name,
                                         compression=compression)
                 else:
-                    assert kind == 'table'
-                    fields, numlines, datastream, csvfile = info
-                    stream_to_table(h5file, const_node, global_name, fields,
-                                    datastream, numlines,
-                                    title="%s table" % global_name,
-                                    buffersize=buffersize,
-                                    # FIXME: handle invert
-                                    compression=compression)
-                    if csvfile is not None:
-                        csvfile.close()
+                    tasks.extend(table_import_tasks(
+                        localdir, const_node, global_name, global_def,
+                        req_fields, title="%s table" % global_name,
+                        # FIXME: handle invert
+                        compression=compression, buffersize=buffersize))
 
-        print()
-        print("entities")
-        print("--------")
         ent_node = h5file.create_group("/", "entities", "Entities")
         for ent_name, entity_def in content['entities'].iteritems():
-            print()
-            print(" %s" % ent_name)
-            kind, info = load_def(localdir, ent_name,
-                                  entity_def, [('period', int), ('id', int)])
-            assert kind == "table"
-            fields, numlines, datastream, csvfile = info
-
-            stream_to_table(h5file, ent_node, ent_name, fields,
-                            datastream, numlines,
-                            title="%s table" % ent_name,
-                            invert=entity_def.get('invert', []),
-                            buffersize=buffersize, compression=compression)
-            if csvfile is not None:
-                csvfile.close()
+            assert 'type' not in entity_def
+            tasks.extend(table_import_tasks(
+                localdir, ent_node, ent_name, entity_def,
+                [('period', int), ('id', int)], title="%s table" % ent_name,
+                invert=entity_def.get('invert', []), compression=compression,
+                buffersize=buffersize))
+
+        print()
+        print("tables")
+        print("------")
+        run_import_tasks(tasks, jobs)
     finally:
         if h5file is not None:
             h5file.close()
@@ -3,18 +3,203 @@ from __future__ import print_function, division
 
 from itertools import izip, groupby
 from operator import itemgetter
+from threading import Lock
 
 import numpy as np
 import numexpr as ne
 
 from expr import (Expr, Variable, getdtype, expr_eval, missing_values,
-                  get_default_value, always, FunctionExpr)
-from context import context_length
+                  get_default_value, always, FunctionExpr, not_hashable)
+from exprbases import rowwise
+from context import EntityContext, context_length
 from utils import removed
 
 # TODO: merge this typemap with the one in tsum
 counting_typemap = {bool: int, int: int, float: float}
 
+# if less than this fraction of the target rows of a link chain are
+# referenced, the (element-wise) target expression is only evaluated on those
+SUBSET_EVAL_RATIO = 0.25
+
+# composed row maps of link chains:
+# {(links, entity_name, period): (source_arrays, rows, fail_level)}
+chain_rows_cache = {}
+
+# reverse indexes of one2many links:
+# {(link, entity_name, period): (source_arrays, index)}
+link_index_cache = {}
+
+# processes can run concurrently in several threads
+link_cache_lock = Lock()
+
+
+def cacheable_context(context):
+    """
+    returns whether results computed on context can be cached, ie whether
+    context is a whole entity at its current period.
+    """
+    entity_data = context.entity_data
+    return (isinstance(entity_data, EntityContext) and
+            entity_data.is_array_period)
+
+
+def store_in_cache(cache, key, value):
+    # key[-1] is the period. We only keep the entries of the current period.
+    period = key[-1]
+    with link_cache_lock:
+        for k in cache.keys():
+            if k[-1] != period:
+                del cache[k]
+        cache[key] = value
+
+
+def chain_rows(context, links, track_levels=False):
+    """
+    computes the row numbers (in the entity at the end of the chain) pointed
+    to by following all links of the chain, starting from the rows of context.
+    The result is -1 for rows where any link of the chain points nowhere.
+
+    If track_levels is True, also returns the index of the first link
+    pointing nowhere for each row (len(links) when the chain is complete),
+    otherwise returns None instead.
+
+    The result is cached per chain, entity and period when evaluated on a
+    whole entity. Since the link columns and the id_to_rownum arrays are
+    never modified inplace (they are replaced when they change), the cache
+    entries are checked against the identity of those arrays.
+    """
+    missing_int = missing_values[int]
+    source_context = context
+    source_arrays = []
+    for link in links:
+        # noinspection PyProtectedMember
+        target_context = link._target_context(source_context)
+        # noinspection PyProtectedMember
+        source_arrays.append(source_context[link._link_field])
+        source_arrays.append(target_context.id_to_rownum)
+        source_context = target_context
+
+    cacheable = cacheable_context(context)
+    if cacheable:
+        key = (links, context.entity_name, context.period)
+        cached = chain_rows_cache.get(key)
+        if cached is not None:
+            cached_arrays, rows, fail_level = cached
+            if (all(a is b for a, b in izip(cached_arrays, source_arrays)) and
+                    (fail_level is not None or not track_levels)):
+                return rows, fail_level if track_levels else None
+
+    rows = None
+    fail_level = None
+    for level in range(len(links)):
+        link_ids = source_arrays[level * 2]
+        id_to_rownum = source_arrays[level * 2 + 1]
+        if rows is None:
+            ids = link_ids
+        elif len(link_ids):
+            # ids for rows pointing nowhere are meaningless but harmless
+            ids = link_ids.take(rows, mode='clip')
+        else:
+            ids = np.full(len(rows), missing_int, dtype=int)
+        if len(id_to_rownum):
+            level_rows = id_to_rownum[ids]
+        else:
+            level_rows = np.full(len(ids), missing_int, dtype=int)
+        if rows is None:
+            expr = "where((ids == mi) | (lrows == mi), mi, lrows)"
+        else:
+            expr = "where((ids == mi) | (lrows == mi) | (rows == mi), mi, " \
+                   "lrows)"
+        new_rows = ne.evaluate(expr, {'ids': ids, 'lrows': level_rows,
+                                      'rows': rows, 'mi': missing_int})
+        if track_levels:
+            if fail_level is None:
+                fail_level = np.full(len(new_rows), len(links), dtype=np.int8)
+            fail_level[(new_rows == missing_int) &
+                       (fail_level == len(links))] = level
+        rows = new_rows
+
+    if cacheable:
+        store_in_cache(chain_rows_cache, key, (source_arrays, rows, fail_level))
+    return rows, fail_level
+
+
+class LinkIndex(object):
+    """
+    Index of the rows of the target entity of a one2many link, by row of its
+    source entity (eg the rows of the persons of each household).
+
+    source_rows[i] is the row (in the source entity) target row i is linked
+    to (-1 if it is linked to nothing) and the target rows linked to source
+    row j are indices[offsets[j]:offsets[j + 1]], in increasing order.
+    """
+    def __init__(self, source_rows, offsets, indices):
+        self.source_rows = source_rows
+        self.offsets = offsets
+        self.indices = indices
+
+    @classmethod
+    def from_source_rows(cls, source_rows, num_source_rows):
+        valid_rows = source_rows[source_rows != missing_values[int]]
+        counts = np.bincount(valid_rows, minlength=num_source_rows)
+        offsets = np.zeros(len(counts) + 1, dtype=int)
+        np.cumsum(counts, out=offsets[1:])
+        # a stable sort keeps the target rows in increasing order within
+        # each source row. Target rows linked to nothing (-1) come first.
+        order = source_rows.argsort(kind='mergesort')
+        indices = order[len(order) - len(valid_rows):]
+        return cls(source_rows, offsets, indices)
+
+    def subset(self, mask):
+        """
+        returns the index of the target rows where mask is True. Target rows
+        are renumbered so that they are indices in the filtered target rows.
+        """
+        new_rownum = np.cumsum(mask) - 1
+        kept = mask[self.indices]
+        num_kept = np.zeros(len(kept) + 1, dtype=int)
+        np.cumsum(kept, out=num_kept[1:])
+        return LinkIndex(self.source_rows[mask], num_kept[self.offsets],
+                         new_rownum[self.indices[kept]])
+
+
+def one2many_index(context, link):
+    """
+    returns the LinkIndex of the one2many link for the rows of context. It
+    is cached (per link, entity and period) like the rows of link chains.
+    """
+    # noinspection PyProtectedMember
+    target_context = link._target_context(context)
+    # this is a one2many, so the link column is on the target side
+    # noinspection PyProtectedMember
+    source_ids = target_context[link._link_field]
+    id_to_rownum = context.id_to_rownum
+    source_arrays = (source_ids, id_to_rownum)
+
+    cacheable = cacheable_context(context)
+    if cacheable:
+        key = (link, context.entity_name, context.period)
+        cached = link_index_cache.get(key)
+        if cached is not None:
+            cached_arrays, index = cached
+            if all(a is b for a, b in izip(cached_arrays, source_arrays)):
+                return index
+
+    missing_int = missing_values[int]
+    if len(id_to_rownum):
+        source_rows = id_to_rownum[source_ids]
+        # filter out missing values: those where the value of the link
+        # points to nowhere (-1)
+        source_rows[source_ids == missing_int] = missing_int
+    else:
+        assert np.all(source_ids == missing_int)
+        source_rows = source_ids.copy()
+    index = LinkIndex.from_source_rows(source_rows, context_length(context))
+
+    if cacheable:
+        store_in_cache(link_index_cache, key, (source_arrays, index))
+    return index
+
 
 class Link(object):
     def __init__(self, name, link_field, target_entity_name,
@@ -158,6 +343,25 @@ class LinkGet(LinkExpression):
     funcname = "get"
     no_eval = ('target_expr',)
 
+    def __init__(self, *args, **kwargs):
+        LinkExpression.__init__(self, *args, **kwargs)
+        # flatten the chain of LinkGet (if any) this LinkGet is the head of.
+        # Those attributes must start with an underscore so that they are
+        # ignored when comparing expressions and are not caught by
+        # __getattr__.
+        links = [self.link]
+        missing_values = [self.missing_value]
+        target_expr = self.target_expr
+        # only "plain" LinkGet with a constant missing value can be fused
+        while (type(target_expr) is LinkGet and
+               not isinstance(target_expr.missing_value, Expr)):
+            links.append(target_expr.link)
+            missing_values.append(target_expr.missing_value)
+            target_expr = target_expr.target_expr
+        self._chain_links = tuple(links)
+        self._chain_missing_values = tuple(missing_values)
+        self._chain_target_expr = target_expr
+
     def traverse(self):
         # XXX: don't we also need the fields within the target expression?
         # noinspection PyProtectedMember
@@ -211,25 +415,61 @@ class LinkGet(LinkExpression):
         assert isinstance(link, Link)
         assert isinstance(target_expr, Expr), str(type(target_expr))
 
-        # noinspection PyProtectedMember
-        target_ids = context[link._link_field]
-        target_context = self.target_context(context)
-
-        id_to_rownum = target_context.id_to_rownum
+        # a chain of links (eg partner.mother.household.region) is evaluated
+        # in one go: we compose the row maps of all the links of the chain
+        # and only evaluate the expression at its end, instead of evaluating
+        # each intermediate LinkGet on the whole population of its entity.
+        links = self._chain_links
+        target_expr = self._chain_target_expr
+        level_missing_values = self._chain_missing_values[1:]
+        track_levels = any(mv is not None for mv in level_missing_values)
+        rows, fail_level = chain_rows(context, links, track_levels)
+
+        target_context = context
+        for chain_link in links:
+            # noinspection PyProtectedMember
+            target_context = chain_link._target_context(target_context)
 
         missing_int = missing_values[int]
-        target_rows = id_to_rownum[target_ids]
+        target_rows = rows
+        if isinstance(target_expr, Variable) or not rowwise(target_expr):
+            target_values = expr_eval(target_expr, target_context)
+        else:
+            # when only a few target rows are referenced, only evaluate the
+            # target expression on those
+            target_length = context_length(target_context.entity_data)
+            used = np.zeros(target_length, dtype=bool)
+            used[rows[rows != missing_int]] = True
+            used_rows = used.nonzero()[0]
+            if len(used_rows) < target_length * SUBSET_EVAL_RATIO:
+                keys = [v.name for v in target_expr.collect_variables()]
+                subset_context = target_context.subset(used_rows, keys,
+                                                       not_hashable)
+                target_values = expr_eval(target_expr, subset_context)
+                subset_rows = np.empty(target_length, dtype=int)
+                subset_rows[used_rows] = np.arange(len(used_rows))
+                target_rows = subset_rows.take(rows, mode='clip')
+            else:
+                target_values = expr_eval(target_expr, target_context)
 
-        target_values = expr_eval(target_expr, target_context)
         missing_value = get_default_value(target_values, missing_value)
-
-        result_values = target_values[target_rows]
+        if len(target_values):
+            # rows pointing nowhere (-1) are replaced by missing_value below
+            result_values = target_values.take(target_rows, mode='clip')
+        else:
+            result_values = np.empty(len(rows), dtype=target_values.dtype)
 
         # it is a bit faster with numexpr (mixed_links: 0.22s -> 0.17s)
-        return ne.evaluate("where((ids != mi) & (rows != mi), values, mv)",
-                           {'ids': target_ids, 'rows': target_rows,
-                            'values': result_values, 'mi': missing_int,
-                            'mv': missing_value})
+        result = ne.evaluate("where(rows != mi, values, mv)",
+                             {'rows': rows, 'values': result_values,
+                              'mi': missing_int, 'mv': missing_value})
+        if fail_level is not None:
+            # each LinkGet of the chain can have its own missing value. The
+            # one of the first link pointing nowhere is used.
+            for level, level_mv in enumerate(level_missing_values, 1):
+                result[fail_level == level] = \
+                    get_default_value(target_values, level_mv)
+        return result
 
     def __repr__(self):
         if (self.missing_value is None and
@@ -256,34 +496,21 @@ class Aggregate(LinkExpression):
         # noinspection PyProtectedMember
         target_context = link._target_context(context)
 
-        # this is a one2many, so the link column is on the target side
-        # noinspection PyProtectedMember
-        source_ids = target_context[link._link_field]
+        source_rows = one2many_index(context, link).source_rows
         expr_value = expr_eval(target_expr, target_context)
         filter_value = expr_eval(target_filter, target_context)
         if filter_value is not None:
-            source_ids = source_ids[filter_value]
+            source_rows = source_rows[filter_value]
             # intentionally not using np.isscalar because of some corner
             # cases, eg. None and np.array(1.0)
             if isinstance(expr_value, np.ndarray) and expr_value.shape:
                 expr_value = expr_value[filter_value]
-
-        missing_int = missing_values[int]
-
-        id_to_rownum = context.id_to_rownum
-        if len(id_to_rownum):
-            source_rows = id_to_rownum[source_ids]
-            # filter out missing values: those where the value of the link
-            # points to nowhere (-1)
-            # XXX: use np.putmask(source_rows, source_ids == missing_int,
-            #                    missing_int)
-            source_rows[source_ids == missing_int] = missing_int
         else:
-            assert np.all(source_ids == missing_int)
-            # we need to make a copy because eval_rows modifies the array
-            # in place in some cases (countlink and descendants)
+            # we need to make a copy because the index is cached and
+            # eval_rows modifies the array in place in some cases (countlink
+            # and descendants)
             # TODO: document this fact in eval_rows
-            source_rows = source_ids.copy()
+            source_rows = source_rows.copy()
 
         if isinstance(expr_value, np.ndarray) and expr_value.shape:
             assert len(source_rows) == len(expr_value), \
@@ -26,6 +26,8 @@ import config
 from console import Console
 from context import EvaluationContext
 from data import entities_from_h5, H5Source
+from batch import run_batch
+from bench import run_benchmarks
 from importer import csv2h5
 from simulation import Simulation
 from upgrade import upgrade
@@ -136,16 +138,36 @@ def simulate(args):
                                       log_level=args.loglevel,
                                       assertions=args.assertions,
                                       autodump=args.autodump,
-                                      autodiff=args.autodiff)
+                                      autodiff=args.autodiff,
+                                      jobs=args.jobs,
+                                      profile=args.profile,
+                                      track_memory=args.memory)
 
-    simulation.run(args.interactive)
-#    import cProfile as profile
-#    profile.runctx('simulation.run(args.interactive)', vars(), {},
-#                   'c:\\tmp\\simulation.profile')
-    # to use profiling data:
-    # import pstats
-    # p = pstats.Stats('c:\\tmp\\simulation.profile')
-    # p.strip_dirs().sort_stats('cum').print_stats(30)
+    simulation.run(args.interactive, args.resume)
+
+
+def batch(args):
+    num_failed = run_batch(args.files, args.jobs,
+                           input_dir=args.input_path,
+                           input_file=args.input_file,
+                           output_dir=args.output_path)
+    if num_failed:
+        raise Exception("%d simulation(s) of the batch failed, see their "
+                        "log file for details" % num_failed)
+
+
+def bench(args):
+    num_failed, regressions = run_benchmarks(args.suite, args.sizes,
+                                             args.periods, args.output_path,
+                                             args.history, args.baseline,
+                                             args.threshold)
+    if num_failed or regressions:
+        raise Exception("%d benchmark(s) failed and %d regression(s) were "
+                        "found" % (num_failed, regressions))
+
+
+def import_csv(args):
+    csv2h5(args.file, jobs=args.jobs)
 
 
 def explore(fpath):
@@ -297,10 +319,55 @@ def main():
     parser_run.add_argument('--autodiff', help='path of the autodiff file')
     parser_run.add_argument('--assertions', choices=['raise', 'warn', 'skip'],
                             help='determines behavior of assertions')
+    parser_run.add_argument('-j', '--jobs', type=int,
+                            help='number of runs to execute in parallel '
+                                 '(integer)')
+    parser_run.add_argument('--resume', action='store_true',
+                            help='continue an interrupted simulation from its '
+                                 'last checkpoint')
+    parser_run.add_argument('--profile', action='store_true',
+                            help='record the time spent in each process, '
+                                 'function and expression')
+    parser_run.add_argument('--memory', action='store_true',
+                            help='record the memory used by each process')
+
+    # create the parser for the "batch" command
+    parser_batch = subparsers.add_parser('batch',
+                                         help='run several simulations (e.g. '
+                                              'variants of a model) in '
+                                              'parallel')
+    parser_batch.add_argument('files', nargs='+', help='simulation files')
+    parser_batch.add_argument('-j', '--jobs', type=int,
+                              help='number of simulations to run in parallel '
+                                   '(defaults to the number of CPUs)')
+
+    # create the parser for the "bench" command
+    parser_bench = subparsers.add_parser('bench',
+                                         help='run a benchmark suite')
+    parser_bench.add_argument('suite', help='benchmark suite file')
+    parser_bench.add_argument('--sizes', type=int, nargs='+',
+                              help='number of individuals of the populations '
+                                   '(overrides the sizes of the suite)')
+    parser_bench.add_argument('-p', '--periods', type=int,
+                              help='number of periods to simulate (overrides '
+                                   'the periods of the models with an input '
+                                   'file)')
+    parser_bench.add_argument('--history',
+                              help='path of the history file (defaults to '
+                                   'history.json next to the suite file)')
+    parser_bench.add_argument('--baseline',
+                              help='history file to compare the results with')
+    parser_bench.add_argument('--threshold', type=float, default=0.1,
+                              help='relative increase of time or memory '
+                                   'considered as a regression (defaults to '
+                                   '0.1)')
 
     # create the parser for the "import" command
     parser_import = subparsers.add_parser('import', help='import data')
     parser_import.add_argument('file', help='import file')
+    parser_import.add_argument('-j', '--jobs', type=int,
+                               help='number of files to read in parallel '
+                                    '(defaults to the number of CPUs)')
 
     # create the parser for the "explore" command
     parser_explore = subparsers.add_parser('explore', help='explore data of a '
@@ -338,8 +405,12 @@ def main():
     action = parsed_args.action
     if action == 'run':
         func, args = simulate, (parsed_args,)
+    elif action == "batch":
+        func, args = batch, (parsed_args,)
+    elif action == "bench":
+        func, args = bench, (parsed_args,)
     elif action == "import":
-        func, args = csv2h5, (parsed_args.file,)
+        func, args = import_csv, (parsed_args,)
     elif action == "explore":
         func, args = explore, (parsed_args.file,)
     elif action == "upgrade":
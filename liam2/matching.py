@@ -1,17 +1,114 @@
 # encoding: utf-8
 from __future__ import print_function
 
-import numpy as np
+import heapq
 import random
 
-from expr import expr_eval, always, expr_cache
-from exprbases import FilteredExpression
-from context import context_length, context_delete, context_subset, context_keep
+import numpy as np
+
+from expr import (Variable, ShortLivedVariable, expr_eval, always, expr_cache,
+                  evaluate)
+from exprbases import FilteredExpression, rowwise
+from context import context_length, context_subset, context_keep
 from utils import loop_wh_progress
 # FIXME: should be optional
 from cpartition import group_indices_nd
 
 
+def py_sparse_assignment(row_order, offsets, cols, costs, num_cols):
+    """
+    computes the assignment of rows to columns with the minimum total cost
+    for a sparse cost matrix given in CSR form: the (non-negative) costs of
+    row i are costs[offsets[i]:offsets[i + 1]] and the corresponding
+    columns are cols[offsets[i]:offsets[i + 1]]. Missing entries mean the
+    row cannot be assigned to the column.
+
+    Each row i also has a private dummy column (num_cols + i), which stands
+    for leaving the row unassigned, with a cost higher than what any
+    augmenting path can save. Rows are added one at a time (in row_order) to
+    the assignment, using the shortest augmenting path (with Dijkstra's
+    algorithm on the reduced costs), which can re-route rows added earlier
+    to their dummy column. The result is thus the assignment with the
+    maximum number of assigned rows and, among those, the minimum total cost.
+
+    returns the column assigned to each row (-1 for unassigned rows).
+    """
+    num_rows = len(offsets) - 1
+    # an augmenting path adds at most min(num_rows, num_cols) pairs
+    max_cost = costs.max() if len(costs) else 0.0
+    dummy_cost = max_cost * min(num_rows, num_cols) + 1.0
+    col4row = np.full(num_rows, -1, dtype=int)
+    row4col = np.full(num_cols + num_rows, -1, dtype=int)
+    u = np.zeros(num_rows)
+    v = np.zeros(num_cols + num_rows)
+    for cur_row in row_order:
+        i = cur_row
+        min_val = 0.0
+        dist = {}
+        path = {}
+        done = set()
+        visited_rows = []
+        heap = []
+        while True:
+            visited_rows.append(i)
+            for e in range(offsets[i], offsets[i + 1]):
+                j = cols[e]
+                if j in done:
+                    continue
+                r = min_val + costs[e] - u[i] - v[j]
+                if r < dist.get(j, np.inf):
+                    dist[j] = r
+                    path[j] = i
+                    heapq.heappush(heap, (r, j))
+            # only row i can reach its dummy column, so the dummy column
+            # of a visited row is always free
+            j = num_cols + i
+            dist[j] = min_val + dummy_cost - u[i] - v[j]
+            path[j] = i
+            heapq.heappush(heap, (dist[j], j))
+            # find the closest column not reached yet
+            while True:
+                r, j = heapq.heappop(heap)
+                if j not in done and r <= dist[j]:
+                    break
+            min_val = dist[j]
+            done.add(j)
+            if row4col[j] == -1:
+                sink = j
+                break
+            i = row4col[j]
+
+        # update dual variables
+        u[cur_row] += min_val
+        for i in visited_rows[1:]:
+            u[i] += min_val - dist[col4row[i]]
+        for j in done:
+            v[j] -= min_val - dist[j]
+        # augment the matching along the path
+        j = sink
+        while True:
+            i = path[j]
+            row4col[j] = i
+            col4row[i], j = j, col4row[i]
+            if i == cur_row:
+                break
+    col4row[col4row >= num_cols] = -1
+    return col4row
+
+
+# the compiled version is used when available. py_sparse_assignment is kept
+# around as the reference implementation.
+try:
+    from cmatching import sparse_assignment
+except ImportError:
+    sparse_assignment = py_sparse_assignment
+
+
+# maximum number of scores computed at once when building the candidates of
+# the optimal matching
+MAX_SCORES_PER_BATCH = 2 ** 20
+
+
 def group_context(used_variables, setfilter, context):
     """
     return a dict of the form:
@@ -38,6 +135,196 @@ def group_context(used_variables, setfilter, context):
     return result
 
 
+def lowest_value(dtype):
+    """
+    returns the lowest value of dtype, so that it never wins an argmax
+    """
+    # this is called at each step, so we avoid the (slow) np.issubdtype
+    if dtype.kind == 'f':
+        return -np.inf
+    elif dtype.kind in 'iu':
+        return np.iinfo(dtype).min
+    else:
+        assert dtype.kind == 'b'
+        return False
+
+
+class Candidates(object):
+    """
+    individuals of set 2 which are still available during a one by one
+    matching.
+
+    Matched individuals are only flagged as dead (in the alive mask and the
+    array of dead rows), so that removing one is O(1). Since compacting the columns
+    changes the row numbers, it is only done on demand (by compact) and only
+    when more than a quarter of the rows are dead.
+    """
+    def __init__(self, columns):
+        self.columns = {k: v for k, v in columns.iteritems()
+                        if k != '__len__'}
+        self.alive = np.ones(context_length(columns), dtype=bool)
+        self.num_alive = len(self.alive)
+        self._dead = np.empty(len(self.alive), dtype=int)
+        self.num_dead = 0
+
+    def __len__(self):
+        return self.num_alive
+
+    def alive_rows(self):
+        return self.alive.nonzero()[0]
+
+    def dead_rows(self):
+        return self._dead[:self.num_dead]
+
+    def subset(self, rows=None):
+        return context_subset(self.columns, rows, self.columns.keys())
+
+    def remove(self, row):
+        self.alive[row] = False
+        self.num_alive -= 1
+        self._dead[self.num_dead] = row
+        self.num_dead += 1
+
+    def compact(self):
+        if self.num_dead * 4 > len(self.alive):
+            self.columns = self.subset(self.alive_rows())
+            del self.columns['__len__']
+            self.alive = np.ones(self.num_alive, dtype=bool)
+            self.num_dead = 0
+
+
+class ScoreFunction(object):
+    """
+    computes the scores of one individual of set 1 against individuals of
+    set 2.
+
+    When the score expression is element-wise and uses variables of set 2
+    (and nothing else than variables of both sets), it is compiled once to a
+    numexpr expression which is evaluated directly on the set 2 columns (the
+    set 1 values are passed as scalars). numexpr evaluates it by cache-sized
+    blocks, using several threads. In that case, the set 1 values can also be
+    given as (n, 1) arrays to compute the scores of n individuals of set 1 at
+    once (the result is then a (n, N) array).
+
+    Otherwise, it is evaluated through expr_eval.
+    """
+    def __init__(self, score, context, set1_values, candidates):
+        self.score = score
+        self.context = context
+        self.expr = None
+
+        eval_ctx = context.clone(entity_data=dict(candidates.columns,
+                                                  **set1_values))
+        variables = score.collect_variables()
+        if rowwise(score) and \
+                any(v.name in candidates.columns for v in variables) and \
+                all(type(v) in (Variable, ShortLivedVariable) and
+                    v.name in eval_ctx.entity_data for v in variables):
+            self.expr = score.as_simple_expr(eval_ctx).as_string()
+
+    @property
+    def compiled(self):
+        return self.expr is not None
+
+    def evaluate(self, set1_values, columns):
+        """
+        computes the scores against all the individuals in columns
+        """
+        if self.compiled:
+            local_ctx = dict(columns, **set1_values)
+            constants = {'nan': float('nan'), 'inf': float('inf')}
+            return evaluate(self.expr, local_ctx, constants, truediv='auto')
+
+        local_ctx = columns.copy()
+        local_ctx.update(set1_values)
+        context = self.context
+        scores = expr_eval(self.score, context.clone(entity_data=local_ctx))
+        # the expression cache is keyed on the expression and period, not on
+        # the (changing) context, so it must not be reused by the next step.
+        # The matching runs inside its own cache scope (see
+        # SequentialMatching.compute), so this only discards what was cached
+        # during the matching.
+        expr_cache.clear()
+        return scores
+
+    def __call__(self, set1_values, candidates):
+        """
+        computes the scores against all the rows of candidates. Dead rows get
+        the lowest possible score.
+        """
+        num_dead = candidates.num_dead
+        if self.compiled:
+            scores = self.evaluate(set1_values, candidates.columns)
+            if num_dead:
+                scores[..., candidates.dead_rows()] = \
+                    lowest_value(scores.dtype)
+            return scores
+
+        # non-compiled expressions are only evaluated on alive individuals
+        rows = candidates.alive_rows() if num_dead else None
+        alive_scores = np.asarray(self.evaluate(set1_values,
+                                                candidates.subset(rows)))
+        dtype = alive_scores.dtype
+        scores = np.full(len(candidates.alive), lowest_value(dtype),
+                         dtype=dtype)
+        scores[candidates.alive] = alive_scores
+        return scores
+
+
+def block_labels(context, blocks, filter_value):
+    """
+    returns the block number of each individual of context, given a list of
+    expressions: individuals with the same values for all the expressions are
+    in the same block. Individuals which are not in filter_value or have a nan
+    value get -1.
+    """
+    length = context_length(context)
+    columns = []
+    for expr in blocks:
+        values = expr_eval(expr, context)
+        if np.isscalar(values):
+            values = np.full(length, values)
+        columns.append(values)
+    labels = np.full(length, -1, dtype=int)
+    # group_indices_nd returns a dict {value_or_tuple: array_of_indices}
+    for label, indices in enumerate(group_indices_nd(columns,
+                                                     filter_value).values()):
+        labels[indices] = label
+    return labels
+
+
+class BlockIndex(object):
+    """
+    row numbers of the (alive and dead) candidates in each block. The index is
+    rebuilt when the candidates are compacted.
+    """
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self.labels = None
+        self.order = None
+        self.offsets = None
+
+    def rows(self, label):
+        """
+        returns the row numbers of the alive candidates of block label (in
+        increasing order)
+        """
+        candidates = self.candidates
+        labels = candidates.columns['__other___block__']
+        if labels is not self.labels:
+            self.labels = labels
+            # sorting is stable, so that the rows of each block are sorted
+            self.order = np.argsort(labels, kind='mergesort')
+            counts = np.bincount(labels + 1)
+            self.offsets = np.zeros(len(counts) + 1, dtype=int)
+            np.cumsum(counts, out=self.offsets[1:])
+        # block -1 is at position 0
+        if label + 1 >= len(self.offsets) - 1:
+            return np.empty(0, dtype=int)
+        rows = self.order[self.offsets[label + 1]:self.offsets[label + 2]]
+        return rows[candidates.alive[rows]]
+
+
 class Matching(FilteredExpression):
     """
     Base class for matching functions
@@ -103,9 +390,22 @@ class SequentialMatching(Matching):
           objective score) to match hard-to-match people first.
         - the string 'EDtM', in which case, the (reduced) "Euclidean Distance to
           the Mean" is used to order individuals.
+
+    The 'optimal' algorithm matches as many pairs as possible and, among
+    those, maximizes the sum of the scores of all pairs, but only considers
+    the num_candidates best scoring individuals of set 2 for each individual
+    of set 1.
+
+    If blocks is given (a list of expressions), individuals of set 1 are only
+    scored against individuals of set 2 in the same block (with the same values
+    for all expressions). With the 'onebyone' algorithm, when no individual is
+    left in a block, the individuals of set 1 of that block are scored against
+    all remaining individuals of set 2. With the 'optimal' algorithm, the
+    individuals of set 1 left unmatched once all blocks are matched are scored
+    against all the individuals of set 2 left unmatched.
     """
     funcname = 'matching'
-    no_eval = ('set1filter', 'set2filter', 'score', 'orderby')
+    no_eval = ('set1filter', 'set2filter', 'score', 'orderby', 'blocks')
 
     def traverse(self):
         # FIXME: we should not override the parent traverse method, so that all
@@ -118,12 +418,37 @@ class SequentialMatching(Matching):
         yield self
 
     def compute(self, context, set1filter, set2filter, score, orderby,
-                pool_size=None, algo='onebyone'):
-        global matching_ctx
-
+                pool_size=None, algo='onebyone', lookahead=1,
+                num_candidates=10, blocks=None):
+        if algo not in ('onebyone', 'byvalue', 'optimal'):
+            raise ValueError("invalid value for algo: %r (it should be one of "
+                             "'onebyone', 'byvalue' or 'optimal')" % algo)
         if pool_size is not None:
             assert isinstance(pool_size, int)
             assert pool_size > 0
+            if algo == 'optimal':
+                raise Exception("the 'pool_size' argument is not supported by "
+                                "the 'optimal' algorithm")
+        assert isinstance(num_candidates, int)
+        assert num_candidates > 0
+        assert isinstance(lookahead, int)
+        assert lookahead > 0
+        if lookahead > 1:
+            if algo != 'onebyone':
+                raise Exception("the 'lookahead' argument is only valid with "
+                                "the 'onebyone' algorithm")
+            if pool_size is not None:
+                raise Exception("the 'lookahead' and 'pool_size' arguments "
+                                "cannot be used together")
+        if blocks is not None:
+            if not isinstance(blocks, (tuple, list)):
+                blocks = [blocks]
+            if algo == 'byvalue':
+                raise Exception("the 'blocks' argument is not supported by "
+                                "the 'byvalue' algorithm")
+            if pool_size is not None or lookahead > 1:
+                raise Exception("the 'blocks' argument cannot be used "
+                                "together with 'pool_size' or 'lookahead'")
 
         set1filterexpr = self._getfilter(context, set1filter)
         set1filtervalue = expr_eval(set1filterexpr, context)
@@ -143,7 +468,7 @@ class SequentialMatching(Matching):
         else:
             orderby_vars = {v.name for v in orderby.collect_variables()}
 
-        if algo == 'onebyone':
+        if algo in ('onebyone', 'optimal'):
             all_vars = {'id'} | used_variables1 | orderby_vars
             set1 = context.subset(set1filtervalue, all_vars, set1filterexpr)
             set2 = context.subset(set2filtervalue, {'id'} | used_variables2,
@@ -157,6 +482,12 @@ class SequentialMatching(Matching):
             set1['__ids__'] = set1['id'].reshape(set1len, 1)
             set2['__ids__'] = set2['id'].reshape(set2len, 1)
 
+            if blocks is not None:
+                labels = block_labels(context, blocks,
+                                      set1filtervalue | set2filtervalue)
+                set1['__block__'] = labels[set1filtervalue]
+                set2['__block__'] = labels[set2filtervalue]
+                print(" (%d blocks)" % (labels.max() + 1), end='')
             print()
         else:
             # optimized matching by grouping sets by values, which usually
@@ -202,71 +533,358 @@ class SequentialMatching(Matching):
         matching_ctx = {'__other_' + k if k != '__len__' else k: v
                         for k, v in set2.iteritems()}
 
-        def match_cell(idx, sorted_idx, pool_size):
-            global matching_ctx
-
-            set2_size = context_length(matching_ctx)
-            if not set2_size:
-                raise StopIteration
-
-            if pool_size is not None and set2_size > pool_size:
-                pool = random.sample(xrange(set2_size), pool_size)
-                local_ctx = context_subset(matching_ctx, pool)
+        with expr_cache.scope():
+            if algo == 'onebyone':
+                self.match_onebyone(context, score, set1, matching_ctx,
+                                    used_variables1, sorted_set1_indices,
+                                    pool_size, lookahead, result)
+            elif algo == 'optimal':
+                self.match_optimal(context, score, set1, matching_ctx,
+                                   used_variables1, sorted_set1_indices,
+                                   num_candidates, result)
             else:
-                local_ctx = matching_ctx.copy()
+                self.match_byvalue(context, score, set1, matching_ctx,
+                                   used_variables1, sorted_set1_indices,
+                                   pool_size, result)
+        return result
 
-            local_ctx.update((k, set1[k][sorted_idx])
-                             for k in {'__ids__'} | used_variables1)
+    @staticmethod
+    def match_byvalue(context, score, set1, set2, used_variables1,
+                      sorted_set1_indices, pool_size, result):
+        """
+        set1 and set2 contain one row (cell) per distinct combination of
+        values, with the ids of the individuals in that cell. Cells of set 1
+        are considered in turn (in sorted_set1_indices order) and their
+        individuals are matched with the individuals of the best cell of set
+        2, then with those of the next best cell (if the first one does not
+        contain enough individuals), and so on.
+
+        Instead of modifying the ids arrays of cells, the number of
+        individuals already matched in each cell of set 2 is kept in an
+        '__used__' column. Exhausted cells of set 2 are flagged as dead.
+        """
+        id_to_rownum = context.id_to_rownum
+        set1_ids = set1['__ids__']
+        candidates = Candidates(set2)
+        if not len(candidates) or not len(sorted_set1_indices):
+            return
+        candidates.columns['__used__'] = np.zeros(len(candidates.alive),
+                                                  dtype=int)
+
+        set1_values = {k: set1[k][0] for k in used_variables1}
+        score_func = ScoreFunction(score, context, set1_values, candidates)
+
+        def match_cell(idx, sorted_idx):
+            if not len(candidates):
+                raise StopIteration
 
-            eval_ctx = context.clone(entity_data=local_ctx)
-            set2_scores = expr_eval(score, eval_ctx)
-            cell2_idx = set2_scores.argmax()
+            # row numbers are only stable within a cell
+            candidates.compact()
+            columns = candidates.columns
+            alive = candidates.alive
+            set1_values = {k: set1[k][sorted_idx] for k in used_variables1}
+            # scores against all candidates, computed only when needed
+            scores = None
 
-            cell1ids = local_ctx['__ids__']
-            cell2ids = local_ctx['__other___ids__'][cell2_idx]
+            cell1ids = set1_ids[sorted_idx]
+            cell1size = len(cell1ids)
+            start1 = 0
+            while start1 < cell1size:
+                num_candidates = len(candidates)
+                if not num_candidates:
+                    break
+
+                if pool_size is not None and num_candidates > pool_size:
+                    pool = random.sample(xrange(num_candidates), pool_size)
+                    rows = candidates.alive_rows()[pool]
+                    pool_scores = score_func.evaluate(set1_values,
+                                                      candidates.subset(rows))
+                    row = rows[np.asarray(pool_scores).argmax()]
+                else:
+                    if scores is None:
+                        scores = score_func(set1_values, candidates)
+                    row = scores.argmax()
+                    # all alive cells have the lowest possible score
+                    if not alive[row]:
+                        row = alive.argmax()
+
+                cell2ids = columns['__other___ids__'][row]
+                used = columns['__used__']
+                start2 = used[row]
+                nb_match = min(cell1size - start1, len(cell2ids) - start2)
+
+                # we could introduce a random choice here but it is not
+                # much necessary. In that case, it should be done in
+                # group_context
+                ids1 = cell1ids[start1:start1 + nb_match]
+                ids2 = cell2ids[start2:start2 + nb_match]
+
+                result[id_to_rownum[ids1]] = ids2
+                result[id_to_rownum[ids2]] = ids1
+
+                start1 += nb_match
+                used[row] += nb_match
+                if used[row] == len(cell2ids):
+                    candidates.remove(row)
+                    if scores is not None:
+                        scores[row] = lowest_value(scores.dtype)
+        loop_wh_progress(match_cell, sorted_set1_indices)
+
+    @staticmethod
+    def match_onebyone(context, score, set1, set2, used_variables1,
+                       sorted_set1_indices, pool_size, lookahead, result):
+        """
+        if lookahead > 1, the scores of the next lookahead individuals of set 1
+        are computed at once against the current set 2. Since the score of an
+        individual does not depend on the other individuals, the matches are
+        then resolved sequentially (by giving the lowest possible score to the
+        already matched individuals of set 2) and give exactly the same result
+        as without lookahead.
+        """
+        id_to_rownum = context.id_to_rownum
+        set1_ids = set1['__ids__']
+        candidates = Candidates(set2)
+        if not len(candidates) or not len(sorted_set1_indices):
+            return
+
+        set1_values = {k: set1[k][0] for k in used_variables1}
+        score_func = ScoreFunction(score, context, set1_values, candidates)
+        # the scores of several individuals can only be computed at once when
+        # the expression is compiled, and it is useless if it does not depend
+        # on the individual of set 1
+        if not score_func.compiled or not used_variables1:
+            lookahead = 1
+
+        if '__block__' in set1:
+            set1_blocks = set1['__block__']
+            block_index = BlockIndex(candidates)
+        else:
+            set1_blocks = None
 
-            if pool_size is not None and set2_size > pool_size:
-                # transform pool-local index to set/matching_ctx index
-                cell2_idx = pool[cell2_idx]
+        batch = {}
 
-            cell1size = len(cell1ids)
-            cell2size = len(cell2ids)
-            nb_match = min(cell1size, cell2size)
-
-            # we could introduce a random choice here but it is not
-            # much necessary. In that case, it should be done in group_context
-            ids1 = cell1ids[:nb_match]
-            ids2 = cell2ids[:nb_match]
-
-            result[id_to_rownum[ids1]] = ids2
-            result[id_to_rownum[ids2]] = ids1
-            
-            if nb_match == cell2size:
-                matching_ctx = context_delete(matching_ctx, cell2_idx)
+        def compute_batch(start):
+            if lookahead == 1:
+                sorted_idx = sorted_set1_indices[start]
+                values = {k: set1[k][sorted_idx] for k in used_variables1}
             else:
-                # other variables do not need to be modified since the cell
-                # only got smaller and was not deleted
-                matching_ctx['__other___ids__'][cell2_idx] = cell2ids[nb_match:]
-
-            # FIXME: the expr gets cached for the full matching_ctx at the
-            # beginning and then when another women with the same values is
-            # found, it thinks it can reuse the expr but it breaks because it
-            # has not the correct length.
-
-            # the current workaround is to invalidate the whole cache for the
-            # current entity but this is not the right way to go.
-            # * disable the cache for matching?
-            # * use a local cache so that methods after matching() can use
-            # what was in the cache before matching(). Shouldn't the cache be
-            # stored inside the context anyway?
-            expr_cache.invalidate(context.period, context.entity_name)
-
-            if nb_match < cell1size:
-                set1['__ids__'][sorted_idx] = cell1ids[nb_match:]
-                match_cell(idx, sorted_idx, pool_size)
-        loop_wh_progress(match_cell, sorted_set1_indices, pool_size)
-        return result
+                indices = sorted_set1_indices[start:start + lookahead]
+                values = {k: set1[k][indices].reshape(-1, 1)
+                          for k in used_variables1}
+            batch['scores'] = score_func(values, candidates)
+
+        def match_one(idx, sorted_idx):
+            num_candidates = len(candidates)
+            if not num_candidates:
+                raise StopIteration
 
+            pos = (idx - 1) % lookahead
+            if pos == 0:
+                # row numbers are only stable within a batch
+                candidates.compact()
+            # candidates to consider (None means all candidates)
+            rows = None
+            if pool_size is not None and num_candidates > pool_size:
+                pool = random.sample(xrange(num_candidates), pool_size)
+                rows = candidates.alive_rows()[pool]
+            elif set1_blocks is not None and set1_blocks[sorted_idx] != -1:
+                rows = block_index.rows(set1_blocks[sorted_idx])
+                # fallback to all candidates if the block is exhausted
+                if not len(rows):
+                    rows = None
+
+            if rows is not None:
+                set1_values = {k: set1[k][sorted_idx] for k in used_variables1}
+                scores = score_func.evaluate(set1_values,
+                                             candidates.subset(rows))
+                row = rows[np.asarray(scores).argmax()]
+            else:
+                if pos == 0:
+                    compute_batch(idx - 1)
+                scores = batch['scores']
+                if lookahead > 1:
+                    scores = scores[pos]
+                alive = candidates.alive
+                row = scores.argmax()
+                # all alive individuals have the lowest possible score
+                if not alive[row]:
+                    row = alive.argmax()
+                if lookahead > 1:
+                    later_scores = batch['scores'][pos + 1:]
+                    later_scores[:, row] = lowest_value(later_scores.dtype)
+
+            id1 = set1_ids[sorted_idx, 0]
+            id2 = candidates.columns['__other___ids__'][row, 0]
+            result[id_to_rownum[id1]] = id2
+            result[id_to_rownum[id2]] = id1
+            candidates.remove(row)
+        loop_wh_progress(match_one, sorted_set1_indices)
+
+    @staticmethod
+    def optimal_pairs(score_func, set1, used_variables1, sorted_set1_indices,
+                      candidates, groups, num_candidates, batched):
+        """
+        returns the (set 1 rows, set 2 rows) of the pairs of the optimal
+        assignment where each individual of set 1 of each group can only be
+        matched with one of its num_candidates best scoring individuals of
+        set 2 in the same group.
+
+        groups is a list of (set 1 rows, set 2 rows) tuples, where rows of
+        set 1 are indices in sorted_set1_indices and rows of set 2 are indices
+        in candidates (None means all the individuals of set 2).
+        """
+        num1, num2 = len(sorted_set1_indices), len(candidates)
+        no_pairs = np.empty(0, dtype=int), np.empty(0, dtype=int)
+        edge_rows, edge_cols, edge_scores = [], [], []
+        for group_rows, group_cols in groups:
+            if not len(group_rows) or \
+                    (group_cols is not None and not len(group_cols)):
+                continue
+            columns = candidates.subset(group_cols)
+            num_cols = context_length(columns)
+            num_best = min(num_candidates, num_cols)
+            batch_size = max(MAX_SCORES_PER_BATCH // num_cols, 1) \
+                if batched else 1
+            for start in range(0, len(group_rows), batch_size):
+                rows = group_rows[start:start + batch_size]
+                indices = sorted_set1_indices[rows]
+                if batch_size > 1:
+                    values = {name: set1[name][indices].reshape(-1, 1)
+                              for name in used_variables1}
+                else:
+                    values = {name: set1[name][indices[0]]
+                              for name in used_variables1}
+                scores = score_func.evaluate(values, columns)
+                # scores which do not depend on the individual of set 1 are
+                # computed only once per batch
+                scores = np.broadcast_to(np.asarray(scores, float),
+                                         (len(rows), num_cols))
+                if num_best < num_cols:
+                    # nans are sorted last
+                    best = np.argpartition(-scores, num_best - 1,
+                                           axis=1)[:, :num_best]
+                else:
+                    best = np.broadcast_to(np.arange(num_cols),
+                                           (len(rows), num_cols))
+                edge_rows.append(np.repeat(rows, num_best))
+                edge_scores.append(
+                    scores[np.arange(len(rows)).reshape(-1, 1), best].ravel())
+                if group_cols is not None:
+                    best = group_cols[best]
+                edge_cols.append(best.ravel())
+        if not edge_rows:
+            return no_pairs
+        edge_rows = np.concatenate(edge_rows)
+        edge_cols = np.concatenate(edge_cols)
+        scores = np.concatenate(edge_scores)
+
+        # individuals with a nan or infinite score cannot be matched together
+        # (infinite scores would make all costs infinite or nan)
+        valid = np.isfinite(scores)
+        if not valid.any():
+            return no_pairs
+        edge_rows, edge_cols = edge_rows[valid], edge_cols[valid]
+        scores = scores[valid]
+        # costs must be positive
+        costs = scores.max() - scores
+
+        # it is faster to add the rows of the smallest set to the assignment,
+        # so we transpose the graph if set 1 is larger
+        transpose = num1 > num2
+        if transpose:
+            edge_rows, edge_cols = edge_cols, edge_rows
+            num_rows, num_cols = num2, num1
+        else:
+            num_rows, num_cols = num1, num2
+        order = np.argsort(edge_rows, kind='mergesort')
+        offsets = np.zeros(num_rows + 1, dtype=np.intp)
+        np.cumsum(np.bincount(edge_rows, minlength=num_rows),
+                  out=offsets[1:])
+        row_order = np.arange(num_rows, dtype=np.intp)
+        col4row = sparse_assignment(row_order, offsets,
+                                    edge_cols[order].astype(np.intp),
+                                    costs[order], num_cols)
+
+        matched = col4row != -1
+        rows1, rows2 = matched.nonzero()[0], col4row[matched]
+        if transpose:
+            rows1, rows2 = rows2, rows1
+        return rows1, rows2
+
+    @staticmethod
+    def match_optimal(context, score, set1, set2, used_variables1,
+                      sorted_set1_indices, num_candidates, result):
+        """
+        matches the individuals of both sets so that the total score is
+        maximal, given that each individual of set 1 can only be matched
+        with one of its num_candidates best scoring individuals of set 2 (in
+        its block if blocks are used).
+
+        The number of matched pairs is maximized first, then the total score.
+        When blocks are used, the individuals of set 1 left unmatched in their
+        block are then matched (in the same way) with the individuals of set
+        2 left unmatched, whatever their block.
+        """
+        candidates = Candidates(set2)
+        num1, num2 = len(sorted_set1_indices), len(candidates)
+        if not num1 or not num2:
+            return
+
+        set1_values = {k: set1[k][0] for k in used_variables1}
+        score_func = ScoreFunction(score, context, set1_values, candidates)
+        # the scores of several individuals of set 1 can only be computed at
+        # once when the expression is compiled (if they depend on them)
+        batched = score_func.compiled or not used_variables1
+
+        # the rows of the candidate graph are the individuals of set 1 in
+        # orderby order, its columns are the individuals of set 2
+        if '__block__' in set1:
+            blocks1 = set1['__block__'][sorted_set1_indices]
+            blocks2 = candidates.columns['__other___block__']
+            order1 = np.argsort(blocks1, kind='mergesort')
+            order2 = np.argsort(blocks2, kind='mergesort')
+            counts1 = np.bincount(blocks1 + 1)
+            counts2 = np.bincount(blocks2 + 1, minlength=len(counts1))
+            offsets1 = np.concatenate(([0], np.cumsum(counts1)))
+            offsets2 = np.concatenate(([0], np.cumsum(counts2)))
+            groups = [(order1[offsets1[i]:offsets1[i + 1]],
+                       order2[offsets2[i]:offsets2[i + 1]])
+                      for i in range(len(counts1))]
+            # individuals of set 1 without block are scored against all
+            # individuals of set 2
+            if len(groups[0][0]):
+                groups[0] = (groups[0][0], None)
+        else:
+            groups = [(np.arange(num1), None)]
+
+        optimal_pairs = SequentialMatching.optimal_pairs
+        rows1, rows2 = optimal_pairs(score_func, set1, used_variables1,
+                                     sorted_set1_indices, candidates, groups,
+                                     num_candidates, batched)
+        if '__block__' in set1:
+            # like with the 'onebyone' algorithm, individuals of set 1 which
+            # could not be matched in their block (e.g. because there is no
+            # individual of set 2 left in it) are scored against all remaining
+            # individuals of set 2
+            left1 = np.ones(num1, dtype=bool)
+            left1[rows1] = False
+            left2 = np.ones(num2, dtype=bool)
+            left2[rows2] = False
+            if left1.any() and left2.any():
+                groups = [(left1.nonzero()[0], left2.nonzero()[0])]
+                more_rows1, more_rows2 = optimal_pairs(
+                    score_func, set1, used_variables1, sorted_set1_indices,
+                    candidates, groups, num_candidates, batched)
+                rows1 = np.concatenate((rows1, more_rows1))
+                rows2 = np.concatenate((rows2, more_rows2))
+        if not len(rows1):
+            return
+
+        ids1 = set1['__ids__'][sorted_set1_indices[rows1], 0]
+        ids2 = candidates.columns['__other___ids__'][rows2, 0]
+        id_to_rownum = context.id_to_rownum
+        result[id_to_rownum[ids1]] = ids2
+        result[id_to_rownum[ids2]] = ids1
 
 functions = {
     'matching': SequentialMatching,
@@ -0,0 +1,147 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import csv
+from collections import OrderedDict
+
+import numpy as np
+
+from data import ColumnArray
+from expr import expr_cache
+from links import LinkIndex, chain_rows_cache, link_index_cache
+from utils import mem_usage, peak_mem_usage, size2str
+
+# kinds of memory tracked for all entities
+CATEGORIES = ('array', 'temp_variables', 'array_lag', 'indexes', 'caches')
+
+
+def arrays_nbytes(value, seen):
+    """
+    returns the number of bytes used by the numpy arrays contained in value
+    (which can be an array, a ColumnArray, a LinkIndex or a dict, list or
+    tuple of those). Arrays whose id is in seen are not counted, so that
+    arrays referenced from several places are only counted once, and the ids
+    of the counted arrays are added to seen. Views count for their base array.
+    """
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        return value.nbytes
+    elif isinstance(value, ColumnArray):
+        return arrays_nbytes(value.columns, seen)
+    elif isinstance(value, LinkIndex):
+        return arrays_nbytes([value.source_rows, value.offsets, value.indices],
+                             seen)
+    elif isinstance(value, dict):
+        return arrays_nbytes(value.values(), seen)
+    elif isinstance(value, (list, tuple)):
+        return sum(arrays_nbytes(v, seen) for v in value)
+    else:
+        return 0
+
+
+def memory_snapshot(entities):
+    """
+    returns an OrderedDict with the number of bytes used by each category of
+    arrays of all entities
+    """
+    seen = set()
+    sizes = OrderedDict((category, 0) for category in CATEGORIES)
+    for entity in entities:
+        sizes['array'] += arrays_nbytes(entity.array, seen)
+        sizes['temp_variables'] += arrays_nbytes(entity.temp_variables, seen)
+        sizes['array_lag'] += arrays_nbytes(entity.array_lag, seen)
+        sizes['indexes'] += arrays_nbytes([entity.id_to_rownum,
+                                           entity.input_index,
+                                           entity.output_index], seen)
+    # caches are counted last because they mostly reference arrays of the
+    # entities and we only want to count the memory they hold on their own
+    sizes['caches'] = arrays_nbytes([expr_cache, chain_rows_cache,
+                                     link_index_cache], seen)
+    return sizes
+
+
+class MemoryTracker(object):
+    """
+    records the memory used by a simulation before and after each of its steps
+    (processes and storage of period data): the resident memory (RSS) of the
+    process, its high-water mark and the bytes used by the arrays of the
+    entities (main arrays, temporary variables, lag arrays, indexes and
+    caches).
+    """
+    columns = (('run', 'period', 'step', 'rss_before', 'rss_after',
+                'peak_rss') + CATEGORIES + ('total',))
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.rows = []
+        # high-water mark of the temporary variables during the current step
+        self.temp_variables_peak = 0
+        # (bytes, run, period, step) of the high-water marks
+        self.peak_rss = None
+        self.peak_arrays = None
+
+    def record_temp_variables(self, other_variables=None):
+        """
+        updates the high-water mark of the temporary variables of the
+        entities (and of other_variables, a dict of variables which are not
+        in the entities at this point, e.g. the local variables of the caller
+        of a function). This must be called before they are purged (at the
+        end of each process), otherwise the snapshot taken after the step
+        would never see them.
+        """
+        seen = set()
+        # temporary variables can be views of the fields of the entities
+        for entity in self.entities:
+            arrays_nbytes(entity.array, seen)
+        nbytes = sum(arrays_nbytes(entity.temp_variables, seen)
+                     for entity in self.entities)
+        nbytes += arrays_nbytes(other_variables, seen)
+        self.temp_variables_peak = max(self.temp_variables_peak, nbytes)
+
+    def track(self, run, period, step, func, *args, **kwargs):
+        self.temp_variables_peak = 0
+        rss_before = mem_usage()
+        res = func(*args, **kwargs)
+        rss_after = mem_usage()
+        peak_after = peak_mem_usage()
+        # the high-water mark is not measured the same way as the current
+        # usage, so it can be (slightly) lower than it
+        if peak_after is None or \
+                (rss_after is not None and rss_after > peak_after):
+            peak_after = rss_after
+
+        sizes = memory_snapshot(self.entities)
+        # the temporary variables of the step were purged before the snapshot
+        sizes['temp_variables'] = max(sizes['temp_variables'],
+                                      self.temp_variables_peak)
+        total = sum(sizes.values())
+        self.rows.append((run, period, step, rss_before, rss_after,
+                          peak_after) + tuple(sizes.values()) + (total,))
+
+        # the step which raised the high-water mark of the process is the one
+        # which triggered the peak memory usage
+        if peak_after is not None and \
+                (self.peak_rss is None or peak_after > self.peak_rss[0]):
+            self.peak_rss = (peak_after, run, period, step)
+        if self.peak_arrays is None or total > self.peak_arrays[0]:
+            self.peak_arrays = (total, run, period, step)
+        return res
+
+    def dump(self, fpath):
+        with open(fpath, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(self.rows)
+        print("memory usage written to '%s'" % fpath)
+
+    def show_peaks(self):
+        for what, peak in (('memory', self.peak_rss),
+                           ('arrays memory', self.peak_arrays)):
+            if peak is not None:
+                size, run, period, step = peak
+                print("peak %s: %s (run %d, period %d, %s)"
+                      % (what, size2str(size), run + 1, period, step))
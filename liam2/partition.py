@@ -11,6 +11,49 @@ except ImportError:
     def filter_to_indices(filter_value):
         return filter_value.nonzero()[0]
 
+
+def group_labels(columns, filter_value, possible_values):
+    """
+    returns the (flat) group number of each individual, in a single pass over
+    each column (using a binary search in its possible values). Groups are
+    numbered like the combinations of possible values, the first column being
+    the outer-most "loop" and the last one the inner most. Individuals which
+    are not selected by filter_value or whose values are not among the
+    possible values get -1.
+    """
+    arrays = np.broadcast_arrays(filter_value, *columns)
+    filter_value, columns = arrays[0], arrays[1:]
+    labels = np.zeros(filter_value.shape, dtype=int)
+    valid = filter_value.astype(bool)
+    for coldata, colvalues in zip(columns, possible_values):
+        colvalues = np.asarray(colvalues)
+        if not len(colvalues):
+            valid[:] = False
+            continue
+        # possible values are usually sorted, but they do not need to
+        sorter = colvalues.argsort(kind='mergesort')
+        sorted_values = colvalues[sorter]
+        pos = np.searchsorted(sorted_values, coldata)
+        np.minimum(pos, len(colvalues) - 1, out=pos)
+        valid &= sorted_values[pos] == coldata
+        labels *= len(colvalues)
+        labels += sorter[pos]
+    labels[~valid] = -1
+    return labels
+
+
+def split_by_label(labels, num_groups):
+    """
+    returns the list of the indices of the individuals of each group, given
+    the group number of each individual (-1 for those in no group). Indices
+    are sorted within each group.
+    """
+    order = labels.argsort(kind='mergesort')
+    bounds = np.bincount(labels + 1, minlength=num_groups + 1).cumsum()
+    # the first chunk contains individuals which are not in any group
+    return np.split(order, bounds[:-1])[1:]
+
+
 try:
     from cpartition import group_indices_nd
 
@@ -47,85 +90,66 @@ except ImportError:
           values for each column
         * returns a 1d array of lists of indices
         """
-        # make a copy of non contiguous columns. It is only worth it when the
-        # number of possible values for that column is large enough to
-        # compensate for the cost of the copy, and it is usually the case.
-        # XXX: we might want to be more precise about this.
-        # 1e5 arrays
-        # * not aligned (nor contiguous): always worth it
-        # * aligned but not contiguous: never worth it
-        # 1e6 arrays
-        # * not aligned (nor contiguous): worth it from 6 values
-        # * aligned but not contiguous: worth it from 12 values
-        contiguous_columns = []
-        for col in columns:
-            if isinstance(col, np.ndarray) and col.shape:
-                if not col.flags.contiguous:
-                    col = col.copy()
-            else:
-                col = [col]
-            contiguous_columns.append(col)
-        columns = contiguous_columns
-
-        size = tuple([len(colvalues) for colvalues in possible_values])
-
-        result = []
-
-        # for each combination of i, j, k:
-        for idx in np.ndindex(*size):
-            # local_filter = filter & (data0 == values0[i])
-            #                       & (data1 == values1[j])
-            # it is a bit faster to do: v = expr; v &= b
-            # than
-            # v = copy(b); v &= expr
-            parts = zip(idx, possible_values, columns)
-            if parts:
-                first_i, first_colvalues, first_coldata = parts[0]
-                local_filter = first_coldata == first_colvalues[first_i]
-                for i, colvalues, coldata in parts[1:]:
-                    local_filter &= coldata == colvalues[i]
-                local_filter &= filter_value
-            else:
-                # filter_value can be a simple boolean, in that case, we
-                # get a 0-d array.
-                local_filter = np.copy(filter_value)
-
-            if local_filter.shape:
-                group_indices = filter_to_indices(local_filter)
-            else:
-                # local_filter = True
-                assert local_filter
-                group_indices = np.arange(len(columns[0]))
-            result.append(group_indices)
-        return result
-
-        # pure-python version. It is 10x slower than the NumPy version above
-        # but it might be a better starting point to translate to C,
-        # especially given that the possible_values are usually sorted (we
-        # could sort them too), so we could use some bisect algorithm to find
-        # which category it belongs to. python built-in bisect is faster
-        # (average time on all indexes) than list.index() starting from ~20
-        # elements. We usually have even less elements than that though :(.
-        # Strangely bisect on a list is 2x faster than np.searchsorted on an
-        # array, even with large array sizes (10^6).
-#        fill_with_empty_list = np.frompyfunc(lambda _: [], 1, 1)
-#        fill_with_empty_list(result, result)
-#
-#        for idx, row in enumerate(izip(*columns)):
-#            # returns a tuple with the position of the group this row belongs
-#            # to. eg. (0, 1, 5)
-#            # XXX: this uses strict equality, partitioning using
-#            # inequalities might be useful in some cases
-#            if filter[idx]:
-#                try:
-#                    # pos = tuple([values_i.index(vi) for vi, values_i
-#                    pos = tuple([np.searchsorted(values_i, vi)
-#                                 for vi, values_i
-#                                 in izip(row, possible_values)])
-#                    result[pos].append(idx)
-#                except ValueError:
-#                    # XXX: issue a warning?
-#                    pass
-#        for idx in np.ndindex(*size):
-#            result[idx] = np.array(result[idx])
-#        return np.ravel(result)
+        labels = group_labels(columns, filter_value, possible_values)
+        num_groups = int(np.prod([len(pv) for pv in possible_values]))
+        return split_by_label(labels, num_groups)
+
+
+def observed_group_labels(columns):
+    """
+    groups individuals by the combinations of values of columns which are
+    actually present, without building all the combinations of possible
+    values (individuals with a missing value are not in any group).
+
+    returns (row_keys, last_values, labels) where row_keys are the observed
+    combinations of values of all columns but the last (as tuples), sorted,
+    last_values are the observed values of the last column, sorted, and labels
+    is the (flat) group number of each individual in a table with one row per
+    row key and one column per value of the last column (-1 for individuals
+    which are not in any group).
+    """
+    assert len(columns) > 0
+    if group_indices_nd is not None:
+        groups = group_indices_nd(columns, True)
+        if len(columns) == 1:
+            # keys are single values instead of tuples in that case
+            groups = {(key,): indices for key, indices in groups.iteritems()}
+        row_keys = sorted(set(key[:-1] for key in groups))
+        last_values = sorted(set(key[-1] for key in groups))
+        row_index = {key: i for i, key in enumerate(row_keys)}
+        col_index = {value: i for i, value in enumerate(last_values)}
+        width = len(last_values)
+        labels = np.full(len(columns[0]), -1, dtype=int)
+        for key, indices in groups.iteritems():
+            labels[indices] = row_index[key[:-1]] * width + \
+                col_index[key[-1]]
+        return row_keys, last_values, labels
+
+    # use the code of each value in its column and combine codes
+    present = np.ones(len(columns[0]), dtype=bool)
+    uniques, codes = [], []
+    for column in columns:
+        if column.dtype.kind == 'f':
+            present &= ~np.isnan(column)
+        colvalues, colcodes = np.unique(column, return_inverse=True)
+        uniques.append(colvalues)
+        codes.append(colcodes)
+    row_code = np.zeros(len(present), dtype=np.int64)
+    for colvalues, colcodes in zip(uniques[:-1], codes[:-1]):
+        row_code *= len(colvalues)
+        row_code += colcodes
+    used_row_codes, row_labels = np.unique(row_code[present],
+                                           return_inverse=True)
+    used_last_codes, last_labels = np.unique(codes[-1][present],
+                                             return_inverse=True)
+    if len(columns) > 1:
+        row_key_codes = np.unravel_index(used_row_codes,
+                                         [len(v) for v in uniques[:-1]])
+        row_keys = zip(*[colvalues[keycodes] for colvalues, keycodes
+                         in zip(uniques[:-1], row_key_codes)])
+    else:
+        row_keys = [()] * len(used_row_codes)
+    last_values = list(uniques[-1][used_last_codes])
+    labels = np.full(len(present), -1, dtype=int)
+    labels[present] = row_labels * len(last_values) + last_labels
+    return row_keys, last_values, labels
@@ -0,0 +1,322 @@
+# encoding: utf-8
+from __future__ import division, print_function
+
+import math
+
+import numpy as np
+import tables
+
+from data import copy_table
+from idshrinker import parse_toshrink, link_targets
+from importer import chunks_to_table
+from utils import timed
+
+__version__ = "0.1"
+
+# number of rows generated at once (per entity)
+CHUNK_ROWS = 2 ** 18
+
+
+def period_blocks(table):
+    """
+    yields the (start, stop) rows of each period of table (whose rows are
+    sorted by period)
+    """
+    periods = table.col('period')
+    bounds = np.flatnonzero(np.diff(periods)) + 1
+    starts = [0] + list(bounds)
+    stops = list(bounds) + [len(periods)]
+    return zip(starts, stops) if len(periods) else []
+
+
+def exclusive_cumsum(a):
+    """
+    >>> exclusive_cumsum(np.array([3, 1, 2]))
+    array([0, 3, 4])
+    """
+    res = np.zeros(len(a), dtype=np.int64)
+    np.cumsum(a[:-1], out=res[1:])
+    return res
+
+
+def gather_groups(starts, counts):
+    """
+    returns the concatenation of the ranges [start, start + count[ and, for
+    each element, the number of the range it comes from
+
+    >>> gather_groups(np.array([5, 0, 2]), np.array([2, 0, 3]))
+    (array([5, 6, 2, 3, 4]), array([0, 0, 2, 2, 2]))
+    """
+    group = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(counts.sum()) - np.repeat(exclusive_cumsum(counts),
+                                                 counts)
+    return starts[group] + within, group
+
+
+class EntityUnits(object):
+    """
+    ids of an entity in the template, the unit (group of individuals copied
+    together) each of them belongs to and its position within that unit
+    """
+    def __init__(self, table, unit_ids=None, first_unit=0):
+        """
+        unit_ids is an array with the id of the unit of each row of table.
+        Individuals belong to the unit of their last row. Those with a
+        missing unit (-1) form their own unit, numbered from first_unit. If
+        unit_ids is None, all individuals belong to unit 0.
+        """
+        self.name = table.name
+        row_ids = table.col('id')
+        # ids are unique per entity, not per row (there can be several
+        # periods)
+        self.ids, last_rows = np.unique(row_ids[::-1], return_index=True)
+        if unit_ids is None:
+            units = np.zeros(len(self.ids), dtype=np.int64)
+        else:
+            units = unit_ids[len(row_ids) - 1 - last_rows].astype(np.int64)
+            missing = units == -1
+            units[missing] = first_unit + np.arange(missing.sum())
+        self.units = units
+        num_units = units.max() + 1 if len(units) else 0
+        self.counts = np.bincount(units, minlength=num_units)
+        order = np.argsort(units, kind='mergesort')
+        self.positions = np.empty(len(units), dtype=np.int64)
+        self.positions[order] = np.arange(len(units)) - \
+            exclusive_cumsum(self.counts)[units[order]]
+
+    def rows_index(self, ids):
+        """
+        returns the index of ids in self.ids and whether they were found
+        """
+        idx = np.searchsorted(self.ids, ids)
+        np.clip(idx, 0, max(len(self.ids) - 1, 0), out=idx)
+        found = self.ids[idx] == ids if len(self.ids) else \
+            np.zeros(len(ids), dtype=bool)
+        return idx, found
+
+
+def draw_units(num_units, counts, size, rng):
+    """
+    draws units (uniformly, with replacement) until the units drawn contain
+    at least size individuals (counts being the number of individuals in each
+    unit)
+    """
+    draws = []
+    total = 0
+    mean_count = max(counts.mean(), 1) if len(counts) else 1
+    while total < size:
+        num_draws = int(math.ceil((size - total) / mean_count)) + 1
+        new_draws = rng.randint(num_units, size=num_draws)
+        cumcounts = total + np.cumsum(counts[new_draws])
+        stop = np.searchsorted(cumcounts, size) + 1
+        draws.append(new_draws[:stop])
+        total = cumcounts[min(stop, num_draws) - 1]
+    return np.concatenate(draws)
+
+
+def generate_population(input_path, output_path, link_fields, copies=None,
+                        size=None, cluster_entity=None, seed=None,
+                        chunk_rows=CHUNK_ROWS):
+    """
+    generates an input file (output_path) using input_path as a template.
+
+    link_fields is a {entity_name: {field_name: target_entity_name}}
+    dictionary of the fields containing ids (of target_entity_name).
+
+    By default, the whole population of the template is replicated copies
+    times (or as many times as needed to get approximately size individuals
+    in its largest entity). The individuals of each copy get new ids, and
+    link fields are remapped accordingly, so that each copy is an independent
+    population.
+
+    If cluster_entity (e.g. household) is given, the individuals of
+    cluster_entity are resampled (with replacement) instead, until there are
+    at least size individuals (copies times the template individuals if size
+    is None) in the largest entity. The individuals of other entities are
+    drawn together with the cluster they belong to, via their link to
+    cluster_entity (individuals without cluster are drawn alone). Links
+    pointing outside of the cluster of an individual are set to -1. Entities
+    without any link to cluster_entity (e.g. region) are copied unchanged.
+
+    The rows of all periods of the template are generated, chunk by chunk,
+    so that the output does not need to fit in memory. Returns the number of
+    individuals of each entity as a {entity_name: count} dictionary.
+    """
+    if copies is None and size is None:
+        raise ValueError("either copies or size must be given")
+    input_file = tables.open_file(input_path)
+    output_file = tables.open_file(output_path, mode="w")
+    try:
+        if hasattr(input_file.root, 'globals'):
+            # noinspection PyProtectedMember
+            input_file.root.globals._f_copy(output_file.root, recursive=True)
+
+        input_tables = list(input_file.iter_nodes(input_file.root.entities))
+        print(" * indexing template")
+        entities = {}
+        if cluster_entity is None:
+            for table in input_tables:
+                entities[table.name] = EntityUnits(table)
+            num_units = 1
+        else:
+            tables_by_name = {table.name: table for table in input_tables}
+            if cluster_entity not in tables_by_name:
+                raise Exception("entity '%s' not found in '%s'"
+                                % (cluster_entity, input_path))
+            cluster_table = tables_by_name[cluster_entity]
+            row_ids = cluster_table.col('id')
+            # each individual of cluster_entity is a unit (numbered by its
+            # position in the sorted ids)
+            clusters = EntityUnits(cluster_table,
+                                   np.searchsorted(np.unique(row_ids),
+                                                   row_ids))
+            entities[cluster_entity] = clusters
+            num_units = len(clusters.ids)
+            for table in input_tables:
+                if table.name == cluster_entity:
+                    continue
+                fields = [fname for fname, target
+                          in link_fields.get(table.name, {}).iteritems()
+                          if target == cluster_entity]
+                if not fields:
+                    continue
+                cluster_idx, found = clusters.rows_index(table.col(fields[0]))
+                unit_ids = np.where(found, cluster_idx, -1)
+                entity = EntityUnits(table, unit_ids, num_units)
+                entities[table.name] = entity
+                num_units = max(num_units, len(entity.counts))
+
+        # draw the units to generate
+        counts = {name: np.bincount(entity.units, minlength=num_units)
+                  for name, entity in entities.iteritems()}
+        largest = max(entities, key=lambda name: len(entities[name].ids))
+        num_largest = len(entities[largest].ids)
+        if cluster_entity is None:
+            if copies is None:
+                copies = max(int(round(size / num_largest)), 1) \
+                    if num_largest else 1
+            draws = np.zeros(copies, dtype=np.int64)
+        else:
+            if size is None:
+                size = copies * num_largest
+            rng = np.random.RandomState(seed)
+            draws = draw_units(num_units, counts[largest], size, rng)
+        # the ids of the individuals drawn with the nth unit start at
+        # base_ids[n]
+        base_ids = {name: exclusive_cumsum(counts[name][draws])
+                    for name in entities}
+
+        output_entities = output_file.create_group("/", "entities", "Entities")
+        for table in input_tables:
+            if table.name not in entities:
+                print(" * copying %s" % table.name)
+                copy_table(table, output_entities)
+                continue
+            print(" * generating %s" % table.name)
+            entity = entities[table.name]
+            fields = [(fname, target) for fname, target
+                      in link_fields.get(table.name, {}).iteritems()
+                      if fname in table.dtype.names and target in entities]
+            blocks = period_blocks(table)
+            period_units = []
+            numlines = 0
+            for start, stop in blocks:
+                idx, _ = entity.rows_index(table.read(start, stop, field='id'))
+                units = entity.units[idx]
+                row_counts = np.bincount(units, minlength=num_units)[draws]
+                period_units.append((idx, units, row_counts))
+                numlines += row_counts.sum()
+
+            def generated_chunks():
+                for (start, stop), (idx, units, row_counts) \
+                        in zip(blocks, period_units):
+                    block = table.read(start, stop)
+                    # rows of the period sorted by unit
+                    order = np.argsort(units, kind='mergesort')
+                    unit_starts = exclusive_cumsum(
+                        np.bincount(units, minlength=num_units))
+                    # split draws in chunks of approximately chunk_rows rows
+                    cum_rows = np.cumsum(row_counts)
+                    bounds = np.searchsorted(
+                        cum_rows, np.arange(chunk_rows, cum_rows[-1]
+                                            if len(cum_rows) else 0,
+                                            chunk_rows))
+                    draw_bounds = [0] + list(bounds + 1) + [len(draws)]
+                    for first, last in zip(draw_bounds[:-1], draw_bounds[1:]):
+                        if first >= last:
+                            continue
+                        chunk_draws = draws[first:last]
+                        positions, draw_num = gather_groups(
+                            unit_starts[chunk_draws],
+                            row_counts[first:last])
+                        rows = order[positions]
+                        draw_num += first
+                        chunk = block[rows]
+                        chunk['id'] = base_ids[table.name][draw_num] + \
+                            entity.positions[idx[rows]]
+                        for fname, target in fields:
+                            target_entity = entities[target]
+                            column = chunk[fname]
+                            tidx, found = target_entity.rows_index(column)
+                            # links to individuals which are not drawn with
+                            # the individual are lost
+                            valid = found & (target_entity.units[tidx] ==
+                                             draws[draw_num])
+                            chunk[fname] = np.where(
+                                valid,
+                                base_ids[target][draw_num] +
+                                target_entity.positions[tidx],
+                                -1)
+                        yield chunk
+
+            fields_desc = [(name, table.dtype[name])
+                           for name in table.dtype.names]
+            # noinspection PyProtectedMember
+            chunks_to_table(output_file, output_entities, table.name,
+                            fields_desc, generated_chunks(), numlines,
+                            title=table._v_title)
+        return {name: int(counts[name][draws].sum()) for name in entities}
+    finally:
+        input_file.close()
+        output_file.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import platform
+
+    print("LIAM2 HDF5 population generator %s using Python %s (%s)\n" %
+          (__version__, platform.python_version(), platform.architecture()[0]))
+
+    parser = argparse.ArgumentParser(
+        description="generates an input file of any size using an existing "
+                    "input file as a template")
+    parser.add_argument('inputpath', help='template input file')
+    parser.add_argument('outputpath', help='output file')
+    parser.add_argument('links',
+                        help="link fields, as "
+                             "entityname1:[entityname2.]linkfield1,"
+                             "linkfield2;entityname2:... (like for "
+                             "idshrinker), e.g. "
+                             "person:mother_id,partner_id;"
+                             "household:person.hh_id")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--copies', type=int,
+                       help='number of copies of the template population')
+    group.add_argument('--size', type=int,
+                       help='number of individuals (of the largest entity)')
+    parser.add_argument('--resample', metavar='ENTITY',
+                        help='resample the individuals of ENTITY (e.g. '
+                             'household) and their members instead of '
+                             'replicating the whole population')
+    parser.add_argument('--seed', type=int,
+                        help='seed of the random number generator used when '
+                             'resampling')
+    args = parser.parse_args()
+
+    counts = timed(generate_population, args.inputpath, args.outputpath,
+                   link_targets(parse_toshrink(args.links)),
+                   copies=args.copies, size=args.size,
+                   cluster_entity=args.resample, seed=args.seed)
+    for name, count in sorted(counts.iteritems()):
+        print("%s: %d individuals" % (name, count))
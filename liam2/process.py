@@ -6,6 +6,7 @@ import collections
 import numpy as np
 
 import config
+import profiler
 from diff_h5 import diff_array
 from data import append_carray_to_table, ColumnArray
 from expr import Expr, Variable, type_to_idx, idx_to_type, expr_eval, expr_cache
@@ -143,6 +144,35 @@ class While(Process):
             yield e
 
 
+def subprocess_label(name, process):
+    """
+    returns the label of a "line" of a process group in simulation profiles
+    """
+    if isinstance(process, Assignment):
+        label = str(process.expr)
+        if name is not None:
+            label = '%s: %s' % (name, label)
+    elif isinstance(process, While):
+        label = 'while %s' % process.cond
+    elif isinstance(process, Return):
+        label = 'return %s' % process.result_expr
+    else:
+        label = name if name is not None else process.__class__.__name__
+    return profiler.clean_label(label)
+
+
+def purge_locals(entity, context, backup=None):
+    """
+    purges the local variables of entity. If the memory usage is tracked,
+    the memory they use (and the memory used by the variables in backup, if
+    any) is recorded first.
+    """
+    memory_tracker = context.simulation.memory_tracker
+    if memory_tracker is not None:
+        memory_tracker.record_temp_variables(backup)
+    entity.purge_locals()
+
+
 class ProcessGroup(Process):
     def __init__(self, name, entity, subprocesses, purge=True):
         super(ProcessGroup, self).__init__(name, entity)
@@ -150,6 +180,7 @@ class ProcessGroup(Process):
         self.calls = collections.Counter()
         self.purge = purge
         self.versions = {}
+        self._profile_labels = None
 
     def run_guarded(self, context):
         period = context.period
@@ -158,14 +189,14 @@ class ProcessGroup(Process):
             print()
 
         try:
-            for k, v in self.subprocesses:
+            for i, (k, v) in enumerate(self.subprocesses):
                 if config.log_level == "processes":
                     print("    *", end=' ')
                     if k is not None:
                         print(k, end=' ')
-                    utils.timed(v.run_guarded, context)
+                    utils.timed(self._run_subprocess, i, v, context)
                 else:
-                    v.run_guarded(context)
+                    self._run_subprocess(i, v, context)
                     #            print "done."
                 context.simulation.start_console(context)
         finally:
@@ -176,7 +207,17 @@ class ProcessGroup(Process):
                 self._autodiff(period)
 
             if self.purge:
-                self.entity.purge_locals()
+                purge_locals(self.entity, context)
+
+    def _run_subprocess(self, i, process, context):
+        if profiler.current is None:
+            process.run_guarded(context)
+        else:
+            if self._profile_labels is None:
+                self._profile_labels = [subprocess_label(k, v)
+                                        for k, v in self.subprocesses]
+            profiler.current.call(self._profile_labels[i],
+                                  process.run_guarded, context)
 
     @property
     def predictors(self):
@@ -362,7 +403,7 @@ class Function(Process):
             result = expr_eval(self.result, context)
         except ReturnException as r:
             result = r.result
-        self.purge_and_restore_locals(backup)
+        self.purge_and_restore_locals(backup, context)
         return result
 
     def expressions(self):
@@ -379,9 +420,9 @@ class Function(Process):
             backup[name] = self.entity.temp_variables.pop(name)
         return backup
 
-    def purge_and_restore_locals(self, backup):
+    def purge_and_restore_locals(self, backup, context):
         # purge the local from the function we just ran
-        self.entity.purge_locals()
+        purge_locals(self.entity, context, backup)
         # restore local variables for our caller
         for k, v in backup.iteritems():
             self.entity.temp_variables[k] = v
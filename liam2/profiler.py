@@ -0,0 +1,156 @@
+# encoding: utf-8
+from __future__ import division, print_function
+
+import json
+import time
+from collections import OrderedDict, Counter
+
+import numpy as np
+
+# the profiler of the simulation being run (None when not profiling)
+current = None
+
+# maximum length of labels (expressions can be very long)
+MAX_LABEL_LENGTH = 80
+
+
+def clean_label(label):
+    """
+    makes label usable in a folded-stack file (where ';' separates frames
+    and a space precedes the count)
+
+    >>> clean_label('x: a;b\\nc')
+    'x: a,b c'
+    """
+    label = ' '.join(str(label).replace(';', ',').split())
+    if len(label) > MAX_LABEL_LENGTH:
+        label = label[:MAX_LABEL_LENGTH - 3] + '...'
+    return label
+
+
+class ProfileNode(object):
+    def __init__(self, label):
+        self.label = label
+        self.calls = 0
+        # inclusive wall time, in seconds
+        self.time = 0.0
+        # total number of elements of the arrays returned by all the calls
+        self.size = 0
+        self.children = OrderedDict()
+
+    def child(self, label):
+        node = self.children.get(label)
+        if node is None:
+            node = ProfileNode(label)
+            self.children[label] = node
+        return node
+
+    @property
+    def exclusive_time(self):
+        return max(self.time - sum(c.time for c in self.children.values()),
+                   0.0)
+
+    def to_dict(self):
+        return OrderedDict([
+            ('name', self.label),
+            ('calls', self.calls),
+            ('inclusive', self.time),
+            ('exclusive', self.exclusive_time),
+            ('avg_size', self.size / self.calls if self.calls else 0),
+            ('children', [c.to_dict() for c in self.children.values()])
+        ])
+
+    def exclusive_times(self, times):
+        times[self.label] += self.exclusive_time
+        for child in self.children.values():
+            child.exclusive_times(times)
+
+    def folded_lines(self, prefix=''):
+        stack = prefix + self.label
+        # flame graph tools expect integer counts: use microseconds
+        exclusive = int(round(self.exclusive_time * 1e6))
+        if exclusive:
+            yield '%s %d' % (stack, exclusive)
+        for child in self.children.values():
+            for line in child.folded_lines(stack + ';'):
+                yield line
+
+
+class Profiler(object):
+    """
+    records the time spent in each process, function, expression line and
+    builtin function of a simulation as a call tree. Each node of the tree
+    knows its inclusive time (including its children), its exclusive time
+    (excluding them), its number of calls and the average size of the arrays
+    it returned.
+    """
+    def __init__(self, label='simulation'):
+        self.root = ProfileNode(label)
+        self.root.calls = 1
+        self.stack = [self.root]
+        self.start_time = time.time()
+
+    def call(self, label, func, *args, **kwargs):
+        node = self.stack[-1].child(label)
+        self.stack.append(node)
+        start = time.time()
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            node.time += time.time() - start
+            node.calls += 1
+            self.stack.pop()
+        if isinstance(res, np.ndarray):
+            node.size += res.size
+        return res
+
+    def stop(self):
+        self.root.time = time.time() - self.start_time
+
+    def exclusive_times(self):
+        """
+        returns a Counter with the total exclusive time of each expression
+        label (in all the places of the tree where it appears). The children
+        of the root are the steps of the simulation (loading data, running a
+        process, storing data, ...) so they are not included (but their
+        children are).
+        """
+        times = Counter()
+        for step in self.root.children.values():
+            for child in step.children.values():
+                child.exclusive_times(times)
+        return times
+
+    def dump_json(self, fpath):
+        with open(fpath, 'w') as f:
+            json.dump(self.root.to_dict(), f, indent=1)
+
+    def dump_folded(self, fpath):
+        """
+        writes the profile in the "folded stacks" format used by flame graph
+        tools (e.g. flamegraph.pl or speedscope)
+        """
+        with open(fpath, 'w') as f:
+            for line in self.root.folded_lines():
+                f.write(line + '\n')
+
+    def dump(self, root_path):
+        """
+        writes the profile to root_path.json and root_path.folded
+        """
+        self.stop()
+        json_path = root_path + '.json'
+        folded_path = root_path + '.folded'
+        self.dump_json(json_path)
+        self.dump_folded(folded_path)
+        print("profile written to '%s' and '%s'" % (json_path, folded_path))
+
+
+def profiled(label, func, *args, **kwargs):
+    """
+    calls func(*args, **kwargs), recording it in the current profile (if any)
+    under label (which should have been cleaned by clean_label if necessary)
+    """
+    if current is None:
+        return func(*args, **kwargs)
+    return current.call(label, func, *args, **kwargs)
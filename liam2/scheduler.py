@@ -0,0 +1,127 @@
+# encoding: utf-8
+from __future__ import print_function
+
+from actions import Show, RemoveIndividuals, Breakpoint, Assert
+from alignment import AlignmentAbsoluteValues
+from expr import Expr, Variable, MethodCall
+from exprbases import NumpyRandom
+from exprmisc import New, Seed
+from links import LinkExpression
+from matching import Matching
+from process import Assignment, ProcessGroup, While, Function
+from regressions import Regression, LogitScore
+from utils import FileProducer
+
+# expressions which use random numbers, have side effects on other entities
+# or produce output (on screen or in files). Processes containing any of them
+# are never executed concurrently with other processes, so that the random
+# numbers they use and the order of their output do not change.
+BARRIER_NODES = (NumpyRandom, Seed, AlignmentAbsoluteValues, Matching,
+                 Regression, LogitScore, New, RemoveIndividuals, Show,
+                 Breakpoint, Assert, FileProducer)
+
+
+class ProcessAccesses(object):
+    """
+    fields read and written by a process (and the functions it calls) as
+    sets of (entity_name, field_name) tuples
+    """
+    def __init__(self, process):
+        self.entity_name = process.entity.name
+        self.reads = set()
+        self.writes = set()
+        self.barrier = False
+        self._seen = set()
+        self._add_process(process)
+
+    def _add_process(self, process):
+        if id(process) in self._seen:
+            return
+        self._seen.add(id(process))
+        if isinstance(process, Assignment) and process.name is not None:
+            self.writes.add((process.entity.name, process.name))
+        if isinstance(process, ProcessGroup):
+            for _, subprocess in process.subprocesses:
+                self._add_process(subprocess)
+        elif isinstance(process, (While, Function)) and \
+                process.code is not None:
+            self._add_process(process.code)
+        try:
+            expressions = list(process.expressions())
+        except NotImplementedError:
+            # unknown kind of process
+            self.barrier = True
+            return
+        for expr in expressions:
+            self._add_expr(expr, process.entity)
+
+    def _add_expr(self, expr, entity):
+        if isinstance(expr, (tuple, list)):
+            for e in expr:
+                self._add_expr(e, entity)
+            return
+        if not isinstance(expr, Expr):
+            return
+        for node in expr.traverse():
+            if isinstance(node, BARRIER_NODES):
+                self.barrier = True
+            elif isinstance(node, MethodCall):
+                if node.entity.name != self.entity_name:
+                    # the method of another entity would run in our context
+                    self.barrier = True
+                else:
+                    self._add_process(node.entity.processes[node.name])
+            elif isinstance(node, LinkExpression):
+                # link expressions do not traverse their arguments
+                link = node.link
+                # noinspection PyProtectedMember
+                target_entity = link._target_entity
+                # noinspection PyProtectedMember
+                link_field = link._link_field
+                # we do not care whether the link field is in the source
+                # (many2one) or target (one2many) entity
+                self.reads.add((entity.name, link_field))
+                self.reads.add((target_entity.name, link_field))
+                self._add_expr(node.args[1:], target_entity)
+                self._add_expr([v for k, v in node.kwargs], target_entity)
+            elif isinstance(node, Variable):
+                var_entity = node.entity if node.entity is not None else entity
+                self.reads.add((var_entity.name, node.name))
+
+    @property
+    def entities(self):
+        return {self.entity_name} | {ent_name for ent_name, _ in self.writes}
+
+    def conflicts_with(self, other):
+        """
+        returns whether executing the two processes concurrently (or in a
+        different order) could change their results
+        """
+        return (self.barrier or other.barrier or
+                # processes of the same entity share their temporary variables
+                bool(self.entities & other.entities) or
+                bool(self.writes & other.reads) or
+                bool(self.reads & other.writes))
+
+
+def schedule_processes(processes):
+    """
+    groups processes (a list of (process, periodicity) tuples) in waves of
+    processes which can be executed concurrently. Each process is in the first
+    wave after all the processes it depends on, ie all the previous processes
+    which it conflicts with. Returns a list of waves, each wave being a list
+    of process numbers (starting at 1).
+    """
+    accesses = [ProcessAccesses(process) for process, _ in processes]
+    wave_of_process = []
+    for i, process_accesses in enumerate(accesses):
+        wave = 0
+        for j in range(i):
+            if accesses[j].conflicts_with(process_accesses):
+                wave = max(wave, wave_of_process[j] + 1)
+        wave_of_process.append(wave)
+    num_waves = max(wave_of_process) + 1 if processes else 0
+    waves = [[] for _ in range(num_waves)]
+    for p_num, wave in enumerate(wave_of_process, start=1):
+        waves[wave].append(p_num)
+    return waves
@@ -4,6 +4,8 @@ from __future__ import print_function, division
 import tempfile
 import time
 import os.path
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import operator
 from collections import defaultdict
 import random
@@ -13,17 +15,30 @@ import numpy as np
 import tables
 import yaml
 
+from alignment import AlignmentAbsoluteValues
 from context import EvaluationContext
-from data import VoidSource, H5Source, H5Sink
+from data import ColumnArray, VoidSource, H5Source, H5Sink
 from entities import Entity, global_symbols
+from memusage import MemoryTracker
+from profiler import Profiler, profiled
+from scheduler import schedule_processes
 from utils import (time2str, timed, gettime, validate_dict,
                    expand_wild, multi_get, multi_set,
                    merge_dicts, merge_items,
                    field_str_to_type, fields_yaml_to_type,
+                   derive_seed, seed_random_generators,
                    UserDeprecationWarning)
 import config
 import console
-import expr
+import profiler
+
+
+# simulation to run in the worker processes of Simulation.run_parallel
+_parallel_simulation = None
+
+
+def _run_parallel_worker(run_num):
+    return dict(_parallel_simulation.run_numbered(run_num))
 
 
 def show_top_times(what, times, count):
@@ -57,8 +72,9 @@ def show_top_processes(process_time, count):
     show_top_times('processes', process_times, count)
 
 
-def show_top_expr(count=None):
-    show_top_times('expressions', expr.timings.most_common(count), count)
+def show_top_expr(profile, count):
+    show_top_times('expressions', profile.exclusive_times().most_common(count),
+                   count)
 
 
 def expand_periodic_fields(content):
@@ -147,6 +163,7 @@ class Simulation(object):
                 '*': [None]  # Or(str, [str, int])
             }],
             'random_seed': int,
+            'random_streams': bool,
             '#input': {
                 'path': str,
                 '#file': str,
@@ -169,12 +186,17 @@ class Simulation(object):
             'autodump': None,
             'autodiff': None,
             'runs': int,
+            'parallel_runs': int,
+            'checkpoint_interval': int,
+            'concurrent_processes': int,
         }
     }
 
     def __init__(self, globals_def, periods, start_period, init_processes,
                  processes, entities, input_method, input_path, output_path,
-                 default_entity=None, runs=1, minimal_output=False):
+                 default_entity=None, runs=1, minimal_output=False,
+                 random_seed=None, random_streams=False, jobs=1,
+                 checkpoint_interval=None, concurrent_processes=1):
         if 'periodic' in globals_def:
             declared_fields = globals_def['periodic']['fields']
             fnames = {fname for fname, type_ in declared_fields}
@@ -205,6 +227,19 @@ class Simulation(object):
         self.stepbystep = False
         self.runs = runs
         self.minimal_output = minimal_output
+        self.random_seed = random_seed
+        # if True, each process uses its own stream of random numbers
+        self.random_streams = random_streams
+        # number of runs executed in parallel (in separate processes)
+        self.jobs = jobs
+        # number of periods between two checkpoints (None to disable them)
+        self.checkpoint_interval = checkpoint_interval
+        # maximum number of independent processes executed at the same time
+        self.concurrent_processes = concurrent_processes
+        # records the memory usage of each step (only when tracking memory)
+        self.memory_tracker = None
+        # summary of the last run (see run_single)
+        self.run_stats = None
 
     @classmethod
     def from_str(cls, yaml_str, simulation_dir='',
@@ -213,7 +248,7 @@ class Simulation(object):
                  start_period=None, periods=None, seed=None,
                  skip_shows=None, skip_timings=None, log_level=None,
                  assertions=None, autodump=None, autodiff=None,
-                 runs=None):
+                 runs=None, jobs=None, profile=False, track_memory=False):
         content = yaml.load(yaml_str)
         expand_periodic_fields(content)
         content = handle_imports(content, simulation_dir)
@@ -235,6 +270,11 @@ class Simulation(object):
         simulation_def = content['simulation']
         if seed is None:
             seed = simulation_def.get('random_seed')
+        random_streams = simulation_def.get('random_streams', False)
+        if seed is None and random_streams:
+            # the seed is needed to derive the seed of each stream. It is
+            # printed so that the simulation can be reproduced.
+            seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
         if seed is not None:
             seed = int(seed)
             print("using fixed random seed: %d" % seed)
@@ -293,6 +333,8 @@ class Simulation(object):
             # by default autodiff will compare all rows
             autodiff = (autodiff, None)
         config.autodiff = autodiff
+        config.profile = profile
+        config.track_memory = track_memory
 
         input_def = simulation_def['input']
         if input_dir is None:
@@ -318,16 +360,16 @@ class Simulation(object):
         minimal_output = False
         if output_file is None:
             output_file = output_def.get('file', '')
-            if output_file:
-                output_path = os.path.join(output_dir, output_file)
-            else:
-                # using a temporary directory instead of a temporary file
-                # because tempfile.* only returns file-like objects (which
-                # pytables does not support) or directories, not file names.
-                tmp_dir = tempfile.mkdtemp(prefix='liam2-', suffix='-tmp',
-                                           dir=output_dir)
-                output_path = os.path.join(tmp_dir, 'simulation.h5')
-                minimal_output = True
+        if output_file:
+            output_path = os.path.join(output_dir, output_file)
+        else:
+            # using a temporary directory instead of a temporary file
+            # because tempfile.* only returns file-like objects (which
+            # pytables does not support) or directories, not file names.
+            tmp_dir = tempfile.mkdtemp(prefix='liam2-', suffix='-tmp',
+                                       dir=output_dir)
+            output_path = os.path.join(tmp_dir, 'simulation.h5')
+            minimal_output = True
 
         entities = {}
         for k, v in content['entities'].iteritems():
@@ -436,9 +478,15 @@ class Simulation(object):
 
         if runs is None:
             runs = simulation_def.get('runs', 1)
+        if jobs is None:
+            jobs = simulation_def.get('parallel_runs', 1)
+        checkpoint_interval = simulation_def.get('checkpoint_interval')
+        concurrent_processes = simulation_def.get('concurrent_processes', 1)
         return Simulation(globals_def, periods, start_period, init_processes,
                           processes, entities_list, input_method, input_path,
-                          output_path, default_entity, runs, minimal_output)
+                          output_path, default_entity, runs, minimal_output,
+                          seed, random_streams, jobs, checkpoint_interval,
+                          concurrent_processes)
 
     @classmethod
     def from_yaml(cls, fpath,
@@ -447,7 +495,7 @@ class Simulation(object):
                   start_period=None, periods=None, seed=None,
                   skip_shows=None, skip_timings=None, log_level=None,
                   assertions=None, autodump=None, autodiff=None,
-                  runs=None):
+                  runs=None, jobs=None, profile=False, track_memory=False):
         with open(fpath) as f:
             return cls.from_str(f, os.path.dirname(os.path.abspath(fpath)),
                                 input_dir, input_file,
@@ -455,7 +503,7 @@ class Simulation(object):
                                 start_period, periods, seed,
                                 skip_shows, skip_timings, log_level,
                                 assertions, autodump, autodiff,
-                                runs)
+                                runs, jobs, profile, track_memory)
 
     def load(self):
         return timed(self.data_source.load, self.globals_def, self.entities_map)
@@ -464,29 +512,47 @@ class Simulation(object):
     def entities_map(self):
         return {entity.name: entity for entity in self.entities}
 
-    def run_single(self, run_console=False, run_num=None):
+    def run_single(self, run_console=False, run_num=None, resume=False):
         start_time = time.time()
-
-        input_dataset = timed(self.data_source.load,
-                              self.globals_def,
-                              self.entities_map)
+        memory_tracker = self.memory_tracker
+
+        def run_step(period, label, func, *args):
+            """
+            runs func(*args), recording it in the profile and the memory usage
+            report (if they are enabled)
+            """
+            if memory_tracker is not None:
+                return memory_tracker.track(run_num or 0, period, label,
+                                            profiled, label, func, *args)
+            return profiled(label, func, *args)
+
+        input_dataset = timed(run_step, self.start_period - 1,
+                              'load input data', self.data_source.load,
+                              self.globals_def, self.entities_map)
 
         globals_data = input_dataset.get('globals')
-        timed(self.data_sink.prepare, self.globals_def, self.entities_map,
-              input_dataset, self.start_period - 1)
-
-        print(" * building arrays for first simulated period")
-        for ent_name, entity in self.entities_map.iteritems():
-            print("    -", ent_name, "...", end=' ')
-            # TODO: this whole process of merging all periods is very
-            # opinionated and does not allow individuals to die/disappear
-            # before the simulation starts. We couldn't for example,
-            # take the output of one of our simulation and
-            # re-simulate only some years in the middle, because the dead
-            # would be brought back to life. In conclusion, it should be
-            # optional.
-            timed(entity.build_period_array, self.start_period - 1)
-        print("done.")
+        if resume:
+            print(" * restoring simulation state from checkpoint ...", end=' ')
+            checkpoint = timed(self.load_checkpoint, input_dataset)
+            print(" * resuming simulation after period %d"
+                  % checkpoint['period'])
+        else:
+            checkpoint = None
+            timed(self.data_sink.prepare, self.globals_def, self.entities_map,
+                  input_dataset, self.start_period - 1)
+
+            print(" * building arrays for first simulated period")
+            for ent_name, entity in self.entities_map.iteritems():
+                print("    -", ent_name, "...", end=' ')
+                # TODO: this whole process of merging all periods is very
+                # opinionated and does not allow individuals to die/disappear
+                # before the simulation starts. We couldn't for example,
+                # take the output of one of our simulation and
+                # re-simulate only some years in the middle, because the dead
+                # would be brought back to life. In conclusion, it should be
+                # optional.
+                timed(entity.build_period_array, self.start_period - 1)
+            print("done.")
 
         if config.autodump or config.autodiff:
             if config.autodump:
@@ -506,9 +572,56 @@ class Simulation(object):
 
         process_time = defaultdict(float)
         period_objects = {}
+        # the processes are executed in waves: all the processes of a wave can
+        # be executed concurrently (by a pool of threads)
+        if self.concurrent_processes > 1 and not config.autodump and \
+                not config.autodiff and config.log_level != "processes" and \
+                not config.profile and not config.track_memory:
+            thread_pool = ThreadPool(self.concurrent_processes)
+            init_waves = schedule_processes(self.init_processes)
+            main_waves = schedule_processes(self.processes)
+        else:
+            thread_pool = None
+            init_waves = [[p_num] for p_num
+                          in range(1, len(self.init_processes) + 1)]
+            main_waves = [[p_num] for p_num
+                          in range(1, len(self.processes) + 1)]
+        if checkpoint is not None:
+            process_time.update(checkpoint['process_time'])
+            period_objects.update(checkpoint['period_objects'])
         eval_ctx = EvaluationContext(self, self.entities_map, globals_data)
 
-        def simulate_period(period_idx, period, processes, entities,
+        def run_concurrently(wave, period_idx, processes):
+            """
+            runs the processes of wave (which do not depend on each other)
+            in the thread pool
+            """
+            def run_process(p_num):
+                process, periodicity = processes[p_num - 1]
+                if period_idx % periodicity != 0:
+                    return None
+                # each process needs its own current entity
+                context = eval_ctx.clone(entity_name=process.entity.name)
+                elapsed, _ = gettime(process.run_guarded, context)
+                return elapsed
+
+            elapsed_times = thread_pool.map(run_process, wave)
+            for p_num, elapsed in zip(wave, elapsed_times):
+                process = processes[p_num - 1][0]
+                if config.log_level in ("functions", "processes"):
+                    print("- %d/%d" % (p_num, len(processes)), process.name,
+                          "...", end=' ')
+                    if elapsed is None:
+                        print("skipped (periodicity)")
+                    elif config.show_timings:
+                        print("done concurrently (%s elapsed)."
+                              % time2str(elapsed))
+                    else:
+                        print("done concurrently.")
+                process_time[process.name] += elapsed or 0
+            self.start_console(eval_ctx)
+
+        def simulate_period(period_idx, period, processes, entities, waves,
                             init=False):
             period_start_time = time.time()
 
@@ -539,18 +652,42 @@ class Simulation(object):
 
             if processes:
                 num_processes = len(processes)
-                for p_num, process_def in enumerate(processes, start=1):
-                    process, periodicity = process_def
+                # number of times each process was executed in this period
+                process_calls = defaultdict(int)
+                for wave in waves:
+                    if len(wave) > 1:
+                        run_concurrently(wave, period_idx, processes)
+                        for p_num in wave:
+                            process = processes[p_num - 1][0]
+                            process_calls[(process.entity.name,
+                                           process.name)] += 1
+                        continue
+
+                    p_num = wave[0]
+                    process, periodicity = processes[p_num - 1]
 
                     # set current entity
                     eval_ctx.entity_name = process.entity.name
 
+                    if self.random_streams:
+                        # the random numbers used by a process do not depend
+                        # on the other processes (nor on their order), so that
+                        # it can be replayed or run in isolation
+                        key = (process.entity.name, process.name)
+                        seed = derive_seed(self.random_seed, run_num or 0,
+                                           period, key[0], key[1],
+                                           process_calls[key])
+                        process_calls[key] += 1
+                        seed_random_generators(seed)
+
                     if config.log_level in ("functions", "processes"):
                         print("- %d/%d" % (p_num, num_processes), process.name,
                               end=' ')
                         print("...", end=' ')
                     if period_idx % periodicity == 0:
-                        elapsed, _ = gettime(process.run_guarded, eval_ctx)
+                        label = '%s.%s' % (process.entity.name, process.name)
+                        elapsed, _ = gettime(run_step, period, label,
+                                             process.run_guarded, eval_ctx)
                     else:
                         elapsed = 0
                         if config.log_level in ("functions", "processes"):
@@ -568,11 +705,14 @@ class Simulation(object):
                 print("- storing period data")
                 for entity in entities:
                     print("  *", entity.name, "...", end=' ')
-                    timed(entity.store_period_data, period)
+                    timed(run_step, period,
+                          '%s.store_period_data' % entity.name,
+                          entity.store_period_data, period)
                     print("    -> %d individuals" % len(entity.array))
             else:
                 for entity in entities:
-                    entity.store_period_data(period)
+                    run_step(period, '%s.store_period_data' % entity.name,
+                             entity.store_period_data, period)
 #            print " - compressing period data"
 #            for entity in entities:
 #                print "  *", entity.name, "...",
@@ -606,14 +746,27 @@ class Simulation(object):
  starting simulation
 =====================""")
         try:
-            simulate_period(0, self.start_period - 1, self.init_processes,
-                            self.entities, init=True)
+            if checkpoint is None:
+                simulate_period(0, self.start_period - 1, self.init_processes,
+                                self.entities, init_waves, init=True)
             main_start_time = time.time()
             periods = range(self.start_period,
                             self.start_period + self.periods)
+            interval = self.checkpoint_interval
             for period_idx, period in enumerate(periods):
+                if checkpoint is not None and period <= checkpoint['period']:
+                    continue
                 simulate_period(period_idx, period,
-                                self.processes, self.entities)
+                                self.processes, self.entities, main_waves)
+                periods_done = period_idx + 1
+                if interval and periods_done % interval == 0 and \
+                        periods_done < self.periods:
+                    print("saving checkpoint ...", end=' ')
+                    state = {'process_time': dict(process_time),
+                             'period_objects': period_objects}
+                    timed(self.save_checkpoint, period, state)
+            if interval and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
 
             total_objects = sum(period_objects[period] for period in periods)
             avg_objects = str(total_objects // self.periods) \
@@ -621,6 +774,14 @@ class Simulation(object):
             main_elapsed_time = time.time() - main_start_time
             ind_per_sec = str(int(total_objects / main_elapsed_time)) \
                 if main_elapsed_time else 'inf'
+            self.run_stats = {
+                'elapsed': time.time() - start_time,
+                'individuals': total_objects // self.periods
+                if self.periods else 0,
+                'individuals_per_sec': total_objects / main_elapsed_time
+                if main_elapsed_time else None,
+                'process_time': dict(process_time)
+            }
 
             print("""
 ==========================================
@@ -633,8 +794,10 @@ class Simulation(object):
 """ % (time2str(time.time() - start_time), avg_objects, ind_per_sec))
 
             show_top_processes(process_time, 10)
-#            if config.debug:
-#                show_top_expr()
+            if profiler.current is not None:
+                show_top_expr(profiler.current, 10)
+            if memory_tracker is not None:
+                memory_tracker.show_peaks()
 
             if run_console:
                 ent_name = self.default_entity
@@ -649,24 +812,238 @@ class Simulation(object):
                                              entity_name=ent_name)
                 c = console.Console(console_ctx)
                 c.run()
+            return process_time
 
         finally:
+            if thread_pool is not None:
+                thread_pool.terminate()
             self.close()
             if h5_autodump is not None:
                 h5_autodump.close()
             if self.minimal_output:
                 output_path = self.data_sink.output_path
-                dirname = os.path.dirname(output_path)
                 try:
                     os.remove(output_path)
+                except OSError:
+                    print("WARNING: could not delete temporary file: %r"
+                          % output_path)
+
+    def run(self, run_console=False, resume=False):
+        runs = int(self.runs)
+        jobs = min(int(self.jobs), runs)
+        # when parallel runs are requested, each run has its own output file
+        # and random seed (even if they are finally executed one after the
+        # other). Other simulations with several runs are unchanged.
+        numbered_runs = jobs > 1
+        if runs > 1 or self.minimal_output:
+            if resume:
+                raise ValueError("only simulations with a single run and an "
+                                 "output file can be resumed")
+            if self.checkpoint_interval:
+                print("WARNING: checkpoints are disabled for simulations with "
+                      "several runs or without output file")
+                self.checkpoint_interval = None
+        if jobs > 1 and not hasattr(os, 'fork'):
+            print("WARNING: parallel runs are not supported on this platform, "
+                  "runs will be executed one after the other")
+            jobs = 1
+        if jobs > 1 and (config.profile or config.track_memory):
+            print("WARNING: parallel runs are disabled when profiling or "
+                  "tracking memory, runs will be executed one after the other")
+            jobs = 1
+        if config.profile:
+            profiler.current = Profiler()
+        if config.track_memory:
+            self.memory_tracker = MemoryTracker(self.entities)
+        if numbered_runs and self.random_seed is None:
+            # the seed of each run is derived from it
+            self.random_seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+            print("using random seed: %d" % self.random_seed)
+        try:
+            if jobs > 1:
+                if run_console:
+                    raise ValueError("the interactive console cannot be used "
+                                     "with parallel runs")
+                self.run_parallel(runs, jobs)
+            elif numbered_runs:
+                for i in range(runs):
+                    self.run_numbered(i, run_console)
+            else:
+                for i in range(runs):
+                    self.run_single(run_console, i, resume)
+        finally:
+            if profiler.current is not None:
+                # the profile is also written when the simulation fails
+                profiler.current.dump(self.report_path('profile'))
+                profiler.current = None
+            if self.memory_tracker is not None:
+                self.memory_tracker.dump(self.report_path('memory') + '.csv')
+                self.memory_tracker = None
+            if self.minimal_output:
+                dirname = os.path.dirname(self.data_sink.output_path)
+                try:
                     os.rmdir(dirname)
                 except OSError:
                     print("WARNING: could not delete temporary directory: %r"
                           % dirname)
 
-    def run(self, run_console=False):
-        for i in range(int(self.runs)):
-            self.run_single(run_console, i)
+    def report_path(self, name):
+        """
+        path (without extension) of the report files (profile, memory usage)
+        """
+        if self.minimal_output:
+            # the output directory is temporary
+            return os.path.join(config.output_directory, 'simulation_' + name)
+        root, _ = os.path.splitext(self.data_sink.output_path)
+        return '%s_%s' % (root, name)
+
+    @property
+    def checkpoint_path(self):
+        root, ext = os.path.splitext(self.data_sink.output_path)
+        return "%s_checkpoint%s" % (root, ext)
+
+    def alignment_nodes(self):
+        """
+        yields the alignment expressions of the model (which keep track of
+        their past errors), always in the same order
+        """
+        seen = set()
+        for entity in self.entities:
+            for name in sorted(entity.processes.keys()):
+                for expr in entity.processes[name].expressions():
+                    for node in expr.all_of(AlignmentAbsoluteValues):
+                        if id(node) not in seen:
+                            seen.add(id(node))
+                            yield node
+
+    def save_checkpoint(self, period, state):
+        """
+        saves everything which is needed to continue the simulation after
+        period, in addition to state (a dictionary)
+        """
+        output_rows = {}
+        tmp_path = self.checkpoint_path + '.tmp'
+        h5file = tables.open_file(tmp_path, mode='w')
+        try:
+            for entity in self.entities:
+                group = h5file.create_group("/", entity.name)
+                array = entity.array
+                table = h5file.create_table(group, "array", array.dtype,
+                                            expectedrows=len(array))
+                array.append_to_table(table)
+                id_to_rownum = entity.id_to_rownum
+                atom = tables.Atom.from_dtype(id_to_rownum.dtype)
+                index = h5file.create_earray(group, "id_to_rownum", atom,
+                                             shape=(0,),
+                                             expectedrows=len(id_to_rownum))
+                index.append(id_to_rownum)
+                output_rows[entity.name] = entity.output_rows
+            state = dict(state,
+                         period=period,
+                         output_rows=output_rows,
+                         past_errors=[node.past_error
+                                      for node in self.alignment_nodes()],
+                         numpy_random_state=np.random.get_state(),
+                         python_random_state=random.getstate())
+            # the state can be larger than what fits in an attribute
+            h5file.create_vlarray("/", "state", tables.ObjectAtom())
+            h5file.root.state.append(state)
+        finally:
+            h5file.close()
+        # never leave a partially written checkpoint behind
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def load_checkpoint(self, input_dataset):
+        """
+        restores the state saved by save_checkpoint and returns it
+        """
+        if not os.path.exists(self.checkpoint_path):
+            raise Exception("cannot resume the simulation: could not find "
+                            "checkpoint file '%s'" % self.checkpoint_path)
+        h5file = tables.open_file(self.checkpoint_path)
+        try:
+            state = h5file.root.state[0]
+            for entity in self.entities:
+                group = h5file.get_node("/", entity.name)
+                entity.array = ColumnArray.from_table(group.array)
+                entity.id_to_rownum = group.id_to_rownum.read()
+                entity.array_period = state['period']
+        finally:
+            h5file.close()
+        for node, past_error in zip(self.alignment_nodes(),
+                                    state['past_errors']):
+            node.past_error = past_error
+        np.random.set_state(state['numpy_random_state'])
+        random.setstate(state['python_random_state'])
+        self.data_sink.reopen(self.entities_map, input_dataset,
+                              state['period'], state['output_rows'])
+        return state
+
+    def run_output_path(self, run_num):
+        """
+        path of the output file of run number run_num (starting at 0) when
+        parallel runs are requested
+        """
+        root, ext = os.path.splitext(self.data_sink.output_path)
+        return "%s_run%d%s" % (root, run_num + 1, ext)
+
+    def run_numbered(self, run_num, run_console=False):
+        """
+        executes run number run_num (starting at 0) of a simulation with
+        parallel runs. Each run uses its own output file and its own random
+        seed (derived from the simulation seed), so that its results do not
+        depend on the other runs nor on the number of parallel runs.
+        """
+        data_sink = self.data_sink
+        self.data_sink = H5Sink(self.run_output_path(run_num))
+        seed_random_generators(derive_seed(self.random_seed, 'run', run_num))
+        try:
+            return self.run_single(run_console, run_num)
+        finally:
+            self.data_sink = data_sink
+
+    def run_parallel(self, runs, jobs):
+        """
+        executes runs in a pool of jobs worker processes (see run_numbered)
+        """
+        global _parallel_simulation
+
+        if config.autodump:
+            raise ValueError("autodump cannot be used with parallel runs")
+
+        # index the input data only once. The index is inherited (read-only)
+        # by the worker processes.
+        self.load()
+        self.data_source.close()
+
+        print("executing %d runs using %d processes" % (runs, jobs))
+        start_time = time.time()
+        # the simulation is inherited by the worker processes (via fork)
+        # instead of being pickled. Each worker process has its own copy of
+        # the simulation and of the config module, so they do not interfere.
+        _parallel_simulation = self
+        pool = multiprocessing.Pool(jobs)
+        try:
+            runs_process_time = pool.map(_run_parallel_worker, range(runs),
+                                         chunksize=1)
+        finally:
+            pool.terminate()
+            _parallel_simulation = None
+
+        process_time = defaultdict(float)
+        for run_process_time in runs_process_time:
+            for name, elapsed in run_process_time.iteritems():
+                process_time[name] += elapsed
+        print("""
+==========================================
+ %d runs done
+==========================================
+ * %s elapsed
+==========================================
+""" % (runs, time2str(time.time() - start_time)))
+        show_top_processes(process_time, 10)
 
     def start_console(self, context):
         if self.stepbystep:
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+from nose.plugins.skip import SkipTest
+
+from liam2.align_link import py_align_households
+
+
+def random_instance(rng, num_hh, shape, use_sec_axis):
+    hh_sizes = rng.randint(0, 5, size=num_hh)
+    hh_offsets = np.zeros(num_hh + 1, dtype=np.intp)
+    np.cumsum(hh_sizes, out=hh_offsets[1:])
+    num_persons = hh_offsets[-1]
+    hh_members = rng.permutation(num_persons).astype(np.intp)
+    fcols_labels = [rng.randint(size, size=num_persons) for size in shape]
+    labels = np.ravel_multi_index(fcols_labels, shape).astype(np.int32)
+    num_candidates = np.bincount(labels, minlength=np.prod(shape))
+    # some bins cannot be filled (need > num_candidates)
+    need = (rng.uniform(size=len(num_candidates)) *
+            (num_candidates + 3)).astype(np.int64)
+    if use_sec_axis:
+        sec_labels = np.asarray(fcols_labels[-1], dtype=np.int32)
+        need_by_sec_axis = need.reshape(shape).sum(axis=0)
+    else:
+        sec_labels = np.empty(0, dtype=np.int32)
+        need_by_sec_axis = np.empty(0, dtype=np.int64)
+    scores = rng.uniform(size=num_hh)
+    return (scores.argsort()[::-1].astype(np.intp), rng.uniform(size=num_hh),
+            hh_offsets, hh_members, labels, sec_labels, need,
+            num_candidates.astype(np.int64), need_by_sec_axis.astype(np.int64),
+            need.sum())
+
+
+def run_kernel(func, args):
+    # the counters are updated inplace
+    args = [arg.copy() if isinstance(arg, np.ndarray) else arg
+            for arg in args]
+    aligned = func(*args)
+    still_needed, still_available, still_needed_by_sec_axis = args[6:9]
+    return (np.asarray(aligned, dtype=bool), still_needed, still_available,
+            still_needed_by_sec_axis)
+
+
+def check_same_results(seed, use_sec_axis):
+    try:
+        from calign_link import align_households
+    except ImportError:
+        raise SkipTest("calign_link is not compiled")
+    rng = np.random.RandomState(seed)
+    args = random_instance(rng, 300, (2, 3), use_sec_axis)
+    expected = run_kernel(py_align_households, args)
+    got = run_kernel(align_households, args)
+    assert expected[0].any()
+    for e, g in zip(expected, got):
+        assert np.array_equal(e, g), "got: %s\nexpected: %s" % (g, e)
+
+
+def test_compiled_kernel():
+    for seed in range(20):
+        for use_sec_axis in (False, True):
+            yield check_same_results, seed, use_sec_axis
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+
+from liam2.alignment import align_get_indices_nd
+
+
+def test_sidewalk_stays_in_groups():
+    groups = [np.arange(0, 3), np.arange(3, 6), np.arange(6, 9)]
+    need = np.array([1, 1, 2])
+    score = np.ones(9)
+    uniform = np.random.uniform
+    # with u = 0, the targets are exactly at the (cumulated) score of the
+    # last candidate of the previous group
+    np.random.uniform = lambda size=None: np.zeros(size)
+    try:
+        aligned = align_get_indices_nd(9, groups, need, None, score,
+                                       method='sidewalk')
+    finally:
+        np.random.uniform = uniform
+    aligned_mask = np.zeros(9, dtype=bool)
+    aligned_mask[aligned] = True
+    assert [np.sum(aligned_mask[group]) for group in groups] == [1, 1, 2]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.batch import run_batch
+from liam2.simulation import Simulation
+
+GENERATE_INPUT = """
+entities:
+    person:
+        fields:
+            - age: int
+
+        processes:
+            init:
+                - new('person', number=50, age=randint(0, 80))
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: []
+    input:
+        method: void
+        file: none
+    output:
+        file: input.h5
+    start_period: 2015
+    periods: 1
+    random_seed: 0
+"""
+
+BASE = """
+entities:
+    person:
+        fields:
+            - age: int
+            - variant: {type: int, initialdata: False}
+
+        processes:
+            ageing:
+                - age: age + 1
+            tag:
+                - variant: 0
+
+simulation:
+    processes:
+        - person: [ageing, tag]
+    input:
+        file: input.h5
+    output:
+        file: base.h5
+    start_period: 2016
+    periods: 2
+"""
+
+VARIANT = """
+import: base.yml
+
+entities:
+    person:
+        processes:
+            tag:
+                - show('running variant', %(num)d)
+                - variant: %(num)d
+                - assertTrue(%(ok)s)
+
+simulation:
+    output:
+        file: variant%(num)d.h5
+"""
+
+# model without output file
+NO_OUTPUT = """
+entities:
+    person:
+        fields:
+            - age: int
+
+        processes:
+            init:
+                - new('person', number=10, age=0)
+                - show('running no output')
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: []
+    input:
+        method: void
+        file: none
+    output:
+        path: .
+    start_period: 2015
+    periods: 1
+"""
+
+
+def write_file(dirpath, fname, content):
+    fpath = os.path.join(dirpath, fname)
+    with open(fpath, 'w') as f:
+        f.write(content)
+    return fpath
+
+
+def test_batch():
+    dirpath = tempfile.mkdtemp()
+    try:
+        Simulation.from_str(GENERATE_INPUT, output_dir=dirpath,
+                            log_level='periods').run()
+        write_file(dirpath, 'base.yml', BASE)
+        fpaths = [write_file(dirpath, 'variant%d.yml' % num,
+                             VARIANT % {'num': num, 'ok': num != 3})
+                  for num in (1, 2, 3)]
+        num_failed = run_batch(fpaths, jobs=2)
+        assert num_failed == 1
+
+        with tables.open_file(os.path.join(dirpath, 'input.h5')) as f:
+            input_ages = f.root.entities.person.read_where('period == 2015',
+                                                           field='age')
+        for num in (1, 2):
+            fpath = os.path.join(dirpath, 'variant%d.h5' % num)
+            with tables.open_file(fpath) as f:
+                table = f.root.entities.person
+                assert np.all(table.read_where('period >= 2016',
+                                               field='variant') == num)
+                assert np.array_equal(table.read_where('period == 2017',
+                                                       field='age'),
+                                      input_ages + 2)
+            with open(os.path.join(dirpath, 'variant%d.log' % num)) as f:
+                log = f.read()
+            assert "running variant %d" % num in log
+            assert "running variant %d" % (3 - num) not in log
+
+        # the log of the failed simulation contains the error
+        with open(os.path.join(dirpath, 'variant3.log')) as f:
+            log = f.read()
+        assert "running variant 3" in log
+        assert "AssertionError" in log
+    finally:
+        shutil.rmtree(dirpath)
+
+
+def test_batch_without_output():
+    dirpath = tempfile.mkdtemp()
+    try:
+        fpath = write_file(dirpath, 'nooutput.yml', NO_OUTPUT)
+        assert run_batch([fpath], jobs=1) == 0
+        # the log is named after the simulation file and the temporary
+        # directories (of the check and of the run) are removed
+        assert sorted(os.listdir(dirpath)) == ['nooutput.log', 'nooutput.yml']
+        with open(os.path.join(dirpath, 'nooutput.log')) as f:
+            assert "running no output" in f.read()
+    finally:
+        shutil.rmtree(dirpath)
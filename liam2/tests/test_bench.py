@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.bench import compare_results, load_baseline, run_benchmarks
+from liam2.simulation import Simulation
+
+GENERATE_INPUT = """
+entities:
+    person:
+        fields:
+            - age: int
+
+        processes:
+            init:
+                - new('person', number=50, age=randint(0, 80))
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: []
+    input:
+        method: void
+        file: none
+    output:
+        file: input.h5
+    start_period: 2015
+    periods: 1
+    random_seed: 0
+"""
+
+# model without input file, which relies on the number of periods it is run
+VOID_MODEL = """
+entities:
+    person:
+        fields:
+            - age: int
+
+        processes:
+            init:
+                - new('person', number=10, age=0)
+            ageing:
+                - age: age + 1
+                - assertTrue(period < 2017)
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: [ageing]
+    input:
+        method: void
+        file: none
+    output:
+        file: void.h5
+    start_period: 2015
+    periods: 2
+    random_seed: 0
+"""
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - age: int
+
+        processes:
+            ageing:
+                - age: age + 1
+
+simulation:
+    processes:
+        - person: [ageing]
+    input:
+        file: input.h5
+    output:
+        file: model.h5
+    start_period: 2016
+    periods: 5
+"""
+
+SUITE = """
+sizes: [100]
+models:
+    - void.yml
+    - model.yml
+"""
+
+
+def result(model, size, elapsed, peak_memory, error=None):
+    return {'model': model, 'size': size, 'elapsed': elapsed,
+            'peak_memory': peak_memory, 'error': error}
+
+
+def test_compare_results():
+    baseline = [result('a.yml', 10, 1.0, 1000),
+                result('a.yml', 100, 10.0, 10000),
+                result('b.yml', None, 2.0, None),
+                result('c.yml', None, None, None, error='Exception: boom')]
+    # within the threshold
+    results = [result('a.yml', 10, 1.05, 1000),
+               result('a.yml', 100, 9.0, 10500),
+               result('b.yml', None, 2.1, 3000)]
+    assert compare_results(results, baseline) == 0
+    # 2 regressions for a.yml 10 and 1 for b.yml (peak_memory cannot be
+    # compared)
+    results = [result('a.yml', 10, 1.2, 2000),
+               result('a.yml', 100, 10.0, 10000),
+               result('b.yml', None, 3.0, 3000)]
+    assert compare_results(results, baseline) == 3
+    assert compare_results(results, baseline, threshold=0.25) == 2
+    # failed runs, and models which failed or were not in the baseline, are
+    # not compared
+    results = [result('a.yml', 10, None, None, error='Exception: boom'),
+               result('a.yml', 1000, 100.0, 100000),
+               result('c.yml', None, 5.0, 1000),
+               result('d.yml', None, 5.0, 1000)]
+    assert compare_results(results, baseline) == 0
+
+
+def test_load_baseline():
+    dirpath = tempfile.mkdtemp()
+    try:
+        fpath = os.path.join(dirpath, 'history.json')
+        history = [{'date': '2016-01-01', 'results': [result('a.yml', 10, 1.0,
+                                                             1000)]},
+                   {'date': '2016-01-02', 'results': [result('a.yml', 10, 2.0,
+                                                             1000)]}]
+        with open(fpath, 'w') as f:
+            json.dump(history, f)
+        assert load_baseline(fpath) == history[-1]['results']
+
+        # a single entry
+        with open(fpath, 'w') as f:
+            json.dump(history[0], f)
+        assert load_baseline(fpath) == history[0]['results']
+    finally:
+        shutil.rmtree(dirpath)
+
+
+def test_run_benchmarks():
+    dirpath = tempfile.mkdtemp()
+    try:
+        Simulation.from_str(GENERATE_INPUT, output_dir=dirpath,
+                            log_level='periods').run()
+        for fname, content in (('void.yml', VOID_MODEL), ('model.yml', MODEL),
+                               ('suite.yml', SUITE)):
+            with open(os.path.join(dirpath, fname), 'w') as f:
+                f.write(content)
+        suite_path = os.path.join(dirpath, 'suite.yml')
+        output_dir = os.path.join(dirpath, 'output')
+        history_path = os.path.join(dirpath, 'history.json')
+
+        # --periods does not apply to the model without input file
+        assert run_benchmarks(suite_path, periods=3) == (0, 0)
+        with tables.open_file(os.path.join(output_dir, 'void.h5')) as f:
+            periods = f.root.entities.person.col('period')
+        assert np.unique(periods).tolist() == [2014, 2015, 2016]
+        with tables.open_file(os.path.join(output_dir, 'model_100.h5')) as f:
+            table = f.root.entities.person
+            # 3 periods simulated after the last period of the input file
+            assert table.col('period').max() == 2018
+            assert len(table.read_where('period == 2018')) == 100
+
+        # the results are appended to the history, and compared with the
+        # baseline (the same file)
+        num_failed, regressions = run_benchmarks(suite_path, periods=3,
+                                                 baseline_path=history_path,
+                                                 threshold=1e6)
+        assert (num_failed, regressions) == (0, 0)
+        with open(history_path) as f:
+            history = json.load(f)
+        assert len(history) == 2
+        for entry in history:
+            assert sorted(entry.keys()) == ['date', 'liam2', 'numpy',
+                                            'platform', 'python', 'results']
+            results = entry['results']
+            assert [(r['model'], r['size']) for r in results] == \
+                [('void.yml', None), ('model.yml', 100)]
+            for r in results:
+                assert r['error'] is None
+                assert r['elapsed'] > 0
+                assert r['individuals'] > 0
+                assert 'ageing' in r['processes']
+    finally:
+        shutil.rmtree(dirpath)
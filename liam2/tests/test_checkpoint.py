@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.simulation import Simulation
+
+MODEL = """
+globals:
+    MIGRATION:
+        path: migration.csv
+        type: int
+
+entities:
+    household:
+        links:
+            persons: {type: one2many, target: person, field: hh_id}
+
+        processes:
+            init:
+                - new('household', number=60)
+            migration:
+                # the alignment needs more persons than there are candidates,
+                # so the error carried to the next period is not zero
+                - migrants: align_abs(persons.count(), MIGRATION,
+                                      link=persons, errors='carry',
+                                      filter=uniform() < 0.2)
+                - remove(migrants)
+
+    person:
+        fields:
+            - age: int
+            - male: bool
+            - income: float
+            - hh_id: int
+
+        links:
+            household: {type: many2one, target: household, field: hh_id}
+
+        processes:
+            init:
+                - new('person', number=200, age=randint(0, 80),
+                      male=uniform() < 0.5, hh_id=randint(0, 60))
+            ageing:
+                - age: age + 1
+                - income: if(age >= 18, normal(1000, 100), 0.0)
+            birth:
+                - new('person', filter=uniform() < 0.05, age=0,
+                      male=uniform() < 0.5)
+            death:
+                - remove(logit_regr(age / 10 - 8, align=0.05) or
+                         household.get(id) == -1)
+            crash:
+                - assertTrue(period != 2018)
+
+simulation:
+    checkpoint_interval: 1
+    init:
+        - household: [init]
+        - person: [init]
+    processes:
+        - household: [migration]
+        - person: [ageing, birth, death, crash]
+    input:
+        method: void
+        file: none
+    output:
+        file: checkpoint.h5
+    start_period: 2015
+    periods: 5
+    random_seed: 0
+"""
+
+MIGRATION = """male,
+False,True
+40,40
+"""
+
+
+def run_model(output_dir, assertions, resume=False):
+    with open(os.path.join(output_dir, 'migration.csv'), 'w') as f:
+        f.write(MIGRATION)
+    simulation = Simulation.from_str(MODEL, input_dir=output_dir,
+                                     output_dir=output_dir,
+                                     assertions=assertions,
+                                     log_level='periods')
+    simulation.run(resume=resume)
+    return simulation
+
+
+def read_output(output_dir):
+    with tables.open_file(os.path.join(output_dir, 'checkpoint.h5')) as f:
+        return {table.name: table.read()
+                for table in f.iter_nodes(f.root.entities)}
+
+
+def test_resume():
+    reference_dir = tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    try:
+        run_model(reference_dir, assertions='skip')
+        checkpoint_path = os.path.join(output_dir, 'checkpoint_checkpoint.h5')
+
+        # the simulation is interrupted during period 2018
+        try:
+            run_model(output_dir, assertions='raise')
+            assert False, "the simulation was not interrupted"
+        except AssertionError as e:
+            assert 'period != 2018' in str(e), str(e)
+        with tables.open_file(checkpoint_path) as f:
+            state = f.root.state[0]
+        assert state['period'] == 2017
+        assert any(np.any(past_error) for past_error in state['past_errors'])
+
+        run_model(output_dir, assertions='skip', resume=True)
+        assert not os.path.exists(checkpoint_path)
+        expected, result = read_output(reference_dir), read_output(output_dir)
+        assert sorted(result.keys()) == ['household', 'person']
+        for entity_name, expected_table in expected.iteritems():
+            table = result[entity_name]
+            assert np.unique(table['period']).tolist() == range(2014, 2020)
+            assert table.dtype == expected_table.dtype
+            for name in table.dtype.names:
+                np.testing.assert_array_equal(table[name],
+                                              expected_table[name])
+    finally:
+        shutil.rmtree(reference_dir)
+        shutil.rmtree(output_dir)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2 import importer
+from liam2.importer import csv2h5
+
+# the types of the columns are detected using the first lines of the files
+# only (lowered in the tests to keep the files small)
+SAMPLE_LINES = 20
+
+TYPES_IMPORT = """
+output: import_types.h5
+
+entities:
+    # integers then floats
+    int_then_float:
+        path: int_then_float.csv
+
+    # empty values then integers
+    empty_then_int:
+        path: empty_then_int.csv
+
+    # 0 and 1 (booleans) then other integers
+    bool_then_int:
+        path: bool_then_int.csv
+"""
+
+# {entity_name: (function returning the value of line i, type, values of the
+# last lines of the sample, values after the sample)}
+EXPECTED = {
+    'int_then_float': (lambda i: '1' if i < SAMPLE_LINES else '2.5',
+                       np.float64, [1.0, 1.0], 2.5),
+    'empty_then_int': (lambda i: '' if i < SAMPLE_LINES else '7',
+                       np.int64, [-1, -1], 7),
+    'bool_then_int': (lambda i: str(i % 2) if i < SAMPLE_LINES else '2',
+                      np.int64, [0, 1], 2)
+}
+
+
+def write_types_files(dirpath):
+    for name, (value, _, _, _) in EXPECTED.items():
+        with open(os.path.join(dirpath, name + '.csv'), 'w') as f:
+            f.write('period,id,value\n')
+            for i in range(SAMPLE_LINES + 3):
+                f.write('2015,%d,%s\n' % (i, value(i)))
+    fpath = os.path.join(dirpath, 'import_types.yml')
+    with open(fpath, 'w') as f:
+        f.write(TYPES_IMPORT)
+    return fpath
+
+
+def check_import(jobs):
+    dirpath = tempfile.mkdtemp()
+    type_detection_lines = importer.TYPE_DETECTION_LINES
+    # the worker processes are forked after the value is replaced
+    importer.TYPE_DETECTION_LINES = SAMPLE_LINES
+    try:
+        fpath = write_types_files(dirpath)
+        # with a small buffer, some chunks are already written when a column
+        # turns out to have another type than the one detected
+        csv2h5(fpath, buffersize=2 ** 7, jobs=jobs)
+        with tables.open_file(os.path.join(dirpath, 'import_types.h5')) as f:
+            arrays = {table.name: table.read()
+                      for table in f.iter_nodes(f.root.entities)}
+    finally:
+        importer.TYPE_DETECTION_LINES = type_detection_lines
+        shutil.rmtree(dirpath)
+    assert sorted(arrays.keys()) == sorted(EXPECTED.keys())
+    for name, (_, type_, sample_end, after) in EXPECTED.items():
+        array = arrays[name]
+        assert array.dtype['value'].type is type_, name
+        assert len(array) == SAMPLE_LINES + 3, name
+        assert np.array_equal(array['id'], np.arange(len(array))), name
+        values = array['value']
+        assert values[SAMPLE_LINES - 2:SAMPLE_LINES].tolist() == sample_end, \
+            name
+        assert np.all(values[SAMPLE_LINES:] == after), name
+
+
+def test_type_change_after_sample():
+    check_import(jobs=1)
+
+
+def test_type_change_after_sample_parallel():
+    check_import(jobs=2)
+
+
+IMPORT = """
+output: output.h5
+
+entities:
+    good:
+        path: good.csv
+    bad:
+        path: bad.csv
+"""
+
+
+def write_files(dirpath, bad_content):
+    files = (('import.yml', IMPORT),
+             ('good.csv', 'period,id,value\n2015,0,1\n2015,1,2\n'),
+             ('bad.csv', bad_content))
+    for fname, content in files:
+        with open(os.path.join(dirpath, fname), 'w') as f:
+            f.write(content)
+    return os.path.join(dirpath, 'import.yml')
+
+
+def test_worker_error():
+    dirpath = tempfile.mkdtemp()
+    try:
+        fpath = write_files(dirpath, 'period,id,value\n2015,0,1\n2015,1\n')
+        try:
+            csv2h5(fpath, jobs=2)
+            assert False, "the import did not fail"
+        except Exception as e:
+            # the error of the worker process is reported with its type and
+            # traceback
+            message = str(e)
+            assert "error while reading '%s'" % os.path.join(dirpath,
+                                                             'bad.csv') \
+                in message, message
+            assert "Exception: all rows do not have the same number of " \
+                "columns" in message, message
+            assert "Traceback (most recent call last)" in message, message
+    finally:
+        shutil.rmtree(dirpath)
+
+
+def test_worker_crash():
+    dirpath = tempfile.mkdtemp()
+    read_csv_file = importer.read_csv_file
+
+    def crash_on_bad_file(task, send):
+        if task[1].endswith('bad.csv'):
+            # simulate a worker process killed (e.g. by the OOM killer)
+            os._exit(1)
+        read_csv_file(task, send)
+
+    # the worker processes are forked after the function is replaced
+    importer.read_csv_file = crash_on_bad_file
+    try:
+        fpath = write_files(dirpath, 'period,id,value\n2015,0,1\n')
+        try:
+            csv2h5(fpath, jobs=2)
+            assert False, "the import did not fail"
+        except Exception as e:
+            assert "died unexpectedly (exit code: 1)" in str(e), str(e)
+    finally:
+        importer.read_csv_file = read_csv_file
+        shutil.rmtree(dirpath)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+from nose.plugins.skip import SkipTest
+
+from liam2.matching import py_sparse_assignment
+from liam2.simulation import Simulation
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - male: bool
+            - partner_id: int
+
+        processes:
+            init:
+                - new('person', number=4, partner_id=-1)
+                - male: id < 2
+            marriage:
+                # the only way to match both men is 0-2 and 1-3, unless 0-3
+                # can be matched
+                - partner_id: matching(set1filter=male, set2filter=not male,
+                                       orderby=id,
+                                       score=if((id == 0) and (other.id == 3),
+                                                %s, - (other.id - id)),
+                                       algo='optimal')
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: [marriage]
+    input:
+        method: void
+        file: none
+    output:
+        file: matching.h5
+    start_period: 2015
+    periods: 1
+"""
+
+
+def sparse_assignment_functions():
+    funcs = [py_sparse_assignment]
+    try:
+        from cmatching import sparse_assignment
+        funcs.append(sparse_assignment)
+    except ImportError:
+        pass
+    return funcs
+
+
+def random_instance(rng, num_rows, num_cols, density):
+    edges = [np.flatnonzero(rng.uniform(size=num_cols) < density)
+             for _ in range(num_rows)]
+    offsets = np.zeros(num_rows + 1, dtype=np.intp)
+    np.cumsum([len(row_cols) for row_cols in edges], out=offsets[1:])
+    cols = np.concatenate(edges).astype(np.intp)
+    costs = rng.randint(0, 10, size=len(cols)).astype(float)
+    return offsets, cols, costs
+
+
+def brute_force(offsets, cols, costs):
+    """
+    returns the (number of pairs, total cost) of the best assignment
+    """
+    num_rows = len(offsets) - 1
+
+    def best(row, used):
+        if row == num_rows:
+            return 0, 0.0
+        # leaving the row unassigned
+        result = best(row + 1, used)
+        for e in range(offsets[row], offsets[row + 1]):
+            if cols[e] not in used:
+                count, cost = best(row + 1, used | {cols[e]})
+                result = min(result, (count + 1, cost + costs[e]),
+                             key=lambda res: (-res[0], res[1]))
+        return result
+    return best(0, frozenset())
+
+
+def check_assignment(func, offsets, cols, costs, num_cols, row_order):
+    col4row = func(row_order, offsets, cols, costs, num_cols)
+    count, total = 0, 0.0
+    for row, col in enumerate(col4row):
+        if col == -1:
+            continue
+        row_cols = list(cols[offsets[row]:offsets[row + 1]])
+        assert col in row_cols, "row %d assigned to column %d" % (row, col)
+        count += 1
+        total += costs[offsets[row] + row_cols.index(col)]
+    assigned = col4row[col4row != -1]
+    assert len(set(assigned)) == len(assigned), "%s" % col4row
+    expected = brute_force(offsets, cols, costs)
+    assert (count, total) == expected, \
+        "got: %s (%s)\nexpected: %s" % ((count, total), col4row, expected)
+
+
+def test_unmatched_rows():
+    # rows 0 and 1 can only be matched with column 0
+    offsets = np.array([0, 1, 2], dtype=np.intp)
+    cols = np.array([0, 0], dtype=np.intp)
+    costs = np.array([5.0, 0.0])
+    for func in sparse_assignment_functions():
+        for row_order in ([0, 1], [1, 0]):
+            col4row = func(np.array(row_order, dtype=np.intp), offsets, cols,
+                           costs, 1)
+            assert list(col4row) == [-1, 0], col4row
+
+
+def test_random_instances():
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        num_rows, num_cols = rng.randint(1, 7, size=2)
+        density = rng.uniform(0.1, 0.8)
+        offsets, cols, costs = random_instance(rng, num_rows, num_cols,
+                                               density)
+        row_order = rng.permutation(num_rows).astype(np.intp)
+        for func in sparse_assignment_functions():
+            check_assignment(func, offsets, cols, costs, num_cols, row_order)
+
+
+def test_compiled_version():
+    funcs = sparse_assignment_functions()
+    if len(funcs) == 1:
+        raise SkipTest("cmatching is not compiled")
+    rng = np.random.RandomState(1)
+    offsets, cols, costs = random_instance(rng, 500, 400, 0.02)
+    costs = rng.uniform(size=len(cols))
+    row_order = np.arange(500, dtype=np.intp)
+    py_result, c_result = [func(row_order, offsets, cols, costs, 400)
+                           for func in funcs]
+    assert np.array_equal(py_result, c_result)
+
+
+def test_non_finite_scores():
+    # pairs with a nan or infinite score are never matched
+    for score in ('nan', 'inf', '-inf'):
+        output_dir = tempfile.mkdtemp()
+        try:
+            Simulation.from_str(MODEL % score, output_dir=output_dir,
+                                log_level='periods').run()
+            fpath = os.path.join(output_dir, 'matching.h5')
+            with tables.open_file(fpath) as f:
+                partner_ids = f.root.entities.person.read_where(
+                    'period == 2015', field='partner_id')
+        finally:
+            shutil.rmtree(output_dir)
+        assert partner_ids.tolist() == [2, 3, 0, 1], (score, partner_ids)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+from liam2.memusage import MemoryTracker, CATEGORIES
+from liam2.simulation import Simulation
+from liam2.utils import size2str
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - age: int
+            - income: float
+
+        processes:
+            init:
+                - new('person', number=1000, age=randint(0, 80))
+            ageing:
+                - age: age + 1
+                # 1000 floats (8000 bytes) which only live during the process
+                - tmp: age * 2.0
+                - income: tmp + 1.0
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: [ageing]
+    input:
+        method: void
+        file: none
+    output:
+        file: memory.h5
+    start_period: 2015
+    periods: 3
+    random_seed: 0
+"""
+
+
+def test_track_memory():
+    output_dir = tempfile.mkdtemp()
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        simulation = Simulation.from_str(MODEL, output_dir=output_dir,
+                                         log_level='periods',
+                                         track_memory=True)
+        simulation.run()
+        assert simulation.memory_tracker is None
+        with open(os.path.join(output_dir, 'memory_memory.csv'), 'rb') as f:
+            rows = list(csv.reader(f))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(output_dir)
+
+    header, rows = rows[0], rows[1:]
+    assert tuple(header) == MemoryTracker.columns
+    rows = [dict(zip(header, row)) for row in rows]
+    for row in rows:
+        for column in header[3:]:
+            row[column] = int(row[column]) if row[column] else None
+    steps = [(int(row['period']), row['step']) for row in rows]
+    assert steps == [(2014, 'load input data'), (2014, 'person.init'),
+                     (2014, 'person.store_period_data'),
+                     (2015, 'person.ageing'), (2015, 'person.store_period_data'),
+                     (2016, 'person.ageing'), (2016, 'person.store_period_data'),
+                     (2017, 'person.ageing'), (2017, 'person.store_period_data')]
+
+    for row in rows:
+        assert row['run'] == '0'
+        assert row['total'] == sum(row[c] for c in CATEGORIES)
+        if row['rss_after'] is not None:
+            assert row['peak_rss'] >= row['rss_after']
+        if row['step'] == 'person.ageing':
+            # the temporary variable was purged at the end of the process
+            assert row['temp_variables'] >= 8000
+            assert row['array'] > 0
+        elif row['step'] == 'person.store_period_data':
+            assert row['temp_variables'] == 0
+
+    # the peaks shown at the end of the simulation
+    output = output.getvalue()
+    peak_arrays = max(rows, key=lambda row: row['total'])
+    expected = ("peak arrays memory: %s (run 1, period %s, %s)"
+                % (size2str(peak_arrays['total']), peak_arrays['period'],
+                   peak_arrays['step']))
+    assert expected in output, output
+    if rows[0]['peak_rss'] is not None:
+        peak_rss = max(row['peak_rss'] for row in rows)
+        assert "peak memory: %s " % size2str(peak_rss) in output, output
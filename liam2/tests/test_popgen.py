@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.popgen import generate_population
+
+DEMO_PATH = os.path.join(os.path.dirname(__file__), 'examples', 'demo.h5')
+LINK_FIELDS = {'person': {'mother_id': 'person', 'partner_id': 'person',
+                          'hh_id': 'household'}}
+
+
+def read_entities(fpath):
+    with tables.open_file(fpath) as f:
+        return {table.name: table.read()
+                for table in f.iter_nodes(f.root.entities)}
+
+
+def num_links(array, field):
+    return np.sum(array[field] != -1)
+
+
+def check_population(entities):
+    """
+    checks that the ids of each entity are unique in each period and that
+    all links point to an existing individual (of the same period) and,
+    for partners, that they point to each other
+    """
+    for name, array in entities.iteritems():
+        for period in np.unique(array['period']):
+            period_array = array[array['period'] == period]
+            ids = period_array['id']
+            assert len(np.unique(ids)) == len(ids), (name, period)
+            for field, target in LINK_FIELDS.get(name, {}).iteritems():
+                target_array = entities[target]
+                target_ids = target_array['id'][target_array['period'] ==
+                                                period]
+                links = period_array[field]
+                links = links[links != -1]
+                assert np.all(np.in1d(links, target_ids)), (name, field)
+            if name == 'person':
+                partner_ids = period_array['partner_id']
+                in_couple = partner_ids != -1
+                id_to_row = dict(zip(ids, range(len(ids))))
+                partner_rows = [id_to_row[pid]
+                                for pid in partner_ids[in_couple]]
+                assert np.array_equal(partner_ids[partner_rows],
+                                      ids[in_couple])
+
+
+def test_replicate():
+    dirpath = tempfile.mkdtemp()
+    try:
+        output_path = os.path.join(dirpath, 'population.h5')
+        counts = generate_population(DEMO_PATH, output_path, LINK_FIELDS,
+                                     copies=3)
+        template = read_entities(DEMO_PATH)
+        entities = read_entities(output_path)
+        with tables.open_file(output_path) as f:
+            assert 'periodic' in f.root.globals
+    finally:
+        shutil.rmtree(dirpath)
+
+    check_population(template)
+    check_population(entities)
+    assert counts == {name: len(array) * 3
+                      for name, array in template.iteritems()}
+    for name, array in entities.iteritems():
+        assert len(array) == counts[name]
+    # each copy is a complete population: no link is lost
+    person, template_person = entities['person'], template['person']
+    for field in LINK_FIELDS['person']:
+        assert num_links(person, field) == 3 * num_links(template_person,
+                                                         field)
+    for field in template_person.dtype.names:
+        if field not in ('id',) + tuple(LINK_FIELDS['person']):
+            assert np.array_equal(person[field],
+                                  np.tile(template_person[field], 3))
+
+
+def test_resample_households():
+    dirpath = tempfile.mkdtemp()
+    try:
+        output_path = os.path.join(dirpath, 'population.h5')
+        counts = generate_population(DEMO_PATH, output_path, LINK_FIELDS,
+                                     size=25000, cluster_entity='household',
+                                     seed=0)
+        entities = read_entities(output_path)
+
+        # the same seed gives the same population
+        other_path = os.path.join(dirpath, 'other.h5')
+        generate_population(DEMO_PATH, other_path, LINK_FIELDS, size=25000,
+                            cluster_entity='household', seed=0)
+        other = read_entities(other_path)
+    finally:
+        shutil.rmtree(dirpath)
+
+    check_population(entities)
+    for name, array in entities.iteritems():
+        assert len(array) == counts[name]
+        assert np.array_equal(array, other[name])
+    person = entities['person']
+    assert len(person) >= 25000
+    # persons are drawn together with their household, so each generated
+    # household has the members of a household of the template
+    template_person = read_entities(DEMO_PATH)['person']
+    assert np.all(template_person['hh_id'] != -1)
+    assert np.all(person['hh_id'] != -1)
+    household_ids, household_sizes = np.unique(person['hh_id'],
+                                               return_counts=True)
+    assert len(household_ids) == counts['household']
+    template_sizes = np.bincount(template_person['hh_id'])
+    assert set(household_sizes) <= set(template_sizes[template_sizes > 0])
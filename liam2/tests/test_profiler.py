@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+from liam2 import profiler
+from liam2.simulation import Simulation
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - age: int
+            - income: float
+
+        processes:
+            init:
+                - new('person', number=100, age=randint(0, 80))
+            ageing:
+                - age: age + 1
+                - income: compute_income(age) + compute_income(age + 1)
+            compute_income(a):
+                - return if(a >= 18, normal(1000, 100), 0.0)
+            stats:
+                - num_adults: count(age >= 18)
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: [ageing, stats]
+    input:
+        method: void
+        file: none
+    output:
+        file: profile.h5
+    start_period: 2015
+    periods: 3
+    random_seed: 0
+"""
+
+
+def find_node(node, name):
+    for child in node['children']:
+        if child['name'] == name:
+            return child
+    raise AssertionError("%s has no child named %s" % (node['name'], name))
+
+
+def find_line(node, prefix):
+    """
+    finds the child of node for the process line starting with prefix
+    """
+    lines = [child for child in node['children']
+             if child['name'].startswith(prefix)]
+    assert len(lines) == 1, (node['name'], prefix)
+    return lines[0]
+
+
+def check_times(node):
+    # allow for rounding errors
+    assert node['inclusive'] >= node['exclusive'] - 1e-9, node['name']
+    children_time = sum(child['inclusive'] for child in node['children'])
+    assert node['inclusive'] >= children_time - 1e-6, node['name']
+    for child in node['children']:
+        check_times(child)
+
+
+def test_profile():
+    output_dir = tempfile.mkdtemp()
+    try:
+        simulation = Simulation.from_str(MODEL, output_dir=output_dir,
+                                         log_level='periods', profile=True)
+        simulation.run()
+        assert profiler.current is None
+        with open(os.path.join(output_dir, 'profile_profile.json')) as f:
+            tree = json.load(f)
+        with open(os.path.join(output_dir, 'profile_profile.folded')) as f:
+            folded = f.read().splitlines()
+    finally:
+        shutil.rmtree(output_dir)
+
+    assert tree['name'] == 'simulation'
+    assert tree['calls'] == 1
+    check_times(tree)
+
+    assert find_node(tree, 'load input data')['calls'] == 1
+    # 1 init period + 3 periods
+    assert find_node(tree, 'person.store_period_data')['calls'] == 4
+    assert find_node(tree, 'person.init')['calls'] == 1
+    ageing = find_node(tree, 'person.ageing')
+    assert ageing['calls'] == 3
+    assert find_line(ageing, 'age: ')['calls'] == 3
+    income = find_line(ageing, 'income: ')
+    assert income['calls'] == 3
+    function = find_node(income, 'person.compute_income()')
+    assert function['calls'] == 6
+    normal = find_node(find_line(function, 'return '), 'normal()')
+    assert normal['calls'] == 6
+    # the population does not change
+    assert normal['avg_size'] == 100
+    stats = find_node(tree, 'person.stats')
+    count = find_node(find_line(stats, 'num_adults: '), 'count()')
+    assert count['calls'] == 3
+
+    # the folded file has one line per node with a non-zero exclusive time
+    total = 0
+    for line in folded:
+        stack, microseconds = line.rsplit(' ', 1)
+        frames = stack.split(';')
+        assert frames[0] == 'simulation'
+        node = tree
+        for frame in frames[1:]:
+            node = find_node(node, frame)
+        assert int(microseconds) == int(round(node['exclusive'] * 1e6))
+        total += int(microseconds)
+    # the exclusive times of all nodes add up to the total time
+    assert abs(total - tree['inclusive'] * 1e6) <= len(folded) + 1
+
+
+def test_exclusive_times():
+    profile = profiler.Profiler()
+    profile.call('load input data', lambda: None)
+    profile.call('person.ageing', profile.call, 'age: (age + 1)',
+                 profile.call, 'numexpr', sum, range(1000))
+    # the steps of the simulation are not expressions
+    times = profile.exclusive_times()
+    assert sorted(times.keys()) == ['age: (age + 1)', 'numexpr']
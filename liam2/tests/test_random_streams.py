@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.simulation import Simulation
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - u: float
+            - n: float
+            - c: int
+
+        processes:
+            init:
+                - new('person', number=100)
+            draw_u:
+                - u: uniform()
+            draw_n:
+                - n: normal()
+            draw_c:
+                - c: choice([0, 1, 2], [0.2, 0.5, 0.3])
+            noise:
+                - tmp: uniform() + normal()
+                - tmp2: choice([0, 1], [0.5, 0.5])
+
+simulation:
+    random_streams: %(random_streams)s
+    init:
+        - person: [init]
+    processes:
+        - person: [%(processes)s]
+    input:
+        method: void
+        file: none
+    output:
+        file: %(output_file)s
+    start_period: 2015
+    periods: 2
+    random_seed: 0
+"""
+
+
+def run_model(output_dir, output_file, processes, random_streams):
+    model = MODEL % {'random_streams': random_streams,
+                     'processes': ', '.join(processes),
+                     'output_file': output_file}
+    simulation = Simulation.from_str(model, output_dir=output_dir,
+                                     log_level='periods')
+    simulation.run()
+    with tables.open_file(os.path.join(output_dir, output_file)) as f:
+        # the fields are nan in the initial period
+        return f.root.entities.person.read_where('period >= 2015')
+
+
+def draws_differ(random_streams):
+    output_dir = tempfile.mkdtemp()
+    try:
+        reference = run_model(output_dir, 'reference.h5',
+                              ['draw_u', 'draw_n', 'draw_c'], random_streams)
+        # insert processes drawing random numbers and reorder the others
+        modified = run_model(output_dir, 'modified.h5',
+                             ['noise', 'draw_c', 'draw_u', 'noise',
+                              'draw_n'], random_streams)
+    finally:
+        shutil.rmtree(output_dir)
+    return [name for name in ('u', 'n', 'c')
+            if not np.array_equal(reference[name], modified[name])]
+
+
+def test_process_draws_do_not_depend_on_other_processes():
+    assert draws_differ(random_streams=True) == []
+
+
+def test_process_draws_depend_on_other_processes_without_streams():
+    # make sure the test above can detect a difference
+    assert draws_differ(random_streams=False) == ['u', 'n', 'c']
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tables
+
+from liam2.simulation import Simulation
+
+MODEL = """
+entities:
+    person:
+        fields:
+            - age: int
+            - u: float
+            - c: int
+
+        processes:
+            init:
+                - new('person', number=100, age=randint(0, 80))
+            ageing:
+                - age: age + 1
+                - u: uniform()
+                - c: choice([0, 1, 2], [0.2, 0.5, 0.3])
+            death:
+                - remove(logit_regr(age / 10 - 8, align=0.05))
+
+simulation:
+    init:
+        - person: [init]
+    processes:
+        - person: [ageing, death]
+    input:
+        method: void
+        file: none
+    output:
+        file: runs.h5
+    start_period: 2015
+    periods: 3
+    random_seed: 0
+"""
+
+
+def run_model(output_dir, runs, jobs):
+    simulation = Simulation.from_str(MODEL, output_dir=output_dir, runs=runs,
+                                     jobs=jobs, log_level='periods')
+    simulation.run()
+    results = []
+    for run_num in range(1, runs + 1):
+        fpath = os.path.join(output_dir, 'runs_run%d.h5' % run_num)
+        with tables.open_file(fpath) as f:
+            # the fields are nan in the initial period
+            table = f.root.entities.person
+            results.append(table.read_where('period >= 2015'))
+    return results
+
+
+def test_results_do_not_depend_on_jobs():
+    two_jobs_dir = tempfile.mkdtemp()
+    three_jobs_dir = tempfile.mkdtemp()
+    try:
+        two_jobs = run_model(two_jobs_dir, runs=3, jobs=2)
+        three_jobs = run_model(three_jobs_dir, runs=3, jobs=3)
+    finally:
+        shutil.rmtree(two_jobs_dir)
+        shutil.rmtree(three_jobs_dir)
+    for two_jobs_result, three_jobs_result in zip(two_jobs, three_jobs):
+        assert np.array_equal(two_jobs_result, three_jobs_result)
+    # each run has its own random numbers
+    assert not np.array_equal(two_jobs[0]['age'], two_jobs[1]['age'])
+
+
+def test_sequential_runs_unchanged():
+    output_dir = tempfile.mkdtemp()
+    try:
+        Simulation.from_str(MODEL, output_dir=output_dir, runs=2,
+                            log_level='periods').run()
+        # without parallel runs, all runs write to the same output file
+        assert os.listdir(output_dir) == ['runs.h5']
+    finally:
+        shutil.rmtree(output_dir)
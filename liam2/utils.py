@@ -1,11 +1,15 @@
 # encoding: utf-8
 from __future__ import print_function
 
+import os
 import re
 import ast
 import sys
 import math
 import time
+import random
+import struct
+import hashlib
 import operator
 import itertools
 from itertools import izip, product
@@ -21,6 +25,15 @@ try:
 except ImportError:
     QtGui, QtCore = None, None
     QtAvailable = False
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    # not available on Windows
+    import resource
+except ImportError:
+    resource = None
 
 import config
 
@@ -186,14 +199,39 @@ def size2str(value):
     return fmt % (value / 1024.0 ** scale, units[scale])
 
 
-# def mem_usage():
-#    pid = os.getpid()
-#    proc = psutil.Process(pid)
-#    return proc.get_memory_info()[0]
+def mem_usage():
+    """
+    returns the resident memory (RSS) of the current process in bytes or None
+    if it cannot be determined on this platform (without psutil)
+    """
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
 
 
-# def mem_usage_str():
-#    return size2str(mem_usage())
+def peak_mem_usage():
+    """
+    returns the maximum resident memory used so far by the current process in
+    bytes or None if it cannot be determined on this platform
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on Mac OS X but in kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        # on Windows
+        return getattr(psutil.Process(os.getpid()).memory_info(), 'peak_wset',
+                       None)
+    return None
+
+
+def mem_usage_str():
+    usage = mem_usage()
+    return size2str(usage) if usage is not None else 'N/A'
 
 
 def gettime(func, *args, **kwargs):
@@ -215,6 +253,30 @@ def prod(values):
     return reduce(operator.mul, values, 1)
 
 
+def derive_seed(*keys):
+    """
+    returns a seed (a list of 32 bits integers) derived from keys. Different
+    keys give unrelated seeds, and thus independent streams of random numbers.
+
+    >>> seed = derive_seed(5235, 0, 2015, 'person', 'birth')
+    >>> seed == derive_seed(5235, 0, 2015, 'person', 'birth')
+    True
+    >>> seed == derive_seed(5235, 0, 2016, 'person', 'birth')
+    False
+    """
+    digest = hashlib.sha256('/'.join(str(key) for key in keys)).digest()
+    return list(struct.unpack('<8I', digest))
+
+
+def seed_random_generators(seed):
+    """
+    seeds both numpy and python random generators with seed (a list of 32 bits
+    integers, as returned by derive_seed)
+    """
+    np.random.seed(seed)
+    random.seed(seed[0] << 32 | seed[1])
+
+
 def ndim(arraylike):
     """
     Computes the number of dimensions of arbitrary structures, including
@@ -389,6 +451,23 @@ class Axis(object):
         return len(self.labels)
 
 
+def flatten_labels(labels):
+    """
+    expands the labels which are tuples (combinations of labels of several
+    dimensions) in a sequence of labels
+
+    >>> flatten_labels(['a', ('b', 'c'), 'd'])
+    ['a', 'b', 'c', 'd']
+    """
+    result = []
+    for label in labels:
+        if isinstance(label, tuple):
+            result.extend(label)
+        else:
+            result.append(label)
+    return result
+
+
 class LabeledArray(np.ndarray):
     # noinspection PyNoneFunctionAssignment
     def __new__(cls, input_array, dim_names=None, pvalues=None,
@@ -551,13 +630,23 @@ class LabeledArray(np.ndarray):
         #       10 |  False |    25 |   10 |    xx
         #       10 |   True |     1 |    1 |    xx
         #          |  total |    xx |   xx |    xx
+        # a dimension whose labels are combinations of values of several
+        # dimensions (eg in groupby(agegroup, region, gender, sparse=True))
+        # is displayed as several columns
+        # agegroup | region | gender |      |
+        #          |        |  False | True | total
+        #        5 |      1 |     20 |   15 |    35
+        #        5 |      4 |      3 |    0 |     3
+        #       10 |      2 |     25 |   10 |    35
+        #          |  total |     48 |   25 |    73
         width = self.shape[-1]
         height = prod(self.shape[:-1])
         if self.dim_names is not None:
-            result = [self.dim_names +
+            dim_names = flatten_labels(self.dim_names)
+            result = [dim_names +
                       [''] * (width - 1),
                       # 2nd line
-                      [''] * (self.ndim - 1) +
+                      [''] * (len(dim_names) - 1) +
                       list(self.pvalues[-1])]
             if self.row_totals is not None:
                 result[0].append('')
@@ -567,7 +656,8 @@ class LabeledArray(np.ndarray):
         data = np.asarray(self).ravel()
 
         if self.pvalues is not None:
-            categ_values = list(product(*self.pvalues[:-1]))
+            categ_values = [flatten_labels(values)
+                            for values in product(*self.pvalues[:-1])]
         else:
             categ_values = [[] for _ in range(height)]
         row_totals = self.row_totals
@@ -581,7 +671,10 @@ class LabeledArray(np.ndarray):
                 line.append(row_totals[y])
             result.append(line)
         if self.col_totals is not None and self.ndim > 1:
-            result.append([''] * (self.ndim - 2) + ['total'] + self.col_totals)
+            num_label_cols = len(categ_values[0]) if categ_values \
+                else self.ndim - 1
+            result.append([''] * (num_label_cols - 1) + ['total'] +
+                          self.col_totals)
         return result
 
     def __repr__(self):
@@ -108,7 +108,11 @@ class MyBuildExt(build_ext):
             cxfreeze_searchpath.insert(0, self.build_lib)
 
 
-ext_modules = [Extension("cpartition", ["liam2/cpartition.pyx"],
+ext_modules = [Extension("calign_link", ["liam2/calign_link.pyx"],
+                         include_dirs=[np.get_include()]),
+               Extension("cmatching", ["liam2/cmatching.pyx"],
+                         include_dirs=[np.get_include()]),
+               Extension("cpartition", ["liam2/cpartition.pyx"],
                          include_dirs=[np.get_include()]),
                Extension("cutils", ["liam2/cutils.pyx"],
                          include_dirs=[np.get_include()])]